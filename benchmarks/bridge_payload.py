@@ -0,0 +1,117 @@
+"""
+Compares the size and cost of the bridge wire formats, end to end: from a discord message to the bytes of the
+frames sent to a consumer.
+
+Each event goes through the same path as on the bot: `generate_payload` (against a warm author and payload
+cache), `MessagePayload.to_event`, serialisation into the on-disk queue, and finally encoding into frames.
+"json" is the original format (the payload dict plus its `seq`), "compact" is the format sent with
+`/bridge/recv?format=compact`. Messages are stand-ins carrying the attributes `generate_payload` reads.
+
+Usage: python -m benchmarks.bridge_payload [events]
+"""
+import datetime
+import random
+import sys
+import time
+from types import SimpleNamespace
+
+from utils.bridge_payload import AuthorCache, CompactEncoder, PayloadCache, dumps, generate_payload
+
+AVATAR = "https://cdn.discordapp.com/avatars/{}/{}.webp?size=512"
+ATTACHMENT = "https://cdn.discordapp.com/attachments/1032974266527907901/{}/image.png"
+
+
+class FakeAvatar:
+    def __init__(self, author_id: int):
+        self.key = "a" * 32
+        self.url = AVATAR.format(author_id, self.key)
+
+    def with_static_format(self, _):
+        return self
+
+    def with_size(self, _):
+        return self
+
+
+def make_messages(count: int, authors: int = 12) -> list[SimpleNamespace]:
+    rng = random.Random(0)
+    members = [
+        SimpleNamespace(id=author_id, display_name="user%d" % author_id, bot=False, system=False)
+        for author_id in range(1000, 1000 + authors)
+    ]
+    for member in members:
+        member.display_avatar = FakeAvatar(member.id)
+    created_at = datetime.datetime.now(datetime.timezone.utc)
+    messages = []
+    for n in range(count):
+        content = " ".join(rng.choice(("hello", "the", "bridge", "is", "up", "again", "lol")) for _ in range(12))
+        attachments = []
+        if n % 10 == 0:
+            url = ATTACHMENT.format(n)
+            attachments.append(
+                SimpleNamespace(
+                    id=n,
+                    url=url,
+                    proxy_url=url.replace("cdn.discordapp.com", "media.discordapp.net"),
+                    filename="image.png",
+                    size=123456,
+                    width=1280,
+                    height=720,
+                    content_type="image/png",
+                )
+            )
+        reference = None
+        if n and n % 4 == 0:
+            reference = SimpleNamespace(message_id=10**18 + n - 1, cached_message=None, channel_id=1)
+        messages.append(
+            SimpleNamespace(
+                id=10**18 + n,
+                author=rng.choice(members),
+                content=content,
+                clean_content=content,
+                created_at=created_at,
+                attachments=attachments,
+                reference=reference,
+            )
+        )
+    return messages
+
+
+def bench(name: str, make_encoder, messages: list, rounds: int = 3) -> tuple[int, float]:
+    """Runs every message through the whole path, `rounds` times with cold caches, and reports the fastest round."""
+    best = float("inf")
+    for _ in range(rounds):
+        authors, payloads, encode = AuthorCache(), PayloadCache(fetch=False), make_encoder()
+        start = time.perf_counter()
+        size = 0
+        for seq, message in enumerate(messages, 1):
+            event = generate_payload(message, authors, payloads=payloads).to_event()
+            dumps(event)  # written to the queue
+            size += sum(len(frame.encode()) for frame in encode(seq, event))
+        best = min(best, time.perf_counter() - start)
+    print(
+        f"{name:>8}: {size / len(messages):8.1f} bytes/event, {best / len(messages) * 1e6:6.2f} us/event "
+        f"({size} bytes total)"
+    )
+    return size, best
+
+
+def json_frames():
+    return lambda seq, event: [dumps({**event, "seq": seq})]
+
+
+def compact_frames():
+    encoder = CompactEncoder()
+    return lambda seq, event: [dumps(record) for record in encoder.encode(seq, event)]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    messages = make_messages(count)
+    json_size, json_time = bench("json", json_frames, messages)
+    compact_size, compact_time = bench("compact", compact_frames, messages)
+    print(f"compact is {compact_size / json_size:.1%} of the size and {compact_time / json_time:.1%} of the time.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Compares read and write throughput of the stock `databases` SQLite backend ("stock": a new connection per query,
+default pragmas) with the tuned engine used by utils.db ("tuned": WAL, a writer and a pool of readers).
+
+Each workload runs `tasks` concurrent tasks: "read" looks rows up by primary key (like ban checks and bind lookups),
+"write" inserts rows, and "mixed" does one insert for every nine lookups.
+
+Usage: python -m benchmarks.sqlite_engine [operations] [tasks]
+"""
+import asyncio
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import orm
+from databases import Database
+
+from utils.sqlite_engine import TunedDatabase
+
+
+def make_model(database: Database):
+    models = orm.ModelRegistry(database)
+
+    class Entry(orm.Model):
+        tablename = "entries"
+        registry = models
+        fields = {
+            "entry_id": orm.Integer(primary_key=True),
+            "user_id": orm.BigInteger(),
+            "reason": orm.String(max_length=1024),
+        }
+
+    return models, Entry
+
+
+async def run(name: str, database: Database, operations: int, tasks: int):
+    registry, Entry = make_model(database)
+    await registry.create_all()
+
+    async def seed():
+        for n in range(1000):
+            await Entry.objects.create(user_id=n, reason="seed")
+
+    # `databases` gives each task its own connection, but tasks inherit their parent's (and queries on one
+    # connection run one at a time), so seeding in the parent would serialise every worker.
+    await asyncio.create_task(seed())
+    rng = random.Random(0)
+
+    async def read():
+        await Entry.objects.get(entry_id=rng.randint(1, 1000))
+
+    async def write():
+        await Entry.objects.create(user_id=rng.getrandbits(63), reason="x" * 64)
+
+    async def mixed():
+        await (write() if rng.random() < 0.1 else read())
+
+    for workload, operation in (("read", read), ("write", write), ("mixed", mixed)):
+        remaining = operations
+
+        async def worker():
+            nonlocal remaining
+            while remaining > 0:
+                remaining -= 1
+                await operation()
+
+        start = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(tasks)))
+        elapsed = time.perf_counter() - start
+        print(f"{name:>6} {workload:>6}: {operations / elapsed:9.1f} ops/s ({elapsed * 1000 / operations:.3f} ms/op)")
+    if isinstance(database, TunedDatabase):
+        await database.engine.close()
+
+
+def main():
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    tasks = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    with tempfile.TemporaryDirectory() as directory:
+        for name, database_class in (("stock", Database), ("tuned", TunedDatabase)):
+            path = Path(directory) / (name + ".db")
+            asyncio.run(run(name, database_class("sqlite:///" + str(path)), operations, tasks))
+
+
+if __name__ == "__main__":
+    main()
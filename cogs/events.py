@@ -1,4 +1,5 @@
 import asyncio
+import collections
 import hashlib
 import inspect
 import io
@@ -17,11 +18,13 @@ from typing import Any, Dict, Optional, Tuple
 
 import discord
 import httpx
-import pydantic
 from bs4 import BeautifulSoup
 from discord.ext import commands, pages, tasks
 
 from config import guilds
+from utils.bridge import BridgeQueue, EditCoalescer
+from utils.bridge_payload import AuthorCache, MessagePayload, PayloadCache, generate_payload
+from utils.mirror import BRIDGE_MIRROR_URL, AttachmentMirror
 
 try:
     from config import dev
@@ -47,28 +50,6 @@ LTR = "\N{black rightwards arrow}\U0000fe0f"
 RTL = "\N{leftwards black arrow}\U0000fe0f"
 
 
-class MessagePayload(pydantic.BaseModel):
-    class MessageAttachmentPayload(pydantic.BaseModel):
-        url: str
-        proxy_url: str
-        filename: str
-        size: int
-        width: Optional[int] = None
-        height: Optional[int] = None
-        content_type: str
-
-    event_type: str = "create"
-    message_id: int
-    author: str
-    is_automated: bool = False
-    avatar: str
-    content: str
-    clean_content: str
-    at: float
-    attachments: list[MessageAttachmentPayload] = []
-    reply_to: Optional["MessagePayload"] = None
-
-
 async def _dc(client: discord.VoiceClient | None):
     if client is None:
         return
@@ -85,14 +66,36 @@ class Events(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.http = httpx.AsyncClient()
-        if not hasattr(self.bot, "bridge_queue") or self.bot.bridge_queue.empty():
-            self.bot.bridge_queue = asyncio.Queue()
+        if not hasattr(self.bot, "bridge_queue"):
+            self.bot.bridge_queue = BridgeQueue()
+        if not hasattr(self.bot, "attachment_mirror"):
+            self.bot.attachment_mirror = AttachmentMirror() if BRIDGE_MIRROR_URL else None
         self.fetch_discord_atom_feed.start()
         self.bridge_health = False
+        self.bridge_authors = AuthorCache()
+        self.bridge_payloads = PayloadCache()
+        # Also flushed by the bot when it shuts down (see Bot.close), not only when the cog is unloaded.
+        self.bridge_edits = self.bot.bridge_edits = EditCoalescer(self.bot.bridge_queue)
+        # Held while a channel's bridge event is built and queued. Handlers take it before awaiting anything, so
+        # events are queued in the order discord sent them even when a reply has to be fetched first.
+        self.bridge_locks: collections.defaultdict[int, asyncio.Lock] = collections.defaultdict(asyncio.Lock)
         self.log = logging.getLogger("jimmy.cogs.events")
 
     def cog_unload(self):
         self.fetch_discord_atom_feed.cancel()
+        self.bridge_edits.flush()
+
+    async def enqueue_bridge_event(self, payload: MessagePayload, rooms: tuple[str | None, ...]):
+        """Queues a bridge event once for each room the message's channel is bridged to."""
+        if payload.event_type == "redact":
+            # No point sending edits of a message that no longer exists.
+            self.bridge_edits.discard(payload.message_id)
+        event = payload.to_event()
+        for room in rooms:
+            if payload.event_type == "edit":
+                self.bridge_edits.add({**event, "room": room})
+            else:
+                await self.bot.bridge_queue.put({**event, "room": room})
 
     @commands.Cog.listener("on_raw_reaction_add")
     async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
@@ -145,40 +148,22 @@ class Events(commands.Cog):
         if not message.guild:
             return
 
-        if message.channel.name == "femboy-hole":
-            def generate_payload(_message: discord.Message) -> MessagePayload:
-                _payload = MessagePayload(
-                    message_id=_message.id,
-                    author=_message.author.display_name,
-                    is_automated=_message.author.bot or _message.author.system,
-                    avatar=_message.author.display_avatar.with_static_format("webp").with_size(512).url,
-                    content=_message.content or "",
-                    clean_content=str(_message.clean_content or ""),
-                    at=_message.created_at.timestamp(),
+        rooms = self.bot.bridge_binds.rooms_for(message.channel.id)
+        # Messages sent by the bot or through a bind's webhook were bridged from matrix, so don't send them back.
+        echo = message.author == self.bot.user or self.bot.bridge_binds.is_bridge_webhook(message.webhook_id)
+        if rooms and not echo:
+            async with self.bridge_locks[message.channel.id]:
+                payload = generate_payload(
+                    message, self.bridge_authors, payloads=self.bridge_payloads, mirror=self.bot.attachment_mirror
                 )
-                for attachment in _message.attachments:
-                    _payload.attachments.append(
-                        MessagePayload.MessageAttachmentPayload(
-                            url=attachment.url,
-                            filename=attachment.filename,
-                            proxy_url=attachment.proxy_url,
-                            size=attachment.size,
-                            width=attachment.width,
-                            height=attachment.height,
-                            content_type=attachment.content_type,
+                reference = message.reference
+                if payload.reply_to is None and reference and reference.message_id:
+                    if reference.channel_id == message.channel.id:
+                        payload.reply_to = await self.bridge_payloads.fetch(
+                            message.channel, reference.message_id, self.bridge_authors
                         )
-                    )
-                if _message.reference is not None and _message.reference.cached_message:
-                    try:
-                        _payload.reply_to = generate_payload(_message.reference.cached_message)
-                    except RecursionError:
-                        _payload.reply_to = None
-                        logging.warning("Failed to generate reply payload for message %s", _message.id, exc_info=True)
-                return _payload
-
-            payload = generate_payload(message)
-            if message.author != self.bot.user and (payload.content or payload.attachments):
-                await self.bot.bridge_queue.put(payload.model_dump())
+                if payload.content or payload.attachments:
+                    await self.enqueue_bridge_event(payload, rooms)
 
         if message.channel.name in ("verify", "timetable") and message.author != self.bot.user:
             if message.channel.permissions_for(message.guild.me).manage_messages:
@@ -217,36 +202,30 @@ class Events(commands.Cog):
     async def on_message_edit(self, before: discord.Message, after: discord.Message):
         if before.author.bot or before.author.system:
             return
-        if before.channel.name == "femboy-hole":
+        rooms = self.bot.bridge_binds.rooms_for(before.channel.id)
+        if rooms:
             if before.content != after.content:
-                _payload = MessagePayload(
-                    message_id=before.id,
-                    author=after.author.display_name,
-                    is_automated=after.author.bot or after.author.system,
-                    avatar=after.author.display_avatar.with_static_format("webp").with_size(512).url,
-                    content=after.content or "",
-                    clean_content=str(after.clean_content or ""),
-                    at=(after.edited_at or after.created_at).timestamp(),
-                    event_type="edit"
-                )
-                await self.bot.bridge_queue.put(_payload.model_dump())
+                async with self.bridge_locks[before.channel.id]:
+                    _payload = generate_payload(
+                        after,
+                        self.bridge_authors,
+                        event_type="edit",
+                        at=(after.edited_at or after.created_at).timestamp(),
+                        payloads=self.bridge_payloads,
+                    )
+                    await self.enqueue_bridge_event(_payload, rooms)
 
     @commands.Cog.listener("on_message_delete")
     async def on_message_delete(self, message: discord.Message):
         if message.author.bot or message.author.system:
             return
-        if message.channel.name == "femboy-hole":
-            _payload = MessagePayload(
-                message_id=message.id,
-                author=message.author.display_name,
-                is_automated=message.author.bot or message.author.system,
-                avatar=message.author.display_avatar.with_static_format("webp").with_size(512).url,
-                content=message.content or "",
-                clean_content=str(message.clean_content or ""),
-                at=message.created_at.timestamp(),
-                event_type="redact"
-            )
-            await self.bot.bridge_queue.put(_payload.model_dump())
+        rooms = self.bot.bridge_binds.rooms_for(message.channel.id)
+        if rooms:
+            async with self.bridge_locks[message.channel.id]:
+                _payload = generate_payload(
+                    message, self.bridge_authors, event_type="redact", payloads=self.bridge_payloads
+                )
+                await self.enqueue_bridge_event(_payload, rooms)
 
     @tasks.loop(minutes=10)
     async def fetch_discord_atom_feed(self):
@@ -0,0 +1,75 @@
+import logging
+
+import discord
+from discord.ext import commands
+
+from utils.uptime import UPTIME_TARGETS, UptimeChecker, UptimeTarget
+
+WINDOWS = {"1 hour": 3600, "24 hours": 86400, "7 days": 7 * 86400, "30 days": 30 * 86400}
+
+
+def _ms(value) -> str:
+    return "-" if value is None else f"{value:,} ms"
+
+
+class UptimeCog(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        self.log = logging.getLogger("jimmy.cogs.uptime")
+        self.checker = UptimeChecker([UptimeTarget.parse(entry) for entry in UPTIME_TARGETS])
+        self.bot.uptime_checker = self.checker
+        self._task = self.bot.loop.create_task(self.checker.run())
+
+    def cog_unload(self):
+        self._task.cancel()
+        self.bot.uptime_checker = None
+
+    @commands.slash_command(name="uptime")
+    @commands.cooldown(1, 10, commands.BucketType.user)
+    async def uptime(
+        self,
+        ctx: discord.ApplicationContext,
+        window: discord.Option(str, description="How far back to look", choices=list(WINDOWS), default="24 hours"),
+        target: discord.Option(
+            str,
+            description="Only show this target",
+            autocomplete=discord.utils.basic_autocomplete(lambda ctx: list(ctx.bot.uptime_checker.targets)),
+            default=None,
+        ),
+    ):
+        """Shows availability and response times of monitored services"""
+        await ctx.defer()
+        stats = await self.checker.stats(WINDOWS[window])
+        if target is not None:
+            if target not in stats:
+                return await ctx.respond(f"\N{cross mark} Unknown target {discord.utils.escape_markdown(target)!r}.")
+            stats = {target: stats[target]}
+
+        embed = discord.Embed(title=f"Uptime over the last {window}", colour=discord.Colour.blurple())
+        for target_id, result in list(stats.items())[:25]:
+            emoji = {True: "\N{large green circle}", False: "\N{large red circle}"}.get(
+                result.get("is_up"), "\N{white circle}"
+            )
+            if result["checks"]:
+                value = (
+                    f"**Availability:** {result['availability']:.2%} of {result['checks']:,} checks\n"
+                    f"**Response time:** p50 {_ms(result['p50'])} \N{middle dot} p95 {_ms(result['p95'])} "
+                    f"\N{middle dot} p99 {_ms(result['p99'])}"
+                )
+            else:
+                value = "No checks yet."
+            if result.get("last_checked"):
+                value += f"\nLast checked <t:{int(result['last_checked'])}:R>"
+                if result.get("notes"):
+                    value += f": {discord.utils.escape_markdown(result['notes'][:200])}"
+            embed.add_field(name=f"{emoji} {target_id}", value=value, inline=False)
+        embed.set_footer(text=f"{len(stats)} target(s)")
+        embed.timestamp = discord.utils.utcnow()
+        await ctx.respond(embed=embed)
+
+
+def setup(bot):
+    if UPTIME_TARGETS:
+        bot.add_cog(UptimeCog(bot))
+    else:
+        logging.getLogger("jimmy.cogs.uptime").info("UPTIME_TARGETS not set, not loading uptime cog")
@@ -41,6 +41,11 @@ lupupa_warning = True
 OAUTH_ID = None  # The user ID of your bot. Must be a string.
 OAUTH_SECRET = "my_secret"  # The oauth secret.
 OAUTH_REDIRECT_URI = "http://127.0.0.1:3762/auth"  # The full redirect URI registered on your oauth page.
+# Pending OAuth logins expire after this many seconds, and at most OAUTH_STATE_MAX are kept at once.
+# OAUTH_STATE_TTL = 300
+# OAUTH_STATE_MAX = 10_000
+# If set, pending OAuth logins are kept in redis rather than in memory, so several web workers can share them.
+# REDIS_URL = "redis://localhost:6379/0"
 
 # Here you can change where the web server points.
 # You should not change this as you should only permit access to the web server via web proxy.
@@ -53,6 +58,85 @@ WEB_SERVER = True  # change this to False to disable it
 # Or change uvicorn settings (see: https://www.uvicorn.org/settings/)
 # Note that passing `host` or `port` will raise an error, as those are configured above.
 UVICORN_CONFIG = {"log_level": "error", "access_log": False, "lifespan": "off"}
+# If set, the web server runs as this many worker processes alongside the bot instead of inside it, talking to the
+# bot over a unix socket at IPC_PATH (defaults to `jimmy.sock` next to the main database).
+# With more than one worker, REDIS_URL should also be set so that pending OAuth logins are shared between them.
+# WEB_WORKERS = 0
+# IPC_PATH = "/data/jimmy.sock"
+# How many requests to discord's OAuth API and ip-api the web server may have in flight at once.
+# WEB_OUTBOUND_CONCURRENCY = 8
+# IP geolocation lookups made when logging in are cached in the database for this many seconds, keeping at most
+# GEOIP_CACHE_SIZE addresses.
+# GEOIP_CACHE_TTL = 7 * 86400
+# GEOIP_CACHE_SIZE = 10_000
+
+# The discord channel bridged to the bridge consumer's default room. Other channels are bridged by binding them
+# to a room via the web API.
+# BRIDGE_CHANNEL = 1032974266527907901
+
+# Consecutive messages from the same matrix user that arrive within this many seconds are merged into one.
+# BRIDGE_COALESCE_WINDOW = 0.75
+
+# Bridged edits are held back for this many seconds, so that only the latest of a burst of edits is sent.
+# BRIDGE_EDIT_WINDOW = 2.0
+
+# How many recently bridged messages are remembered to give replies context, and whether replies to messages
+# that have been forgotten should be fetched from discord (rate-limited).
+# BRIDGE_PAYLOAD_CACHE_SIZE = 2048
+# BRIDGE_FETCH_REPLIES = True
+# How many messages GET /bridge/backfill fetches ahead of what it has sent to the client.
+# BRIDGE_BACKFILL_PREFETCH = 200
+
+# Where bridged messages are stored until the bridge consumer acknowledges them.
+# Defaults to `bridge.db` next to the main database.
+# BRIDGE_QUEUE_PATH = "/data/bridge.db"
+# How much of the bridge queue (in bytes) is also kept in memory. Anything older is read back from disk.
+# BRIDGE_QUEUE_MEMORY = 8 * 1024 * 1024
+# The most events the bridge queue will hold for consumers before dropping the oldest ones.
+# BRIDGE_QUEUE_MAX_EVENTS = 100_000
+# Consumers that haven't connected for this many seconds are forgotten, and stop holding events back for them.
+# BRIDGE_CONSUMER_EXPIRY = 7 * 86400
+# How many events each connected bridge consumer may have buffered before it is considered lagging.
+# Lagging consumers catch up from the queue on disk instead, so they never hold up other consumers.
+# BRIDGE_BUFFER_SIZE = 1000
+
+# Bridged attachments are mirrored into a local store, so they stay available after discord's CDN links expire.
+# The store lives in `mirror/` next to the main database, and the least recently used files are deleted once it
+# grows past BRIDGE_MIRROR_SIZE bytes. Mirrored files are served at BRIDGE_MIRROR_URL, which defaults to
+# `/bridge/media` on the web server (derived from OAUTH_REDIRECT_URI). Mirroring is disabled if neither is set.
+# BRIDGE_MIRROR_PATH = "/data/mirror"
+# BRIDGE_MIRROR_SIZE = 2 * 1024 ** 3
+# BRIDGE_MIRROR_URL = "https://example.com/bridge/media"
+
+# The largest file (in bytes) that will be accepted from matrix. Files over the channel's upload limit are
+# recompressed or split into parts before they're sent to discord.
+# BRIDGE_MEDIA_MAX_SIZE = 100 * 1024 * 1024
+
+# The main database is opened in WAL mode, with one connection for writes and up to DB_READERS read-only
+# connections for reads. DB_PRAGMAS overrides the SQLite pragmas every connection is opened with (see
+# utils/sqlite_engine.py for the defaults).
+# DB_READERS = 4
+# DB_PRAGMAS = {"synchronous": "full", "mmap_size": 0}
+# Lookups of students, bans and access tokens are cached for MODEL_CACHE_TTL seconds (access tokens for at most 10),
+# keeping up to MODEL_CACHE_SIZE lookups per model. Writes made by the bot clear the cache straight away; writes
+# made by other processes only show up once the cached entry expires. Set MODEL_CACHE_TTL to 0 to disable caching.
+# MODEL_CACHE_TTL = 60
+# MODEL_CACHE_SIZE = 1024
+
+# Services to monitor for /uptime, as http(s):// or tcp://host:port URLs, or dicts with a "url" and optionally an
+# "id", "interval" and "timeout" (in seconds). Each is probed every UPTIME_INTERVAL seconds, give or take
+# UPTIME_JITTER (a fraction of the interval). Results are written to the database in batches, every
+# UPTIME_FLUSH_INTERVAL seconds or once UPTIME_BATCH_SIZE are waiting.
+# UPTIME_TARGETS = ["https://example.com", {"id": "minecraft", "url": "tcp://example.com:25565", "interval": 30}]
+# UPTIME_INTERVAL = 60
+# UPTIME_TIMEOUT = 10
+# UPTIME_JITTER = 0.1
+# UPTIME_FLUSH_INTERVAL = 15
+# UPTIME_BATCH_SIZE = 100
+# Checks are also rolled up per minute, hour and day. Raw checks are deleted after UPTIME_RAW_RETENTION seconds,
+# and rollups after the retention given for their resolution (None keeps them forever).
+# UPTIME_RAW_RETENTION = 2 * 86400
+# UPTIME_ROLLUP_RETENTION = {60: 7 * 86400, 3600: 90 * 86400, 86400: None}
 
 # Only change this if you want to test changes to the bot without sending too much traffic to discord.
 # Connect modes:
@@ -2,6 +2,7 @@ import asyncio
 import logging
 import os
 import signal
+import subprocess
 import sys
 import textwrap
 from datetime import datetime, timedelta, timezone
@@ -141,7 +142,17 @@ if __name__ == "__main__":
     bot.log.info("Starting...")
     bot.started_at = discord.utils.utcnow()
 
-    if getattr(config, "WEB_SERVER", True):
+    if getattr(config, "WEB_SERVER", True) and getattr(config, "WEB_WORKERS", 0):
+        bot.log.info("Web server is enabled, starting %d worker process(es).", config.WEB_WORKERS)
+        from utils.ipc import IPCServer
+
+        ipc = IPCServer(bot)
+        bot.loop.run_until_complete(ipc.start())
+        bot.web = {
+            "ipc": ipc,
+            "process": subprocess.Popen([sys.executable, "-m", "web"], env={**os.environ, "JIMMY_IPC_PATH": ipc.path}),
+        }
+    elif getattr(config, "WEB_SERVER", True):
         bot.log.info("Web server is enabled (WEB_SERVER=True in config.py), initialising.")
         import uvicorn
 
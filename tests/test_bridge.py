@@ -0,0 +1,306 @@
+import asyncio
+import sqlite3
+import time
+import uuid
+
+import httpx
+
+from utils.bridge import BridgeBindCache, BridgeQueue, BridgeStats, EditCoalescer
+from utils.db import BridgeBind
+from utils.mirror import AttachmentMirror
+
+
+def test_sequence_numbers_are_monotonic(tmp_path):
+    queue = BridgeQueue(tmp_path / "bridge.db")
+    assert [queue.put_nowait({"n": n}) for n in range(3)] == [1, 2, 3]
+    queue.ack("default", 3)
+    # Pruning every event must not reset the sequence
+    assert queue.read(0) == []
+    assert queue.put_nowait({"n": 3}) == 4
+
+
+def test_resume_from_cursor_after_restart(tmp_path):
+    queue = BridgeQueue(tmp_path / "bridge.db")
+    for n in range(5):
+        queue.put_nowait({"n": n})
+    queue.ack("default", 2)
+    queue.close()
+
+    queue = BridgeQueue(tmp_path / "bridge.db")
+    assert queue.head == 5
+    assert queue.cursor() == 2
+    assert [event.payload["n"] for event in queue.read(queue.cursor())] == [2, 3, 4]
+
+
+def test_events_are_kept_until_every_consumer_acks(tmp_path):
+    queue = BridgeQueue(tmp_path / "bridge.db")
+    queue.put_nowait({"n": 0})
+    queue.ack("archiver", 0)
+    queue.ack("default", 1)
+    assert len(queue.read(0)) == 1
+    queue.ack("archiver", 1)
+    assert queue.read(0) == []
+
+
+def test_writes_are_batched_off_the_event_loop(tmp_path):
+    path = tmp_path / "bridge.db"
+    queue = BridgeQueue(path, memory_limit=0)
+    disk = sqlite3.connect(path)
+
+    async def main():
+        for n in range(3):
+            queue.put_nowait({"n": n})
+        queue.ack("default", 1)
+        # Nothing has been written yet, but the events and cursor are already visible
+        assert disk.execute("SELECT COUNT(*) FROM events").fetchone() == (0,)
+        assert [event.seq for event in queue.read(0)] == [2, 3]
+        assert queue.cursor() == 1
+        await asyncio.sleep(0.1)
+        assert disk.execute("SELECT seq FROM events").fetchall() == [(2,), (3,)]
+        assert disk.execute("SELECT consumer, seq FROM cursors").fetchall() == [("default", 1)]
+        queue.put_nowait({"n": 3})
+
+    asyncio.run(main())
+    disk.close()
+    queue.close()
+    queue = BridgeQueue(path)
+    assert (queue.head, queue.cursor()) == (4, 1)
+    assert [event.seq for event in queue.read(1)] == [2, 3, 4]
+
+
+def test_idle_consumers_expire(tmp_path):
+    queue = BridgeQueue(tmp_path / "bridge.db", consumer_expiry=60)
+    queue.put_nowait({"n": 0})
+    queue.ack("abandoned", 0)
+    subscription = queue.subscribe("connected", 0)
+    queue.ack("default", 1)
+    assert len(queue.read(0)) == 1
+    # Connected consumers never expire, however long ago they were last seen
+    assert queue.expire(time.time() + 120) == ["abandoned", "default"]
+    assert len(queue.read(0)) == 1
+    subscription.close()
+    queue.ack("connected", 1)
+    assert queue.read(0) == []
+
+
+def test_get_waits_for_new_events(tmp_path):
+    queue = BridgeQueue(tmp_path / "bridge.db")
+
+    async def main():
+        assert await queue.get(0, timeout=0.01) == []
+        waiter = asyncio.create_task(queue.get(0, timeout=1))
+        await asyncio.sleep(0)
+        await queue.put({"n": 0})
+        return await waiter
+
+    (event,) = asyncio.run(main())
+    assert (event.seq, event.payload) == (1, {"n": 0})
+
+
+def test_stats_track_batches_and_latency(tmp_path):
+    queue = BridgeQueue(tmp_path / "bridge.db")
+    for n in range(3):
+        queue.put_nowait({"n": n})
+    stats = BridgeStats()
+    stats.record(queue.read(0, limit=2))
+    stats.record(queue.read(2))
+    snapshot = stats.snapshot()
+    assert snapshot["frames"] == 2
+    assert snapshot["events"] == 3
+    assert snapshot["max_batch"] == 2
+    assert snapshot["avg_batch"] == 1.5
+    assert snapshot["max_latency_ms"] >= 0
+
+
+def test_subscribers_each_receive_every_event(tmp_path):
+    queue = BridgeQueue(tmp_path / "bridge.db")
+    first, second = queue.subscribe("first"), queue.subscribe("second")
+
+    async def main():
+        await queue.put({"n": 0})
+        await queue.put({"n": 1})
+        return await first.get(timeout=1), await second.get(limit=1, timeout=1)
+
+    first_events, second_events = asyncio.run(main())
+    assert [event.seq for event in first_events] == [1, 2]
+    assert [event.seq for event in second_events] == [1]
+    assert (first.lag, second.lag) == (0, 1)
+
+
+def test_slow_subscriber_falls_back_to_log(tmp_path):
+    queue = BridgeQueue(tmp_path / "bridge.db")
+    fast, slow = queue.subscribe("fast"), queue.subscribe("slow", maxsize=2)
+    for n in range(5):
+        queue.put_nowait({"n": n})
+    assert slow.lagging and slow.overflows == 1
+    assert len(fast.buffer) == 5
+
+    async def main():
+        return await slow.get(limit=3), await slow.get(limit=3)
+
+    head, tail = asyncio.run(main())
+    assert [event.seq for event in head + tail] == [1, 2, 3, 4, 5]
+    assert not slow.lagging
+
+
+def test_bind_cache_indexes_both_directions():
+    cache = BridgeBindCache()
+    first = BridgeBind(entry_id=uuid.uuid4(), matrix_id="!first:example.org", discord_id=1, webhook=None)
+    second = BridgeBind(entry_id=uuid.uuid4(), matrix_id="!second:example.org", discord_id=1, webhook=None)
+    cache._add(first)
+    cache._add(second)
+    assert cache.get("!first:example.org") is first
+    assert cache.get_by_discord(1) == [first, second]
+
+    cache._remove(first)
+    assert cache.get("!first:example.org") is None
+    assert cache.get_by_discord(1) == [second]
+    cache._remove(second)
+    assert cache.by_discord == {}
+
+
+def test_bind_cache_routes_channels_to_rooms():
+    cache = BridgeBindCache(default_channel=10)
+    assert cache.rooms_for(10) == (None,)
+    assert cache.rooms_for(20) == ()
+
+    room = BridgeBind(entry_id=uuid.uuid4(), matrix_id="!room:example.org", discord_id=20, webhook=None)
+    user = BridgeBind(entry_id=uuid.uuid4(), matrix_id="@user:example.org", discord_id=30, webhook=None)
+    default = BridgeBind(entry_id=uuid.uuid4(), matrix_id="!default:example.org", discord_id=10, webhook=None)
+    for bind in (room, user, default):
+        cache._add(bind)
+    assert cache.rooms_for(20) == ("!room:example.org",)
+    assert cache.rooms_for(30) == ()
+    assert cache.rooms_for(10) == ("!default:example.org",)
+
+    cache._remove(default)
+    assert cache.rooms_for(10) == (None,)
+
+
+def test_bind_cache_recognises_bridge_webhooks():
+    cache = BridgeBindCache()
+    url = "https://discord.com/api/webhooks/1234/token"
+    first = BridgeBind(entry_id=uuid.uuid4(), matrix_id="!first:example.org", discord_id=1, webhook=url)
+    second = BridgeBind(entry_id=uuid.uuid4(), matrix_id="!second:example.org", discord_id=2, webhook=url)
+    cache._add(first)
+    cache._add(second)
+    assert cache.is_bridge_webhook(1234)
+    assert not cache.is_bridge_webhook(None)
+    cache._remove(first)
+    assert cache.is_bridge_webhook(1234)
+    cache._remove(second)
+    assert not cache.is_bridge_webhook(1234)
+
+
+def test_events_over_memory_limit_spill_to_disk(tmp_path):
+    queue = BridgeQueue(tmp_path / "bridge.db", memory_limit=40)
+    for n in range(5):
+        queue.put_nowait({"n": n})  # 8 bytes each
+    assert queue.snapshot()["memory_events"] == 5
+    queue.put_nowait({"n": 5})
+    assert queue.spilled == 1
+    assert [event.seq for event in queue.read(0)] == [1, 2, 3, 4, 5, 6]
+    assert queue.drained == 6
+    assert [event.seq for event in queue.read(1)] == [2, 3, 4, 5, 6]
+    assert queue.drained == 6
+
+
+def test_oldest_events_dropped_when_full(tmp_path):
+    queue = BridgeQueue(tmp_path / "bridge.db", max_events=3)
+    for n in range(5):
+        queue.put_nowait({"n": n})
+    assert queue.dropped == 2
+    assert [event.seq for event in queue.read(0)] == [3, 4, 5]
+
+    # Larger logs are trimmed a tenth at a time
+    queue = BridgeQueue(tmp_path / "batched.db", max_events=20)
+    for n in range(21):
+        queue.put_nowait({"n": n})
+    assert queue.dropped == 0
+    queue.put_nowait({"n": 21})
+    assert queue.dropped == 2
+    assert queue.read(0)[0].seq == 3
+
+
+def test_edit_bursts_are_coalesced(tmp_path):
+    queue = BridgeQueue(tmp_path / "bridge.db")
+
+    async def main():
+        edits = EditCoalescer(queue, window=0.05)
+        for content in ("helo", "hello", "hello!"):
+            edits.add({"message_id": 1, "event_type": "edit", "content": content})
+        edits.add({"message_id": 2, "event_type": "edit", "content": "bye"})
+        edits.discard(2)
+        await asyncio.sleep(0.1)
+        return edits
+
+    edits = asyncio.run(main())
+    assert [event.payload["content"] for event in queue.read(0)] == ["hello!"]
+    assert (edits.coalesced, edits.cancelled) == (2, 1)
+
+
+def test_mirror_stores_attachments_by_content(tmp_path):
+    async def main():
+        mirror = AttachmentMirror(tmp_path, max_size=10, base_url="https://example.com/media")
+        await mirror.http.aclose()
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, content=b"abcdef"))
+        mirror.http = httpx.AsyncClient(transport=transport)
+        assert mirror.register(1, "https://cdn/1", "a b.png") == "https://example.com/media/1/a%20b.png"
+        mirror.register(2, "https://cdn/2", "copy.png")
+        first, second = await mirror.get(1), await mirror.get(2)
+        # The same content is only stored once, and only counted once against the size limit
+        assert first.path == second.path and first.path.read_bytes() == b"abcdef"
+        assert mirror.total_size == 6
+        await mirror.close()
+
+    asyncio.run(main())
+
+
+def test_mirror_downloads_lazily_and_forgets_evicted_attachments(tmp_path):
+    requested = []
+
+    def respond(request):
+        requested.append(str(request.url))
+        return httpx.Response(200, content=str(request.url).encode()[-6:])
+
+    async def main():
+        mirror = AttachmentMirror(tmp_path, max_size=10, base_url="https://example.com/media")
+        await mirror.http.aclose()
+        mirror.http = httpx.AsyncClient(transport=httpx.MockTransport(respond))
+        mirror.register(1, "https://cdn/aaaaaa", "a.png", lazy=True)
+        mirror.register(2, "https://cdn/bbbbbb", "b.png", lazy=True)
+        await asyncio.sleep(0.1)
+        assert requested == []
+        assert (await mirror.get(1)).path.read_bytes() == b"aaaaaa"
+        # Storing the second file evicts the first, and the first's index entry with it
+        assert (await mirror.get(2)).path.read_bytes() == b"bbbbbb"
+        assert mirror.evicted == 1
+        assert await mirror.get(1) is None
+        assert requested == ["https://cdn/aaaaaa", "https://cdn/bbbbbb"]
+        await mirror.close()
+
+    asyncio.run(main())
+
+
+def test_mirror_size_is_shared_between_processes(tmp_path):
+    def respond(request):
+        return httpx.Response(200, content=str(request.url).encode()[-6:])
+
+    async def main():
+        # Two mirrors on the same store, as the bot and a web worker would have
+        mirrors = [AttachmentMirror(tmp_path, max_size=10, base_url="https://example.com/media") for _ in range(2)]
+        for mirror in mirrors:
+            await mirror.http.aclose()
+            mirror.http = httpx.AsyncClient(transport=httpx.MockTransport(respond))
+        bot, worker = mirrors
+        bot.register(1, "https://cdn/aaaaaa", "a.png", lazy=True)
+        worker.register(2, "https://cdn/bbbbbb", "b.png", lazy=True)
+        await bot.get(1)
+        # Neither process downloaded more than max_size itself, but together they did
+        await worker.get(2)
+        assert worker.evicted == 1 and worker.total_size == 6
+        assert await bot.get(1) is None
+        for mirror in mirrors:
+            await mirror.close()
+
+    asyncio.run(main())
@@ -0,0 +1,37 @@
+import asyncio
+import io
+from pathlib import Path
+
+import PIL.Image
+
+from utils.bridge_media import MediaFile, fit_to_limit, group_files
+
+
+def _media(tmp_path: Path, name: str, data: bytes, content_type: str) -> MediaFile:
+    path = tmp_path / name
+    path.write_bytes(data)
+    return MediaFile(path, name, len(data), content_type)
+
+
+def test_large_files_are_split_into_parts(tmp_path):
+    original = _media(tmp_path, "archive.zip", bytes(range(256)) * 10, "application/zip")
+    parts = asyncio.run(fit_to_limit(original, 1000))
+    assert [(part.filename, part.size) for part in parts] == [
+        ("archive.zip.001", 1000), ("archive.zip.002", 1000), ("archive.zip.003", 560)
+    ]
+    assert b"".join(part.path.read_bytes() for part in parts) == bytes(range(256)) * 10
+    assert not original.path.exists()
+
+
+def test_large_images_are_recompressed(tmp_path):
+    buffer = io.BytesIO()
+    PIL.Image.effect_noise((512, 512), 64).convert("RGB").save(buffer, "BMP")
+    original = _media(tmp_path, "photo.bmp", buffer.getvalue(), "image/bmp")
+    (fitted,) = asyncio.run(fit_to_limit(original, 100_000))
+    assert fitted.filename == "photo.webp" and fitted.content_type == "image/webp"
+    assert fitted.size <= 100_000
+
+
+def test_files_are_grouped_within_the_limit(tmp_path):
+    files = [_media(tmp_path, f"{n}.txt", b"x" * size, "text/plain") for n, size in enumerate((4, 4, 4, 9))]
+    assert [[file.size for file in group] for group in group_files(files, 9)] == [[4, 4], [4], [9]]
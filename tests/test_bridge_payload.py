@@ -0,0 +1,127 @@
+import asyncio
+import datetime
+from types import SimpleNamespace
+
+from utils.bridge_payload import CompactEncoder, MessagePayload, PayloadCache, dumps, history_payloads, loads
+
+
+def make_payload(message_id: int, author_id: int = 1, **kwargs) -> dict:
+    kwargs.setdefault("content", "hello")
+    kwargs.setdefault("clean_content", kwargs["content"])
+    return MessagePayload(
+        message_id=message_id,
+        author="user%d" % author_id,
+        author_id=author_id,
+        avatar="https://example.org/%d.webp" % author_id,
+        at=0.0,
+        **kwargs,
+    ).model_dump()
+
+
+def test_authors_are_sent_once_per_connection():
+    encoder = CompactEncoder()
+    first = encoder.encode(1, make_payload(10))
+    second = encoder.encode(2, make_payload(11))
+    assert [record["k"] for record in first] == ["author", "create"]
+    assert [record["k"] for record in second] == ["create"]
+    assert second[0] == {"k": "create", "seq": 2, "id": 11, "at": 0.0, "a": 1, "c": "hello"}
+    # A fresh connection gets the author again
+    assert CompactEncoder().encode(2, make_payload(11))[0]["k"] == "author"
+
+
+def test_changed_author_is_resent():
+    encoder = CompactEncoder()
+    encoder.encode(1, make_payload(10))
+    payload = make_payload(11)
+    payload["author"] = "renamed"
+    author, _ = encoder.encode(2, payload)
+    assert author["name"] == "renamed"
+
+
+def test_replies_refer_to_message_id():
+    reply_to = MessagePayload(**make_payload(10))
+    (event,) = CompactEncoder().encode(2, make_payload(11, author_id=2, reply_to=reply_to))[1:]
+    assert event["r"] == 10
+
+
+def test_queued_event_keeps_one_level_of_reply():
+    first = MessagePayload(**make_payload(10))
+    second = MessagePayload(**make_payload(11, reply_to=first))
+    event = MessagePayload(**make_payload(12, reply_to=second)).to_event()
+    assert event["reply_to"]["message_id"] == 11
+    assert "reply_to" not in event["reply_to"]
+    assert event["attachments"] == [] and event["room"] is None
+
+
+def test_round_trip():
+    payload = make_payload(10)
+    assert loads(dumps(payload)) == payload
+
+
+def test_payload_cache_evicts_least_recently_used():
+    cache = PayloadCache(maxsize=2, fetch=False)
+    for message_id in (1, 2):
+        cache.put(MessagePayload(**make_payload(message_id)))
+    assert cache.get(1) is not None
+    cache.put(MessagePayload(**make_payload(3)))
+    assert cache.get(2) is None
+    assert cache.get(1) is not None
+    assert (cache.hits, cache.misses) == (2, 1)
+
+
+def test_payload_cache_applies_edits_and_redacts():
+    cache = PayloadCache(fetch=False)
+    cache.put(MessagePayload(**make_payload(1)))
+    cache.update(MessagePayload(**make_payload(1, content="edited", event_type="edit")))
+    assert cache.get(1).content == "edited"
+    cache.update(MessagePayload(**make_payload(1, event_type="redact")))
+    assert cache.get(1) is None
+
+
+class FakeAvatar:
+    key = "avatar"
+    url = "https://example.org/avatar.webp"
+
+    def with_static_format(self, _):
+        return self
+
+    def with_size(self, _):
+        return self
+
+
+class FakeChannel:
+    def __init__(self, count: int):
+        author = SimpleNamespace(id=1, display_name="user", display_avatar=FakeAvatar(), bot=False, system=False)
+        created_at = datetime.datetime.now(datetime.timezone.utc)
+        self.messages = [
+            SimpleNamespace(
+                id=n,
+                author=author,
+                content=str(n),
+                clean_content=str(n),
+                created_at=created_at,
+                attachments=[],
+                reference=None,
+            )
+            for n in range(count)
+        ]
+        self.fetched = 0
+
+    async def history(self, *, limit, after, oldest_first):
+        for message in self.messages[after.id + 1:][:limit]:
+            self.fetched += 1
+            yield message
+
+
+def test_history_is_streamed_with_bounded_prefetch():
+    channel = FakeChannel(50)
+
+    async def main():
+        payloads = history_payloads(channel, after=SimpleNamespace(id=9), limit=30, prefetch=5)
+        first = await payloads.__anext__()
+        await asyncio.sleep(0.01)
+        # The producer only runs a few messages ahead of the consumer
+        assert channel.fetched <= 1 + 5 + 1
+        return [first.message_id] + [payload.message_id async for payload in payloads]
+
+    assert asyncio.run(main()) == list(range(10, 40))
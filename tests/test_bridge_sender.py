@@ -0,0 +1,97 @@
+import asyncio
+
+from utils.bridge_media import MediaFile
+from utils.bridge_sender import BridgeSender, ChannelPipeline, OutboundMessage, paginate
+
+
+class FakeChannel:
+    id = 1
+
+    def __init__(self):
+        self.sent = []
+        self.files = []
+
+    async def send(self, content, **kwargs):
+        self.sent.append(content)
+        self.files.extend(file.filename for file in kwargs.get("files") or ())
+
+
+def test_paginate_splits_long_messages():
+    assert paginate("hello\nworld") == ["hello\nworld"]
+    pages = paginate("a" * 1500 + "\n" + "b" * 1500)
+    assert pages == ["a" * 1500, "b" * 1500]
+
+
+def test_consecutive_messages_from_one_sender_are_coalesced():
+    channel = FakeChannel()
+
+    async def main():
+        pipeline = ChannelPipeline(channel, window=0.1)
+        for author, content in (("alice", "hi"), ("alice", "there"), ("bob", "hello")):
+            pipeline.queue.put_nowait(OutboundMessage(author, paginate(content)))
+        await asyncio.sleep(0.5)
+        pipeline.close()
+        return pipeline
+
+    pipeline = asyncio.run(main())
+    assert channel.sent == ["**alice**:\n>>> hi\nthere", "**bob**:\n>>> hello"]
+    assert pipeline.coalesced == 1
+
+
+def test_files_only_message_is_not_coalesced(tmp_path):
+    channel = FakeChannel()
+    path = tmp_path / "upload"
+    path.write_bytes(b"data")
+    media = MediaFile(path, "cat.png", 4, "image/png")
+
+    async def main():
+        pipeline = ChannelPipeline(channel, window=0.1)
+        pipeline.queue.put_nowait(OutboundMessage("alice", paginate("look")))
+        pipeline.queue.put_nowait(OutboundMessage("alice", [], files=[[media]]))
+        await asyncio.sleep(0.5)
+        assert not pipeline.task.done()
+        pipeline.close()
+
+    asyncio.run(main())
+    assert channel.sent == ["**alice**:\n>>> look", None]
+    assert channel.files == ["cat.png"]
+    assert not path.exists()
+
+
+def test_each_webhook_gets_its_own_pipeline():
+    channel = FakeChannel()
+
+    async def main():
+        sender = BridgeSender()
+        default = sender.pipeline(channel)
+        hooked = sender.pipeline(channel, "https://discord.com/api/webhooks/123456789012345678/" + "a" * 68)
+        # Switching webhooks must not cancel the other pipeline (and drop whatever it has queued)
+        assert sender.pipeline(channel) is default
+        assert hooked is not default and not default.task.done()
+        await sender.close()
+
+    asyncio.run(main())
+
+
+def test_failures_are_counted_and_close_sends_what_is_queued():
+    channel = FakeChannel()
+    send = channel.send
+
+    async def flaky_send(content, **kwargs):
+        if "fail" in (content or ""):
+            raise RuntimeError("boom")
+        await send(content, **kwargs)
+
+    channel.send = flaky_send
+
+    async def main():
+        sender = BridgeSender()
+        for author, content in (("alice", "fail"), ("bob", "one"), ("carol", "two")):
+            sender.submit(channel, author, content)
+        await sender.close(timeout=5)
+        return sender.snapshot()
+
+    snapshot = asyncio.run(main())
+    assert channel.sent == ["**bob**:\n>>> one", "**carol**:\n>>> two"]
+    assert (snapshot["sent"], snapshot["failed"], snapshot["queued"]) == (2, 1, 0)
+    assert snapshot["last_error"]["error"] == "RuntimeError('boom')"
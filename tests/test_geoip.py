@@ -0,0 +1,66 @@
+import asyncio
+
+import pytest
+
+from utils import db
+from utils.geoip import GeoIPCache
+from utils.sqlite_engine import TunedDatabase
+
+
+@pytest.fixture
+def database(monkeypatch, tmp_path):
+    database = TunedDatabase("sqlite:///" + str(tmp_path / "main.db"))
+    monkeypatch.setattr(db.registry, "database", database)
+    monkeypatch.setattr(db.IPInfo, "database", database)
+    return database
+
+
+def test_geoip_cache_coalesces_and_expires(database, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("utils.geoip.time.time", lambda: now[0])
+    fetched = []
+
+    async def fetch(ip):
+        fetched.append(ip)
+        await asyncio.sleep(0.05)
+        return {"query": ip, "n": len(fetched)}
+
+    cache = GeoIPCache(fetch, ttl=60, maxsize=10)
+
+    async def main():
+        await db.registry.create_all()
+        # Concurrent lookups of the same IP share one fetch
+        results = await asyncio.gather(*(cache.get("1.1.1.1") for _ in range(3)))
+        assert [result["n"] for result in results] == [1, 1, 1]
+        assert (cache.misses, cache.coalesced) == (1, 2)
+        assert (await cache.get("1.1.1.1"))["n"] == 1
+        assert cache.hits == 1
+        # Once the entry is older than the TTL, it is fetched again
+        now[0] += 61
+        assert (await cache.get("1.1.1.1"))["n"] == 2
+        assert fetched == ["1.1.1.1", "1.1.1.1"]
+        assert await db.IPInfo.objects.count() == 1
+        await database.engine.close()
+
+    asyncio.run(main())
+
+
+def test_geoip_cache_evicts_oldest_entries(database, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr("utils.geoip.time.time", lambda: now[0])
+
+    async def fetch(ip):
+        return {"query": ip}
+
+    cache = GeoIPCache(fetch, ttl=3600, maxsize=2)
+
+    async def main():
+        await db.registry.create_all()
+        for ip in ("1.1.1.1", "2.2.2.2", "3.3.3.3"):
+            await cache.get(ip)
+            now[0] += 1
+        remaining = sorted(entry.ip for entry in await db.IPInfo.objects.all())
+        await database.engine.close()
+        return remaining
+
+    assert asyncio.run(main()) == ["2.2.2.2", "3.3.3.3"]
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import stat
+import types
+
+import discord
+
+from utils.bridge import BridgeBindCache, BridgeQueue
+from utils.ipc import BotProxy, IPCServer
+
+
+def test_proxy_mirrors_bot_state_and_streams_events(tmp_path):
+    queue = BridgeQueue(tmp_path / "bridge.db")
+    bot = types.SimpleNamespace(
+        started_at=discord.utils.utcnow(),
+        latency=0.05,
+        is_ready=lambda: True,
+        get_channel=lambda channel_id: None,
+        bridge_binds=BridgeBindCache(default_channel=10),
+        bridge_queue=queue,
+    )
+
+    async def main():
+        server = IPCServer(bot, str(tmp_path / "ipc.sock"))
+        await server.start()
+        # Only this user can connect, from the moment the socket exists
+        assert stat.S_IMODE(os.stat(server.path).st_mode) == 0o600
+        proxy = BotProxy(server.path, token="secret")
+        assert await proxy.connect()
+        assert proxy.is_ready() and proxy.latency == 0.05
+
+        subscription = proxy.bridge_queue.subscribe("web")
+        await queue.put({"n": 0})
+        await queue.put({"n": 1})
+        events = await subscription.get(timeout=1)
+        if len(events) < 2:
+            events += await subscription.get(timeout=1)
+        subscription.queue.ack("web", events[-1].seq)
+        subscription.close()
+        await asyncio.sleep(0.05)
+        await server.close()
+        return events
+
+    events = asyncio.run(main())
+    assert [(event.seq, event.payload) for event in events] == [(1, {"n": 0}), (2, {"n": 1})]
+    assert queue.cursor("web") == 2
+
+
+def test_consumer_names_are_unique_across_proxies(tmp_path):
+    queue = BridgeQueue(tmp_path / "bridge.db")
+    bot = types.SimpleNamespace(
+        started_at=discord.utils.utcnow(),
+        latency=0.05,
+        is_ready=lambda: True,
+        get_channel=lambda channel_id: None,
+        bridge_binds=BridgeBindCache(default_channel=10),
+        bridge_queue=queue,
+    )
+
+    async def main():
+        server = IPCServer(bot, str(tmp_path / "ipc.sock"))
+        await server.start()
+        # Each web worker has its own proxy
+        first, second = BotProxy(server.path, token="secret"), BotProxy(server.path, token="secret")
+        subscription = first.bridge_queue.subscribe("web")
+        await subscription.ready()
+        duplicate = second.bridge_queue.subscribe("web")
+        try:
+            await duplicate.ready()
+        except RuntimeError as e:
+            assert "already connected" in str(e)
+        else:
+            raise AssertionError("The same consumer subscribed twice")
+        subscription.close()
+        await asyncio.sleep(0.05)
+        # Once the first worker lets go, the name can be used again
+        again = second.bridge_queue.subscribe("web")
+        await again.ready()
+        again.close()
+        await asyncio.sleep(0.05)
+        await server.close()
+
+    asyncio.run(main())
@@ -0,0 +1,28 @@
+from utils.metrics import Counter, Gauge, Histogram, Registry
+
+
+def test_render_exposition_format():
+    registry = Registry()
+    requests = Counter("requests_total", "Requests.", ("path",), registry=registry)
+    requests.inc(labels=('/a"b',))
+    requests.inc(2, labels=('/a"b',))
+    Gauge("queue_depth", "Depth.", function=lambda: 7, registry=registry)
+    latency = Histogram("latency_seconds", "Latency.", buckets=(0.1, 1), registry=registry)
+    for value in (0.05, 0.5, 5):
+        latency.observe(value)
+
+    assert registry.render().splitlines() == [
+        "# HELP requests_total Requests.",
+        "# TYPE requests_total counter",
+        'requests_total{path="/a\\"b"} 3',
+        "# HELP queue_depth Depth.",
+        "# TYPE queue_depth gauge",
+        "queue_depth 7",
+        "# HELP latency_seconds Latency.",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1"} 2',
+        'latency_seconds_bucket{le="+Inf"} 3',
+        "latency_seconds_sum 5.55",
+        "latency_seconds_count 3",
+    ]
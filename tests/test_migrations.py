@@ -0,0 +1,44 @@
+import asyncio
+
+import orm
+
+from utils.migrations import Migration, get_version, migrate
+from utils.sqlite_engine import TunedDatabase
+
+
+def test_migrations_apply_once(tmp_path):
+    models = orm.ModelRegistry(TunedDatabase("sqlite:///" + str(tmp_path / "main.db")))
+
+    class Entry(orm.Model):
+        tablename = "entries"
+        registry = models
+        fields = {"entry_id": orm.Integer(primary_key=True), "target": orm.String(max_length=64)}
+
+    migrations = (
+        Migration(1, "Create tables", create_tables=True),
+        Migration(2, "Index targets", ("CREATE INDEX ix_entries_target ON entries (target)",)),
+    )
+    created = []
+    create_all = models.create_all
+
+    async def counting_create_all():
+        created.append(True)
+        await create_all()
+
+    models.create_all = counting_create_all
+
+    async def main():
+        assert await get_version(models) == 0
+        assert await migrate(models, migrations) == 2
+        indexes = await models.database.fetch_all("SELECT name FROM sqlite_master WHERE type = 'index'")
+        assert "ix_entries_target" in [row[0] for row in indexes]
+        # Already current: nothing runs, not even create_all
+        assert await migrate(models, migrations) == 2
+        assert len(created) == 1
+        # A later migration is applied on its own
+        migrations_v3 = migrations + (Migration(3, "Drop index", ("DROP INDEX ix_entries_target",)),)
+        assert await migrate(models, migrations_v3) == 3
+        assert len(created) == 1
+        await models.database.engine.close()
+
+    asyncio.run(main())
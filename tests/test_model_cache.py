@@ -0,0 +1,58 @@
+import asyncio
+
+import orm
+
+from utils.db import get_or_none
+from utils.model_cache import CachedModel, ModelCache
+from utils.sqlite_engine import TunedDatabase
+
+
+def test_model_cache_invalidates_on_write(tmp_path):
+    models = orm.ModelRegistry(TunedDatabase("sqlite:///" + str(tmp_path / "main.db")))
+
+    class CachedEntry(CachedModel):
+        tablename = "entries"
+        registry = models
+        fields = {"entry_id": orm.Integer(primary_key=True), "name": orm.String(max_length=64)}
+
+    cache = CachedEntry.cache
+
+    async def main():
+        await models.create_all()
+        assert await get_or_none(CachedEntry, name="a") is None
+        # Misses are cached too, so creating the row has to invalidate them
+        assert await get_or_none(CachedEntry, name="a") is None
+        assert (cache.hits, cache.misses) == (1, 1)
+        entry = await CachedEntry.objects.create(name="a")
+        assert (await get_or_none(CachedEntry, name="a")).pk == entry.pk
+        assert (await get_or_none(CachedEntry, name="a")).pk == entry.pk
+        assert (cache.hits, cache.misses) == (2, 2)
+
+        await entry.update(name="b")
+        assert await get_or_none(CachedEntry, name="a") is None
+        await CachedEntry.objects.filter(name="b").update(name="c")
+        assert (await get_or_none(CachedEntry, name="c")).pk == entry.pk
+        await CachedEntry.objects.filter(name="c").delete()
+        assert await get_or_none(CachedEntry, name="c") is None
+        assert cache.invalidations == 4
+        await models.database.engine.close()
+
+    asyncio.run(main())
+
+
+def test_model_cache_bounds(monkeypatch):
+    now = [0.0]
+    monkeypatch.setattr("utils.model_cache.time.monotonic", lambda: now[0])
+    cache = ModelCache("test", ttl=10, maxsize=2)
+    for value in range(3):
+        cache.put(ModelCache.key({"id": value}), value, cache.generation)
+    assert len(cache) == 2
+    assert cache.get(ModelCache.key({"id": 2})) == 2
+    now[0] = 10
+    assert cache.get(ModelCache.key({"id": 2})) != 2
+    # A result read before an invalidation isn't cached after it
+    generation = cache.generation
+    cache.invalidate()
+    cache.put(ModelCache.key({"id": 1}), 1, generation)
+    assert len(cache) == 0
+    assert ModelCache.key({"id__in": [1, 2]}) is None
@@ -0,0 +1,22 @@
+import asyncio
+
+from utils.sqlite_engine import TunedDatabase
+
+
+def test_reads_share_the_reader_pool(tmp_path):
+    database = TunedDatabase("sqlite:///" + str(tmp_path / "main.db"), readers=2)
+
+    async def setup():
+        await database.execute("CREATE TABLE entries (id INTEGER PRIMARY KEY, name TEXT)")
+        assert await database.execute("INSERT INTO entries (name) VALUES ('a')") == 1
+
+    async def main():
+        # In its own task, so that the reads below don't inherit (and queue on) its `databases` connection
+        await asyncio.create_task(setup())
+        rows = await asyncio.gather(*(database.fetch_one("SELECT name FROM entries WHERE id = 1") for _ in range(8)))
+        assert [row[0] for row in rows] == ["a"] * 8
+        assert await database.fetch_one("SELECT name FROM entries WHERE id = 2") is None
+        assert database.engine.snapshot() == {"readers": 2, "idle_readers": 2, "writer": True}
+        await database.engine.close()
+
+    asyncio.run(main())
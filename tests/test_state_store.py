@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+from utils.state_store import MemoryStateStore, RedisStateStore
+
+
+class FakeRedis:
+    """Just enough of redis.asyncio.Redis for RedisStateStore."""
+
+    def __init__(self):
+        self.values = {}
+        self.sets = {}
+
+    async def set(self, key, value, px=None):
+        assert px > 0, "redis rejects an expiry of 0"
+        self.values[key] = (value.encode(), time.time() + px / 1000)
+
+    async def getdel(self, key):
+        value, expires = self.values.pop(key, (None, 0))
+        return value if expires > time.time() else None
+
+    async def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+
+    async def zadd(self, key, mapping):
+        self.sets.setdefault(key, {}).update({member.encode(): score for member, score in mapping.items()})
+
+    async def zrem(self, key, member):
+        self.sets.get(key, {}).pop(member.encode(), None)
+
+    async def zremrangebyscore(self, key, low, high):
+        members = self.sets.get(key, {})
+        for member in [member for member, score in members.items() if score <= high]:
+            del members[member]
+
+    async def zcard(self, key):
+        return len(self.sets.get(key, {}))
+
+    async def zpopmin(self, key, count):
+        members = sorted(self.sets.get(key, {}).items(), key=lambda item: item[1])[:count]
+        for member, _ in members:
+            del self.sets[key][member]
+        return members
+
+
+def _exercise(store):
+    async def main():
+        first = await store.issue("!first:example.org")
+        second = await store.issue("!second:example.org")
+        third = await store.issue("!third:example.org")
+        # The oldest token is evicted once the store is full, and tokens can only be used once
+        return [await store.pop(first), await store.pop(second), await store.pop(second), await store.pop(third)]
+
+    return asyncio.run(main())
+
+
+def test_memory_store_is_capped_and_single_use():
+    store = MemoryStateStore(ttl=60, maxsize=2)
+    assert _exercise(store) == [None, "!second:example.org", None, "!third:example.org"]
+    assert len(store) == 0
+
+
+def test_memory_store_expires_tokens():
+    store = MemoryStateStore(ttl=0)
+    token = asyncio.run(store.issue("value"))
+    assert asyncio.run(store.pop(token)) is None
+
+
+def test_redis_store_is_capped_and_single_use():
+    redis = FakeRedis()
+    store = RedisStateStore(redis, "test", ttl=60, maxsize=2)
+    assert _exercise(store) == [None, "!second:example.org", None, "!third:example.org"]
+    assert redis.values == {} and redis.sets["test:index"] == {}
+
+
+def test_redis_store_accepts_short_ttls():
+    redis = FakeRedis()
+    store = RedisStateStore(redis, "test", ttl=0.5)
+    assert asyncio.run(store.pop(asyncio.run(store.issue("value")))) == "value"
@@ -0,0 +1,101 @@
+import asyncio
+import time
+
+import httpx
+
+from utils import db
+from utils.migrations import migrate
+from utils.sqlite_engine import TunedDatabase
+from utils.uptime import ProbeResult, UptimeChecker, UptimeTarget, percentile, uptime_stats
+from utils.uptime_rollups import Rollup, pick_resolution, prune, rollup_stats
+
+
+def test_percentile_uses_nearest_rank():
+    values = list(range(1, 101))
+    assert [percentile(values, q) for q in (50, 95, 99)] == [50, 95, 99]
+    assert percentile([7], 99) == 7
+    assert percentile([], 50) is None
+
+
+def test_probes_http_and_tcp_targets():
+    def handler(request: httpx.Request) -> httpx.Response:
+        return httpx.Response(200 if request.url.path == "/ok" else 503)
+
+    async def main():
+        server = await asyncio.start_server(lambda reader, writer: writer.close(), "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        checker = UptimeChecker([], http=httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+        ok = await checker.probe(UptimeTarget.parse("https://example.com/ok"))
+        broken = await checker.probe(UptimeTarget.parse("https://example.com/broken"))
+        tcp = await checker.probe(UptimeTarget.parse(f"tcp://127.0.0.1:{port}"))
+        server.close()
+        closed = await checker.probe(UptimeTarget.parse(f"tcp://127.0.0.1:{port}"))
+        return ok, broken, tcp, closed
+
+    ok, broken, tcp, closed = asyncio.run(main())
+    assert ok.is_up and ok.response_time is not None
+    assert not broken.is_up and broken.notes == "HTTP 503"
+    assert tcp.is_up
+    assert not closed.is_up and closed.response_time is None
+
+
+def test_rollups_merge_into_longer_periods():
+    minutes = [Rollup() for _ in range(3)]
+    for n in range(1, 301):
+        minutes[n % 3].add(n % 50 != 0, n)
+    hour = Rollup()
+    for minute in minutes:
+        hour.merge(minute)
+    stats = hour.snapshot()
+    assert (stats["checks"], stats["min"], stats["max"]) == (300, 1, 299)
+    assert stats["availability"] == 294 / 300
+    # Percentiles come from ~10% wide histogram bins
+    for q, exact in ((50, 150), (95, 285), (99, 297)):
+        assert abs(stats[f"p{q}"] - exact) <= exact * 0.1
+
+
+def test_long_windows_read_coarser_rollups():
+    retention = {60: 7 * 86400, 3600: 90 * 86400, 86400: None}
+    assert pick_resolution(3600, rollup_retention=retention) is None
+    assert pick_resolution(7 * 3600, rollup_retention=retention) == 60
+    assert pick_resolution(14 * 86400, rollup_retention=retention) == 3600
+    assert pick_resolution(30 * 86400, rollup_retention=retention) == 86400
+
+
+def test_results_are_flushed_rolled_up_and_pruned(monkeypatch, tmp_path):
+    database = TunedDatabase("sqlite:///" + str(tmp_path / "main.db"))
+    monkeypatch.setattr(db.registry, "database", database)
+    for model in (db.UptimeEntry, db.UptimeRollup):
+        monkeypatch.setattr(model, "database", database)
+    target = UptimeTarget.parse("https://example.com")
+    now = time.time()
+    old = (now - 3 * 86400) // 60 * 60
+
+    async def main():
+        await migrate(db.registry)
+        checker = UptimeChecker([target], http=httpx.AsyncClient())
+        for timestamp, result in (
+            (old, ProbeResult(True, 100)),
+            (old + 1, ProbeResult(False, None, "HTTP 503")),
+            (now - 2, ProbeResult(True, 200)),
+            (now - 1, ProbeResult(True, 300)),
+        ):
+            checker.record(target, result, timestamp)
+        await checker.flush()
+        assert checker.flushed == 4
+        assert await database.fetch_val("SELECT COUNT(*) FROM uptime") == 4
+        resolutions = await database.fetch_all("SELECT DISTINCT resolution FROM uptime_rollups ORDER BY resolution")
+        assert [row[0] for row in resolutions] == [60, 3600, 86400]
+
+        deleted = await prune(now, raw_retention=2 * 86400, rollup_retention={60: 86400, 3600: None, 86400: None})
+        assert deleted["raw"] == 2 and deleted["60"] == 1
+        # Raw rows only cover the last two days now, but the hourly rollups still have the older checks
+        recent = await uptime_stats(target.id, now - 3600)
+        assert (recent["checks"], recent["availability"], recent["p50"]) == (2, 1.0, 200)
+        history = await rollup_stats(target.id, old - 3600, 3600)
+        assert (history["checks"], history["availability"]) == (4, 0.75)
+        assert (history["min"], history["max"]) == (100, 300)
+        await checker.http.aclose()
+        await database.engine.close()
+
+    asyncio.run(main())
@@ -0,0 +1,158 @@
+import asyncio
+import types
+
+import httpx
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+from utils.bridge import BRIDGE_CHANNEL, BridgeBindCache, BridgeQueue
+from web.server import _outbound_slot, app, bridge_sse
+
+AUTH = {"Authorization": "Bearer secret"}
+
+
+class FakeSender:
+    def __init__(self):
+        self.sent = []
+
+    def submit(self, channel, author, content, *, avatar=None, webhook=None, files=()):
+        self.sent.append((channel.id, author, content))
+        return 1
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    channel = types.SimpleNamespace(id=BRIDGE_CHANNEL)
+    bot = types.SimpleNamespace(
+        http=types.SimpleNamespace(token="secret"),
+        bridge_binds=BridgeBindCache(default_channel=BRIDGE_CHANNEL),
+        get_channel=lambda channel_id: channel if channel_id == BRIDGE_CHANNEL else None,
+        bridge_queue=BridgeQueue(tmp_path / "bridge.db"),
+    )
+    monkeypatch.setattr(app.state, "bot", bot)
+    monkeypatch.setattr(app.state, "bridge_sender", FakeSender())
+    return TestClient(app)
+
+
+def test_batch_returns_one_result_per_message_in_order(client):
+    messages = [
+        {"room": "!a:example.org", "sender": "alice", "message": "first"},
+        {"room": "!a:example.org", "sender": "bob"},
+        "not an object",
+        {"room": "!a:example.org", "sender": "carol", "message": "third", "files": ["https://example.org/cat.png"]},
+        {"room": "!a:example.org", "sender": "dave", "message": "last"},
+    ]
+    response = client.post("/bridge/batch", json={"messages": messages}, headers=AUTH)
+    assert response.status_code == 201
+    results = response.json()["results"]
+    assert [result["status"] for result in results] == ["ok", "error", "error", "error", "ok"]
+    assert [result.get("code") for result in results] == [None, 400, 400, 400, None]
+    assert results[2]["detail"] == "Message must be an object."
+    # The bad messages don't stop the rest from being sent, in order
+    assert [author for _, author, _ in app.state.bridge_sender.sent] == ["alice", "dave"]
+
+
+def test_batch_is_capped(client):
+    messages = [{"room": "!a:example.org", "sender": "alice", "message": "hi"}] * 501
+    response = client.post("/bridge/batch", json={"messages": messages}, headers=AUTH)
+    assert response.status_code == 413
+    assert app.state.bridge_sender.sent == []
+    assert client.post("/bridge/batch", json={"messages": {}}, headers=AUTH).status_code == 400
+    assert client.post("/bridge/batch", json={"messages": []}, headers={"Authorization": "Bearer x"}).status_code == 401
+
+
+def _sse(consumer: str, **kwargs):
+    kwargs = {"cursor": None, "ack": False, "heartbeat": 0.05, "format": "json", "last_event_id": None, **kwargs}
+    return bridge_sse(consumer=consumer, **kwargs)
+
+
+def test_sse_streams_acks_and_resumes(client):
+    queue = app.state.bot.bridge_queue
+
+    async def main():
+        for n in range(3):
+            await queue.put({"n": n})
+        response = await _sse("sse")
+        # Nothing is connected until the response starts streaming
+        assert "sse" not in app.state.bridge_consumers
+        stream = response.body_iterator
+        assert await anext(stream) == "retry: 3000\n\n"
+        chunk = await anext(stream)
+        assert [line for line in chunk.splitlines() if line.startswith("id:")] == ["id: 1", "id: 2", "id: 3"]
+        assert "sse" in app.state.bridge_consumers
+        assert await anext(stream) == ": ping\n\n"
+        # Without `ack`, events are acknowledged once they have been sent
+        assert queue.cursor("sse") == 3
+        await stream.aclose()
+        assert "sse" not in app.state.bridge_consumers
+
+        for n in range(3, 5):
+            await queue.put({"n": n})
+        # A reconnecting client resumes after its Last-Event-ID, which also acknowledges everything up to it
+        stream = (await _sse("sse", ack=True, last_event_id=4)).body_iterator
+        await anext(stream)
+        chunk = await anext(stream)
+        assert [line for line in chunk.splitlines() if line.startswith("id:")] == ["id: 5"]
+        await anext(stream)
+        assert queue.cursor("sse") == 4
+        await stream.aclose()
+
+    asyncio.run(main())
+
+
+def test_unsent_sse_response_does_not_hold_the_consumer(client):
+    async def main():
+        await _sse("sse")  # e.g. the client went away before the response started
+        late = (await _sse("sse")).body_iterator
+        stream = (await _sse("sse")).body_iterator
+        assert await anext(stream) == "retry: 3000\n\n"
+        with pytest.raises(HTTPException) as e:
+            await _sse("sse")
+        assert e.value.status_code == 409
+        # A response that only starts once the consumer is connected elsewhere gets an error event instead
+        assert (await anext(late)).startswith("event: error\n")
+        await stream.aclose()
+
+    asyncio.run(main())
+
+
+def test_sse_rejects_bad_secret(client):
+    response = client.get("/bridge/sse", headers={"Authorization": "Bearer x"})
+    assert response.status_code == 401
+    assert client.get("/bridge/sse").status_code in (401, 403)
+
+
+def test_outbound_requests_are_limited(monkeypatch):
+    running = []
+    peak = 0
+
+    async def request():
+        nonlocal peak
+        async with _outbound_slot():
+            running.append(True)
+            peak = max(peak, len(running))
+            await asyncio.sleep(0.05)
+            running.pop()
+
+    async def main():
+        monkeypatch.setattr(app.state, "outbound", asyncio.Semaphore(2))
+        await asyncio.gather(*(request() for _ in range(5)))
+        assert peak == 2
+
+        # With every slot taken, a request gives up with a 503 rather than queueing indefinitely
+        async with _outbound_slot(), _outbound_slot():
+            with pytest.raises(HTTPException) as e:
+                async with _outbound_slot(timeout=0.05):
+                    pass
+        assert e.value.status_code == 503 and e.value.headers["Retry-After"] == "10"
+
+        # An upstream timeout is answered with a 504, and the slot is given back
+        with pytest.raises(HTTPException) as e:
+            async with _outbound_slot():
+                raise httpx.ReadTimeout("timed out")
+        assert e.value.status_code == 504
+        async with _outbound_slot(timeout=0.05), _outbound_slot(timeout=0.05):
+            pass
+
+    asyncio.run(main())
@@ -0,0 +1,635 @@
+import asyncio
+import collections
+import itertools
+import logging
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from .bridge_payload import dumps, loads
+from .db import BridgeBind, _pth
+
+__all__ = (
+    "BRIDGE_CHANNEL",
+    "BridgeBindCache",
+    "BridgeEvent",
+    "BridgeQueue",
+    "BridgeStats",
+    "BridgeSubscription",
+    "EditCoalescer",
+)
+
+try:
+    from config import BRIDGE_QUEUE_PATH
+except ImportError:
+    BRIDGE_QUEUE_PATH = Path(_pth).with_name("bridge.db")
+
+try:
+    from config import BRIDGE_CHANNEL
+except ImportError:
+    BRIDGE_CHANNEL = 1032974266527907901
+
+try:
+    from config import BRIDGE_QUEUE_MEMORY
+except ImportError:
+    BRIDGE_QUEUE_MEMORY = 8 * 1024 * 1024
+
+try:
+    from config import BRIDGE_QUEUE_MAX_EVENTS
+except ImportError:
+    BRIDGE_QUEUE_MAX_EVENTS = 100_000
+
+try:
+    from config import BRIDGE_CONSUMER_EXPIRY
+except ImportError:
+    BRIDGE_CONSUMER_EXPIRY = 7 * 86400
+
+try:
+    from config import BRIDGE_EDIT_WINDOW
+except ImportError:
+    BRIDGE_EDIT_WINDOW = 2.0
+
+try:
+    from config import BRIDGE_BUFFER_SIZE
+except ImportError:
+    BRIDGE_BUFFER_SIZE = 1000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    payload TEXT NOT NULL,
+    queued_at REAL
+);
+CREATE TABLE IF NOT EXISTS cursors (
+    consumer TEXT PRIMARY KEY,
+    seq INTEGER NOT NULL,
+    seen_at REAL
+);
+"""
+
+
+class BridgeEvent(NamedTuple):
+    seq: int
+    payload: dict
+    queued_at: float | None
+
+
+class BridgeStats:
+    """Running delivery statistics for a bridge consumer."""
+
+    def __init__(self):
+        self.frames = 0
+        self.events = 0
+        self.max_batch = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def record(self, events: list[BridgeEvent], frames: int = 1):
+        """Records that `events` were just sent in `frames` frames."""
+        now = time.time()
+        self.frames += frames
+        self.events += len(events)
+        self.max_batch = max(self.max_batch, len(events))
+        for event in events:
+            if event.queued_at is not None:
+                latency = now - event.queued_at
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+
+    def snapshot(self) -> dict:
+        return {
+            "frames": self.frames,
+            "events": self.events,
+            "avg_batch": round(self.events / self.frames, 2) if self.frames else 0,
+            "max_batch": self.max_batch,
+            "avg_latency_ms": round(self.latency_total / self.events * 1000, 2) if self.events else 0,
+            "max_latency_ms": round(self.latency_max * 1000, 2),
+        }
+
+
+class BridgeSubscription:
+    """
+    A single consumer's view of the bridge event stream.
+
+    New events are pushed into a bounded, per-subscriber buffer so that publishing never waits on a consumer.
+    If a consumer falls so far behind that its buffer overflows, it is marked as lagging: the buffer is dropped and
+    the consumer catches up by reading straight from the log until it reaches the head again.
+    """
+
+    def __init__(self, queue: "BridgeQueue", consumer: str, position: int, maxsize: int = BRIDGE_BUFFER_SIZE):
+        self.queue = queue
+        self.consumer = consumer
+        self.position = position
+        self.maxsize = maxsize
+        self.buffer: collections.deque[BridgeEvent] = collections.deque()
+        self.lagging = position < queue.head
+        self.overflows = 0
+        self._wakeup = asyncio.Event()
+
+    def _push(self, event: BridgeEvent):
+        if event.seq <= self.position:
+            return
+        if not self.lagging:
+            if len(self.buffer) >= self.maxsize:
+                self.queue.log.warning(
+                    "Bridge consumer %r is lagging behind (%d events buffered), switching to log reads.",
+                    self.consumer,
+                    len(self.buffer),
+                )
+                self.lagging = True
+                self.overflows += 1
+                self.buffer.clear()
+            else:
+                self.buffer.append(event)
+        self._wakeup.set()
+
+    @property
+    def lag(self) -> int:
+        """The number of events published that this consumer has not yet been sent."""
+        return self.queue.head - self.position
+
+    async def get(self, *, limit: int = 100, timeout: float = None) -> list[BridgeEvent]:
+        """Returns up to `limit` events after the current position, waiting up to `timeout` seconds for one."""
+        if not self.lagging and not self.buffer:
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                return []
+
+        if self.lagging:
+            events = self.queue.read(self.position, limit)
+            if not events or events[-1].seq >= self.queue.head:
+                self.lagging = False
+        else:
+            events = [self.buffer.popleft() for _ in range(min(limit, len(self.buffer)))]
+        if events:
+            self.position = events[-1].seq
+        return events
+
+    def snapshot(self) -> dict:
+        return {"position": self.position, "lag": self.lag, "lagging": self.lagging, "overflows": self.overflows}
+
+    def close(self):
+        self.queue.subscribers.discard(self)
+        # Consumers expire some time after they were last connected, not after they connected.
+        self.queue._touch(self.consumer)
+
+
+class BridgeQueue:
+    """
+    An append-only, SQLite-backed log of bridge events.
+
+    Every event is given a monotonically increasing sequence number. Consumers keep a cursor (the last sequence
+    number they acknowledged), so a consumer that reconnects - even after a restart - resumes right after the last
+    event it confirmed. Events are only removed once every known consumer has acknowledged them, or once more than
+    `max_events` events are waiting, in which case the oldest are dropped (a tenth of `max_events` at a time).
+    Consumers that haven't been connected or acknowledged anything for `consumer_expiry` seconds are forgotten, so
+    an abandoned consumer can't hold on to events forever.
+
+    The most recent events are also kept in memory, up to `memory_limit` bytes (of serialised payload), so that
+    consumers keeping up with the stream never touch the disk. Events pushed out of memory by newer ones are
+    "spilled" and only remain on disk, from where they are "drained" in order once a consumer catches up.
+
+    Cursors are kept in memory, and writes (new events, cursor updates and deletions) are committed in batches by a
+    worker thread with its own connection, so queueing and acknowledging events never waits on the disk. Events are
+    written within moments of being queued, but the last few may be lost if the process dies in between.
+    """
+
+    def __init__(
+        self,
+        path: str | Path = BRIDGE_QUEUE_PATH,
+        *,
+        memory_limit: int = BRIDGE_QUEUE_MEMORY,
+        max_events: int = BRIDGE_QUEUE_MAX_EVENTS,
+        consumer_expiry: Optional[float] = BRIDGE_CONSUMER_EXPIRY,
+    ):
+        self.path = Path(path)
+        self.memory_limit = memory_limit
+        self.max_events = max_events
+        self.consumer_expiry = consumer_expiry
+        self.log = logging.getLogger("jimmy.bridge.queue")
+        self._db = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(_SCHEMA)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(events)")}
+        if "queued_at" not in columns:
+            self._db.execute("ALTER TABLE events ADD COLUMN queued_at REAL")
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(cursors)")}
+        if "seen_at" not in columns:
+            self._db.execute("ALTER TABLE cursors ADD COLUMN seen_at REAL")
+            self._db.execute("UPDATE cursors SET seen_at = ?", (time.time(),))
+        row = self._db.execute("SELECT seq FROM sqlite_sequence WHERE name = 'events'").fetchone()
+        self.head = row[0] if row else 0
+        # Every event up to here has been deleted from the log (or never existed), or is about to be.
+        (low,) = self._db.execute("SELECT MIN(seq) FROM events").fetchone()
+        self._deleted_to = self.head if low is None else low - 1
+        self._expired_at = 0.0
+        # consumer -> (cursor, last seen)
+        self._cursors: dict[str, tuple[int, Optional[float]]] = {
+            consumer: (seq, seen_at)
+            for consumer, seq, seen_at in self._db.execute("SELECT consumer, seq, seen_at FROM cursors")
+        }
+        # Changes not yet written to disk: queued events (oldest first), cursors to save and cursors to delete.
+        self._pending: collections.deque[tuple[BridgeEvent, str]] = collections.deque()
+        self._dirty: set[str] = set()
+        self._forgotten: set[str] = set()
+        self._written_to = self.head
+        self._written_deleted_to = self._deleted_to
+        self._writer = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._writer.execute("PRAGMA synchronous=NORMAL")
+        self._write_lock = threading.Lock()
+        self._flushing: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+        self.subscribers: set[BridgeSubscription] = set()
+        self._tail: collections.deque[tuple[BridgeEvent, int]] = collections.deque()
+        self._tail_size = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.drained = 0
+
+    def _trim_tail(self, seq: int = 0):
+        """Evicts events up to `seq` from memory, then any further events needed to get under the memory limit."""
+        while self._tail and (self._tail[0][0].seq <= seq or self._tail_size > self.memory_limit):
+            event, size = self._tail.popleft()
+            self._tail_size -= size
+            if event.seq > seq:
+                self.spilled += 1
+
+    def _notify(self, event: BridgeEvent):
+        self._wakeup.set()
+        self._wakeup = asyncio.Event()
+        for subscriber in self.subscribers:
+            subscriber._push(event)
+
+    def _take(self) -> tuple[list[tuple], list[tuple], list[tuple], Optional[int]]:
+        """Collects the changes that haven't been written to disk yet, as arguments for _write()."""
+        events = [
+            (event.seq, serialised, event.queued_at)
+            for event, serialised in self._pending
+            if event.seq > max(self._written_to, self._deleted_to)
+        ]
+        cursors = [(consumer, *self._cursors[consumer]) for consumer in self._dirty]
+        forgotten = [(consumer,) for consumer in self._forgotten]
+        self._dirty.clear()
+        self._forgotten.clear()
+        deleted_to = self._deleted_to if self._deleted_to > self._written_deleted_to else None
+        return events, cursors, forgotten, deleted_to
+
+    def _write(self, events: list[tuple], cursors: list[tuple], forgotten: list[tuple], deleted_to: Optional[int]):
+        """Writes a batch of changes in a single transaction. Runs in a worker thread, except at shutdown."""
+        with self._write_lock:
+            # At shutdown, a batch may overlap one a worker thread was still writing.
+            events = [event for event in events if event[0] > self._written_to]
+            self._writer.execute("BEGIN")
+            try:
+                self._writer.executemany("INSERT INTO events (seq, payload, queued_at) VALUES (?, ?, ?)", events)
+                self._writer.executemany("DELETE FROM cursors WHERE consumer = ?", forgotten)
+                self._writer.executemany(
+                    "INSERT INTO cursors (consumer, seq, seen_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT (consumer) DO UPDATE SET seq = excluded.seq, seen_at = excluded.seen_at",
+                    cursors,
+                )
+                if deleted_to is not None:
+                    self._writer.execute("DELETE FROM events WHERE seq <= ?", (deleted_to,))
+                self._writer.execute("COMMIT")
+            except BaseException:
+                self._writer.execute("ROLLBACK")
+                raise
+            if events:
+                self._written_to = max(self._written_to, events[-1][0])
+            if deleted_to is not None:
+                self._written_deleted_to = max(self._written_deleted_to, deleted_to)
+
+    def _schedule_write(self):
+        if self._flushing is not None:
+            return
+        try:
+            self._flushing = asyncio.get_running_loop().create_task(self._flush())
+        except RuntimeError:
+            # Not running in an event loop, so there is nothing to block: write straight away.
+            self._write(*self._take())
+            self._pending.clear()
+
+    async def _flush(self):
+        """Writes pending changes to disk in the background, a batch at a time, until there are none left."""
+        try:
+            while self._pending or self._dirty or self._forgotten or self._deleted_to > self._written_deleted_to:
+                batch = self._take()
+                try:
+                    await asyncio.to_thread(self._write, *batch)
+                except Exception:
+                    self.log.exception("Failed to write to the bridge queue, will retry.")
+                    self._dirty.update(consumer for consumer, *_ in batch[1] if consumer in self._cursors)
+                    self._forgotten.update(consumer for (consumer,) in batch[2] if consumer not in self._cursors)
+                    await asyncio.sleep(1)
+                while self._pending and self._pending[0][0].seq <= max(self._written_to, self._deleted_to):
+                    self._pending.popleft()
+        finally:
+            self._flushing = None
+
+    def put_nowait(self, payload: dict) -> int:
+        """Appends an event to the log, returning its sequence number."""
+        queued_at = time.time()
+        serialised = dumps(payload)
+        self.head += 1
+        event = BridgeEvent(self.head, payload, queued_at)
+        self._pending.append((event, serialised))
+        if self.memory_limit:
+            self._tail.append((event, len(serialised)))
+            self._tail_size += len(serialised)
+        # Once the log is full, the oldest events are dropped a batch at a time rather than one on every put.
+        if self.max_events and self.head - self.max_events - self._deleted_to >= max(self.max_events // 10, 1):
+            cutoff = self.head - self.max_events
+            # Every event between the last deletion and the cutoff is still there, as sequence numbers have no gaps.
+            dropped = cutoff - self._deleted_to
+            self.log.warning("Bridge queue is full, dropped %d unacknowledged events.", dropped)
+            self.dropped += dropped
+            self._deleted_to = cutoff
+            self._trim_tail(cutoff)
+        else:
+            self._trim_tail()
+        self._schedule_write()
+        self._notify(event)
+        return self.head
+
+    async def put(self, payload: dict) -> int:
+        return self.put_nowait(payload)
+
+    def read(self, after: int, limit: int = 100) -> list[BridgeEvent]:
+        """Returns up to `limit` events with a sequence number greater than `after`, oldest first."""
+        if after >= self.head:
+            return []
+        if self._tail and after >= self._tail[0][0].seq - 1:
+            start = after + 1 - self._tail[0][0].seq
+            return [event for event, _ in itertools.islice(self._tail, start, start + limit)]
+
+        after = max(after, self._deleted_to)
+        rows = self._db.execute(
+            "SELECT seq, payload, queued_at FROM events WHERE seq > ? ORDER BY seq LIMIT ?", (after, limit)
+        ).fetchall()
+        self.drained += len(rows)
+        events = [BridgeEvent(seq, loads(payload), queued_at) for seq, payload, queued_at in rows]
+        if len(events) < limit and self._pending:
+            # Events that haven't been written yet are newer than any that have, so they follow straight on.
+            last = events[-1].seq if events else after
+            events.extend(itertools.islice((e for e, _ in self._pending if e.seq > last), limit - len(events)))
+        return events
+
+    async def get(self, after: int, *, limit: int = 100, timeout: float = None) -> list[BridgeEvent]:
+        """Like read(), but waits (up to `timeout` seconds) for new events if there are none yet."""
+        if self.head <= after:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                return []
+        return self.read(after, limit)
+
+    def subscribe(self, consumer: str, position: int = None, maxsize: int = BRIDGE_BUFFER_SIZE) -> BridgeSubscription:
+        """
+        Subscribes `consumer` to the event stream, starting after `position` (or its acknowledged cursor).
+        Each subscriber gets its own buffer, so any number of consumers can read the same events.
+        """
+        if position is None:
+            position = self.cursor(consumer)
+        # Register the consumer so that events it has not seen yet are not pruned from under it.
+        self._save_cursor(consumer, self._cursors.get(consumer, (position,))[0])
+        subscription = BridgeSubscription(self, consumer, position, maxsize)
+        self.subscribers.add(subscription)
+        return subscription
+
+    def cursor(self, consumer: str = "default") -> int:
+        """Returns the last sequence number `consumer` acknowledged."""
+        return self._cursors.get(consumer, (0,))[0]
+
+    def cursors(self) -> dict[str, int]:
+        """Returns every known consumer's cursor."""
+        return {consumer: seq for consumer, (seq, _) in self._cursors.items()}
+
+    def _save_cursor(self, consumer: str, seq: int):
+        self._cursors[consumer] = (seq, time.time())
+        self._forgotten.discard(consumer)
+        self._dirty.add(consumer)
+        self._schedule_write()
+
+    def ack(self, consumer: str, seq: int):
+        """Marks every event up to and including `seq` as delivered to `consumer`."""
+        self._save_cursor(consumer, max(min(seq, self.head), self.cursor(consumer)))
+        self.prune()
+
+    def _touch(self, consumer: str):
+        if consumer in self._cursors:
+            self._save_cursor(consumer, self._cursors[consumer][0])
+
+    def expire(self, now: float = None) -> list[str]:
+        """
+        Forgets consumers that aren't connected and haven't been seen for `consumer_expiry` seconds, so they no
+        longer hold back pruning. Returns their names. One that comes back starts from the oldest event left.
+        """
+        if self.consumer_expiry is None:
+            return []
+        cutoff = (now or time.time()) - self.consumer_expiry
+        connected = {subscriber.consumer for subscriber in self.subscribers}
+        expired = [
+            consumer
+            for consumer, (_, seen_at) in self._cursors.items()
+            if consumer not in connected and (seen_at or 0) < cutoff
+        ]
+        if expired:
+            for consumer in expired:
+                del self._cursors[consumer]
+                self._dirty.discard(consumer)
+                self._forgotten.add(consumer)
+            self._schedule_write()
+            self.log.info("Forgot bridge consumers that haven't been seen in a while: %s", ", ".join(expired))
+        return expired
+
+    def prune(self) -> int:
+        """Deletes events that every known consumer has acknowledged. Returns the number of events removed."""
+        # prune() runs on every ack, but expiry is measured in days, so checking once a minute is plenty.
+        if time.monotonic() - self._expired_at >= 60:
+            self._expired_at = time.monotonic()
+            self.expire()
+        if not self._cursors:
+            return 0
+        low = min(seq for seq, _ in self._cursors.values())
+        if low <= self._deleted_to:
+            return 0
+        self._trim_tail(low)
+        pruned, self._deleted_to = low - self._deleted_to, low
+        self._schedule_write()
+        return pruned
+
+    def snapshot(self) -> dict:
+        return {
+            "head": self.head,
+            "memory_events": len(self._tail),
+            "memory_bytes": self._tail_size,
+            "spilled": self.spilled,
+            "dropped": self.dropped,
+            "drained": self.drained,
+        }
+
+    def qsize(self, consumer: str = "default") -> int:
+        return self.head - self.cursor(consumer)
+
+    def empty(self, consumer: str = "default") -> bool:
+        return self.qsize(consumer) <= 0
+
+    def close(self):
+        """Writes anything still pending and closes the database."""
+        if self._flushing is not None:
+            self._flushing.cancel()
+        self._write(*self._take())
+        self._pending.clear()
+        self._writer.close()
+        self._db.close()
+
+
+_WEBHOOK_URL = re.compile(r"/webhooks/(\d+)/")
+
+
+def _webhook_id(url: Optional[str]) -> Optional[int]:
+    """Returns the ID of the webhook a discord webhook URL points to."""
+    if url and (match := _WEBHOOK_URL.search(url)):
+        return int(match[1])
+
+
+class BridgeBindCache:
+    """
+    An in-memory copy of the BridgeBind table, indexed by matrix ID and by discord ID.
+
+    Binds of matrix rooms to discord channels double as the outbound routing table: `routes` maps each bridged
+    channel ID to the room IDs its messages should be sent to.
+
+    Binds must be created and deleted through this cache so that it stays in sync with the database.
+    """
+
+    def __init__(self, default_channel: int = BRIDGE_CHANNEL):
+        self.default_channel = default_channel
+        self.by_matrix: dict[str, BridgeBind] = {}
+        self.by_discord: dict[int, dict[str, BridgeBind]] = {}
+        self.routes: dict[int, tuple[str | None, ...]] = {}
+        # IDs of the webhooks binds send through, and how many binds use each.
+        self.webhooks: collections.Counter[int] = collections.Counter()
+        self._update_route(default_channel)
+
+    @staticmethod
+    def is_room(matrix_id: str) -> bool:
+        return matrix_id.startswith(("!", "#"))
+
+    def _update_route(self, discord_id: int):
+        rooms = tuple(mx_id for mx_id in self.by_discord.get(discord_id, ()) if self.is_room(mx_id))
+        if not rooms and discord_id == self.default_channel:
+            # The default channel is bridged to whichever room the consumer considers its default.
+            rooms = (None,)
+        if rooms:
+            self.routes[discord_id] = rooms
+        else:
+            self.routes.pop(discord_id, None)
+
+    def _add(self, bind: BridgeBind):
+        self.by_matrix[bind.matrix_id] = bind
+        self.by_discord.setdefault(bind.discord_id, {})[bind.matrix_id] = bind
+        if hook := _webhook_id(bind.webhook):
+            self.webhooks[hook] += 1
+        self._update_route(bind.discord_id)
+
+    def _remove(self, bind: BridgeBind):
+        self.by_matrix.pop(bind.matrix_id, None)
+        binds = self.by_discord.get(bind.discord_id, {})
+        binds.pop(bind.matrix_id, None)
+        if not binds:
+            self.by_discord.pop(bind.discord_id, None)
+        if hook := _webhook_id(bind.webhook):
+            self.webhooks[hook] -= 1
+            if self.webhooks[hook] <= 0:
+                del self.webhooks[hook]
+        self._update_route(bind.discord_id)
+
+    async def load(self):
+        """(Re)loads every bind from the database."""
+        self.by_matrix.clear()
+        self.by_discord.clear()
+        self.routes.clear()
+        self.webhooks.clear()
+        self._update_route(self.default_channel)
+        for bind in await BridgeBind.objects.all():
+            self._add(bind)
+
+    def get(self, matrix_id: str) -> Optional[BridgeBind]:
+        return self.by_matrix.get(matrix_id)
+
+    def get_by_discord(self, discord_id: int) -> list[BridgeBind]:
+        return list(self.by_discord.get(discord_id, {}).values())
+
+    def rooms_for(self, channel_id: int) -> tuple[str | None, ...]:
+        """Returns the rooms messages in `channel_id` are bridged to (empty if the channel is not bridged)."""
+        return self.routes.get(channel_id, ())
+
+    def is_bridge_webhook(self, webhook_id: Optional[int]) -> bool:
+        """Whether `webhook_id` is a webhook that bridged messages are sent through, so its messages are echoes."""
+        return webhook_id is not None and webhook_id in self.webhooks
+
+    async def create(self, **kwargs) -> BridgeBind:
+        bind = await BridgeBind.objects.create(**kwargs)
+        self._add(bind)
+        return bind
+
+    async def delete(self, bind: BridgeBind):
+        await bind.delete()
+        self._remove(bind)
+
+    def __len__(self):
+        return len(self.by_matrix)
+
+
+class EditCoalescer:
+    """
+    Holds bridged edits back for `window` seconds, so a burst of edits to one message is sent as a single edit.
+
+    Only the latest edit of each message (per room) is kept. If the message is deleted before the edit is
+    flushed, the edit is dropped altogether.
+    """
+
+    def __init__(self, queue: BridgeQueue, window: float = BRIDGE_EDIT_WINDOW):
+        self.queue = queue
+        self.window = window
+        self.pending: dict[tuple[int, str | None], dict] = {}
+        self._handles: dict[tuple[int, str | None], asyncio.TimerHandle] = {}
+        self.coalesced = 0
+        self.cancelled = 0
+
+    def add(self, payload: dict):
+        """Queues an edit payload, replacing any pending edit of the same message."""
+        key = (payload["message_id"], payload.get("room"))
+        if key in self.pending:
+            self.coalesced += 1
+        else:
+            self._handles[key] = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+        self.pending[key] = payload
+
+    def discard(self, message_id: int) -> int:
+        """Drops any pending edits of `message_id`, returning how many were dropped."""
+        keys = [key for key in self.pending if key[0] == message_id]
+        for key in keys:
+            self._handles.pop(key).cancel()
+            del self.pending[key]
+        self.cancelled += len(keys)
+        return len(keys)
+
+    def _flush(self, key: tuple[int, str | None]):
+        self._handles.pop(key, None)
+        payload = self.pending.pop(key, None)
+        if payload is not None:
+            self.queue.put_nowait(payload)
+
+    def flush(self):
+        """Sends every pending edit now."""
+        for key in list(self.pending):
+            self._handles[key].cancel()
+            self._flush(key)
@@ -0,0 +1,180 @@
+import asyncio
+import io
+import logging
+import mimetypes
+import os
+import tempfile
+from pathlib import Path
+from typing import AsyncIterator, Iterable, NamedTuple, Optional
+
+import discord
+import httpx
+import PIL.Image
+from starlette.datastructures import UploadFile
+
+__all__ = ("MediaFile", "MediaTooLarge", "download", "from_upload", "fit_to_limit", "group_files")
+
+try:
+    from config import BRIDGE_MEDIA_MAX_SIZE
+except ImportError:
+    BRIDGE_MEDIA_MAX_SIZE = 100 * 1024 * 1024
+
+# Discord allows at most this many attachments per message.
+MAX_FILES_PER_MESSAGE = 10
+# The default upload limit, for channels outside of a guild.
+DEFAULT_FILESIZE_LIMIT = 10 * 1024 * 1024
+CHUNK_SIZE = 65536
+
+log = logging.getLogger("jimmy.bridge.media")
+
+
+class MediaTooLarge(ValueError):
+    """Raised when an inbound file is larger than BRIDGE_MEDIA_MAX_SIZE."""
+
+
+class MediaFile(NamedTuple):
+    """A file bridged from matrix, stored in a temporary file until it has been sent to discord."""
+
+    path: Path
+    filename: str
+    size: int
+    content_type: str
+
+    def to_discord(self) -> discord.File:
+        # Opened from the path each time, so the file can be sent again if the first attempt fails.
+        return discord.File(self.path, filename=self.filename)
+
+    def close(self):
+        self.path.unlink(missing_ok=True)
+
+
+def _guess_type(filename: str, content_type: Optional[str] = None) -> str:
+    if content_type and content_type != "application/octet-stream":
+        return content_type.split(";")[0].strip()
+    return mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+
+async def _spool(chunks: AsyncIterator[bytes], filename: str, content_type: str, max_size: int) -> MediaFile:
+    """Writes `chunks` to a temporary file, giving up as soon as more than `max_size` bytes have been written."""
+    fd, name = tempfile.mkstemp(prefix="jimmy-bridge-")
+    path = Path(name)
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as file:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > max_size:
+                    raise MediaTooLarge(f"{filename!r} is larger than {max_size} bytes.")
+                file.write(chunk)
+    except BaseException:
+        path.unlink(missing_ok=True)
+        raise
+    return MediaFile(path, filename, size, _guess_type(filename, content_type))
+
+
+async def download(
+    http: httpx.AsyncClient, url: str, filename: str = None, *, max_size: int = BRIDGE_MEDIA_MAX_SIZE
+) -> MediaFile:
+    """Streams the file at `url` to disk."""
+    async with http.stream("GET", url) as response:
+        response.raise_for_status()
+        if int(response.headers.get("Content-Length", 0)) > max_size:
+            raise MediaTooLarge(f"{url!r} is larger than {max_size} bytes.")
+        filename = filename or Path(response.url.path).name or "file"
+        return await _spool(
+            response.aiter_bytes(CHUNK_SIZE), filename, response.headers.get("Content-Type"), max_size
+        )
+
+
+async def from_upload(upload: UploadFile, *, max_size: int = BRIDGE_MEDIA_MAX_SIZE) -> MediaFile:
+    """Moves a multipart upload (which starlette spools to disk once it gets large) into a MediaFile."""
+
+    async def chunks():
+        while chunk := await upload.read(CHUNK_SIZE):
+            yield chunk
+
+    try:
+        return await _spool(chunks(), upload.filename or "file", upload.content_type, max_size)
+    finally:
+        await upload.close()
+
+
+def _recompress(media: MediaFile, limit: int) -> Optional[MediaFile]:
+    """
+    Re-encodes an image as WebP, shrinking it until it fits into `limit` bytes.
+    Returns None if the file isn't a still image, or can't be made small enough.
+    """
+    try:
+        image = PIL.Image.open(media.path)
+        if getattr(image, "is_animated", False):
+            return
+        image.load()
+    except (OSError, PIL.Image.DecompressionBombError):
+        return
+    if image.mode not in ("RGB", "RGBA"):
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+
+    filename = Path(media.filename).with_suffix(".webp").name
+    for _ in range(6):
+        buffer = io.BytesIO()
+        image.save(buffer, "WEBP", quality=80, method=4)
+        if buffer.tell() <= limit:
+            fd, name = tempfile.mkstemp(prefix="jimmy-bridge-")
+            with os.fdopen(fd, "wb") as file:
+                file.write(buffer.getbuffer())
+            return MediaFile(Path(name), filename, buffer.tell(), "image/webp")
+        image = image.resize((max(image.width * 3 // 4, 1), max(image.height * 3 // 4, 1)))
+
+
+def _split(media: MediaFile, limit: int) -> list[MediaFile]:
+    """Splits a file into numbered parts of at most `limit` bytes each."""
+    count = -(-media.size // limit)
+    parts = []
+    try:
+        with media.path.open("rb") as source:
+            for n in range(1, count + 1):
+                fd, name = tempfile.mkstemp(prefix="jimmy-bridge-")
+                parts.append(MediaFile(Path(name), f"{media.filename}.{n:03d}", 0, "application/octet-stream"))
+                with os.fdopen(fd, "wb") as file:
+                    remaining = limit
+                    while remaining and (chunk := source.read(min(CHUNK_SIZE, remaining))):
+                        file.write(chunk)
+                        remaining -= len(chunk)
+                parts[-1] = parts[-1]._replace(size=limit - remaining)
+    except BaseException:
+        for part in parts:
+            part.close()
+        raise
+    return parts
+
+
+async def fit_to_limit(media: MediaFile, limit: int) -> list[MediaFile]:
+    """
+    Makes sure `media` can be uploaded to discord. Images over `limit` are recompressed, and anything else (or any
+    image that still doesn't fit) is split into parts named `<filename>.001`, `<filename>.002`, etc.
+    The original file is removed if it is replaced.
+    """
+    if media.size <= limit:
+        return [media]
+    if media.content_type.startswith("image/"):
+        if recompressed := await asyncio.to_thread(_recompress, media, limit):
+            log.debug("Recompressed %r from %d to %d bytes.", media.filename, media.size, recompressed.size)
+            media.close()
+            return [recompressed]
+    parts = await asyncio.to_thread(_split, media, limit)
+    log.debug("Split %r (%d bytes) into %d parts.", media.filename, media.size, len(parts))
+    media.close()
+    return parts
+
+
+def group_files(files: Iterable[MediaFile], limit: int) -> list[list[MediaFile]]:
+    """Groups files into as few messages as possible, keeping each message's total size within `limit`."""
+    groups: list[list[MediaFile]] = []
+    size = 0
+    for media in files:
+        if not groups or len(groups[-1]) >= MAX_FILES_PER_MESSAGE or size + media.size > limit:
+            groups.append([])
+            size = 0
+        groups[-1].append(media)
+        size += media.size
+    return groups
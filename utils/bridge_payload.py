@@ -0,0 +1,342 @@
+import asyncio
+import collections
+import json
+import logging
+from typing import TYPE_CHECKING, AsyncIterator, NamedTuple, Optional
+
+import discord
+import pydantic
+
+from .bridge_sender import RateLimiter
+
+if TYPE_CHECKING:
+    from .mirror import AttachmentMirror
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from config import BRIDGE_PAYLOAD_CACHE_SIZE
+except ImportError:
+    BRIDGE_PAYLOAD_CACHE_SIZE = 2048
+
+try:
+    from config import BRIDGE_FETCH_REPLIES
+except ImportError:
+    BRIDGE_FETCH_REPLIES = True
+
+try:
+    from config import BRIDGE_BACKFILL_PREFETCH
+except ImportError:
+    BRIDGE_BACKFILL_PREFETCH = 200
+
+__all__ = (
+    "MessagePayload",
+    "AuthorRecord",
+    "AuthorCache",
+    "PayloadCache",
+    "CompactEncoder",
+    "generate_payload",
+    "history_payloads",
+    "dumps",
+    "loads",
+)
+
+
+# Left out of queued events: the replied-to message is included, but not whatever it replied to in turn.
+_REPLY_CHAIN = {"reply_to": {"reply_to"}}
+
+
+class MessagePayload(pydantic.BaseModel):
+    class MessageAttachmentPayload(pydantic.BaseModel):
+        url: str
+        proxy_url: str
+        filename: str
+        size: int
+        width: Optional[int] = None
+        height: Optional[int] = None
+        content_type: str
+        id: Optional[int] = None
+        mirror_url: Optional[str] = None
+
+    event_type: str = "create"
+    message_id: int
+    author: str
+    author_id: Optional[int] = None
+    is_automated: bool = False
+    avatar: str
+    content: str
+    clean_content: str
+    at: float
+    attachments: list[MessageAttachmentPayload] = pydantic.Field(default_factory=list)
+    reply_to: Optional["MessagePayload"] = None
+    room: Optional[str] = None
+
+    def to_event(self) -> dict:
+        """The payload as it is queued for the bridge, with the reply chain cut after the replied-to message."""
+        return self.model_dump(exclude=_REPLY_CHAIN)
+
+
+def dumps(obj) -> str:
+    """Serialises `obj` to compact JSON, using orjson if it is installed."""
+    if orjson:
+        return orjson.dumps(obj).decode()
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def loads(data: str | bytes):
+    if orjson:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class AuthorRecord(NamedTuple):
+    id: int
+    name: str
+    avatar: str
+    is_automated: bool
+
+
+class AuthorCache:
+    """
+    Remembers the bridge-facing details of recent message authors.
+
+    Building an avatar URL is comparatively expensive, so it is only rebuilt when the author's name or avatar
+    actually changes.
+    """
+
+    def __init__(self, maxsize: int = 1024):
+        self.maxsize = maxsize
+        self._records: collections.OrderedDict[int, tuple[tuple, AuthorRecord]] = collections.OrderedDict()
+
+    def get(self, author: discord.User | discord.Member) -> AuthorRecord:
+        avatar = author.display_avatar
+        key = (author.display_name, avatar.key, author.bot or author.system)
+        cached = self._records.get(author.id)
+        if cached and cached[0] == key:
+            self._records.move_to_end(author.id)
+            return cached[1]
+
+        record = AuthorRecord(author.id, key[0], avatar.with_static_format("webp").with_size(512).url, key[2])
+        self._records[author.id] = (key, record)
+        if len(self._records) > self.maxsize:
+            self._records.popitem(last=False)
+        return record
+
+
+class PayloadCache:
+    """
+    A size-bounded LRU of recently generated bridge payloads, keyed by message ID.
+
+    This is what replies are resolved from, so a reply to a message that has fallen out of discord's message cache
+    still gets its context, and a message that is replied to many times is only turned into a payload once.
+    On a miss, the replied-to message can be fetched from discord, at most `fetch_rate` times every `fetch_per`
+    seconds.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = BRIDGE_PAYLOAD_CACHE_SIZE,
+        *,
+        fetch: bool = BRIDGE_FETCH_REPLIES,
+        fetch_rate: int = 5,
+        fetch_per: float = 10,
+    ):
+        self.maxsize = maxsize
+        self.fetch_enabled = fetch
+        self.limiter = RateLimiter(fetch_rate, fetch_per)
+        self._payloads: collections.OrderedDict[int, MessagePayload] = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+
+    def get(self, message_id: int) -> Optional[MessagePayload]:
+        payload = self._payloads.get(message_id)
+        if payload is None:
+            self.misses += 1
+            return
+        self.hits += 1
+        self._payloads.move_to_end(message_id)
+        return payload
+
+    def put(self, payload: MessagePayload):
+        self._payloads[payload.message_id] = payload
+        self._payloads.move_to_end(payload.message_id)
+        if len(self._payloads) > self.maxsize:
+            self._payloads.popitem(last=False)
+
+    def update(self, payload: MessagePayload):
+        """Applies an edit or redact payload to the cached payload of the same message."""
+        if payload.event_type == "redact":
+            self._payloads.pop(payload.message_id, None)
+        elif cached := self._payloads.get(payload.message_id):
+            cached.content = payload.content
+            cached.clean_content = payload.clean_content
+
+    async def fetch(
+        self, channel: discord.abc.Messageable, message_id: int, authors: AuthorCache
+    ) -> Optional[MessagePayload]:
+        """Fetches a message that is not cached, if fetching is enabled and the rate limit allows it."""
+        if not self.fetch_enabled or not self.limiter.try_acquire():
+            return
+        self.fetches += 1
+        try:
+            message = await channel.fetch_message(message_id)
+        except discord.HTTPException:
+            return
+        return generate_payload(message, authors, payloads=self)
+
+    def snapshot(self) -> dict:
+        return {"size": len(self._payloads), "hits": self.hits, "misses": self.misses, "fetches": self.fetches}
+
+
+def generate_payload(
+    message: discord.Message,
+    authors: AuthorCache,
+    *,
+    event_type: str = "create",
+    at: float = None,
+    payloads: PayloadCache = None,
+    mirror: "AttachmentMirror" = None,
+    lazy_mirror: bool = False,
+) -> MessagePayload:
+    """
+    Builds the bridge payload for `message`.
+
+    Attachments and the replied-to message are only included for `create` events. If `payloads` is given, replies
+    are resolved from it first, and the new payload is cached there (or applied to the cached one, for edits and
+    redacts). If `mirror` is given, attachments are mirrored and their payloads carry the mirror's URL; with
+    `lazy_mirror`, they are only downloaded once the mirror's URL is first requested.
+    """
+    author = authors.get(message.author)
+    payload = MessagePayload(
+        event_type=event_type,
+        message_id=message.id,
+        author=author.name,
+        author_id=author.id,
+        is_automated=author.is_automated,
+        avatar=author.avatar,
+        content=message.content or "",
+        clean_content=str(message.clean_content or ""),
+        at=at or message.created_at.timestamp(),
+    )
+    if event_type != "create":
+        if payloads is not None:
+            payloads.update(payload)
+        return payload
+
+    for attachment in message.attachments:
+        payload.attachments.append(
+            MessagePayload.MessageAttachmentPayload(
+                url=attachment.url,
+                filename=attachment.filename,
+                proxy_url=attachment.proxy_url,
+                size=attachment.size,
+                width=attachment.width,
+                height=attachment.height,
+                content_type=attachment.content_type,
+                id=attachment.id,
+                mirror_url=mirror.register(
+                    attachment.id, attachment.url, attachment.filename, attachment.content_type, lazy=lazy_mirror
+                ) if mirror else None,
+            )
+        )
+    if message.reference is not None and message.reference.message_id:
+        if payloads is not None:
+            payload.reply_to = payloads.get(message.reference.message_id)
+        if payload.reply_to is None and message.reference.cached_message:
+            try:
+                payload.reply_to = generate_payload(message.reference.cached_message, authors, payloads=payloads)
+            except RecursionError:
+                payload.reply_to = None
+                logging.warning("Failed to generate reply payload for message %s", message.id, exc_info=True)
+    if payloads is not None:
+        payloads.put(payload)
+    return payload
+
+
+async def history_payloads(
+    channel: discord.abc.Messageable,
+    *,
+    after: discord.abc.Snowflake = None,
+    limit: int = None,
+    authors: AuthorCache = None,
+    mirror: "AttachmentMirror" = None,
+    prefetch: int = BRIDGE_BACKFILL_PREFETCH,
+) -> AsyncIterator[MessagePayload]:
+    """
+    Yields the payloads for `channel`'s messages after `after`, oldest first. Attachments are registered with
+    `mirror` lazily, so a large backfill doesn't download (and evict recently bridged files for) every one of them.
+
+    History is fetched by a background task that stays at most `prefetch` messages ahead of the consumer, so the
+    next page is already being fetched while the current one is processed, without reading the whole history into
+    memory when the consumer is slow.
+    """
+    authors = authors or AuthorCache()
+    payloads = PayloadCache(fetch=False)
+    queue: asyncio.Queue[Optional[discord.Message]] = asyncio.Queue(maxsize=prefetch)
+
+    error: Optional[Exception] = None
+
+    async def producer():
+        nonlocal error
+        try:
+            async for message in channel.history(limit=limit, after=after, oldest_first=True):
+                await queue.put(message)
+        except Exception as e:
+            error = e
+        await queue.put(None)
+
+    task = asyncio.create_task(producer())
+    try:
+        while (message := await queue.get()) is not None:
+            yield generate_payload(message, authors, payloads=payloads, mirror=mirror, lazy_mirror=True)
+        if error:
+            raise error
+    finally:
+        task.cancel()
+
+
+class CompactEncoder:
+    """
+    Encodes bridge events for a single consumer in the compact wire format.
+
+    Instead of repeating the author's name and avatar in every event, an `{"k": "author", ...}` record is sent the
+    first time an author appears (or when they change), and events refer to it by ID. Replies refer to the ID of
+    the message they reply to rather than embedding it, and fields equal to their default are left out.
+    """
+
+    def __init__(self):
+        self.sent_authors: dict[int, tuple] = {}
+
+    def encode(self, seq: int, payload: dict) -> list[dict]:
+        """Returns the records (an optional author record followed by the event) representing `payload`."""
+        records = []
+        author_id = payload.get("author_id")
+        author = (payload["author"], payload["avatar"], payload["is_automated"])
+        if author_id is not None and self.sent_authors.get(author_id) != author:
+            self.sent_authors[author_id] = author
+            records.append({"k": "author", "id": author_id, "name": author[0], "avatar": author[1], "bot": author[2]})
+
+        event = {"k": payload["event_type"], "seq": seq, "id": payload["message_id"], "at": payload["at"]}
+        if author_id is not None:
+            event["a"] = author_id
+        else:
+            event.update(name=author[0], avatar=author[1], bot=author[2])
+        if payload["content"]:
+            event["c"] = payload["content"]
+        if payload["clean_content"] != payload["content"]:
+            event["cc"] = payload["clean_content"]
+        if payload.get("attachments"):
+            event["f"] = [
+                {key: value for key, value in attachment.items() if value is not None}
+                for attachment in payload["attachments"]
+            ]
+        if payload.get("reply_to"):
+            event["r"] = payload["reply_to"]["message_id"]
+        if payload.get("room"):
+            event["room"] = payload["room"]
+        records.append(event)
+        return records
@@ -0,0 +1,364 @@
+import asyncio
+import collections
+import logging
+import re
+import textwrap
+import time
+from typing import NamedTuple, Optional
+
+import aiohttp
+import discord
+from discord.ext.commands import Paginator
+
+from .bridge_media import DEFAULT_FILESIZE_LIMIT, MediaFile, group_files
+
+__all__ = ("RateLimiter", "OutboundMessage", "ChannelPipeline", "BridgeSender", "paginate")
+
+try:
+    from config import BRIDGE_COALESCE_WINDOW
+except ImportError:
+    BRIDGE_COALESCE_WINDOW = 0.75
+
+# How long since a sender's last message before their name is shown again (when not sending via a webhook).
+HEADER_TIMEOUT = 600
+MAX_PAGE_SIZE = 1990
+
+
+def paginate(text: str) -> list[str]:
+    """Splits a message into pages that fit into a single discord message."""
+    paginator = Paginator(prefix="", suffix="", max_size=MAX_PAGE_SIZE)
+    for line in text.splitlines():
+        try:
+            paginator.add_line(line)
+        except (ValueError, RuntimeError):  # the exception raised depends on the py-cord version
+            paginator.add_line(textwrap.shorten(line, width=1980, placeholder="<...>"))
+    # The paginator wraps every page in newlines, even with an empty prefix and suffix.
+    return [page.strip("\n") for page in paginator.pages]
+
+
+def webhook_username(name: str) -> str:
+    """Makes a matrix display name acceptable as a webhook username."""
+    # Discord refuses webhook usernames containing these words.
+    name = re.sub(r"(discord|clyde)", lambda m: m[0][0] + "\N{zero width space}" + m[0][1:], name, flags=re.I)
+    return textwrap.shorten(name, width=80, placeholder="...") or "Unknown"
+
+
+class RateLimiter:
+    """A token bucket that allows `rate` calls every `per` seconds."""
+
+    def __init__(self, rate: int, per: float):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        """Takes a token if one is available, without waiting."""
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+
+
+class OutboundMessage(NamedTuple):
+    author: str
+    pages: list[str]
+    avatar: Optional[str] = None
+    # Attachments, already grouped into the messages they are sent in.
+    files: list[list[MediaFile]] = []
+
+    def close(self):
+        for group in self.files:
+            for media in group:
+                media.close()
+
+
+class ChannelPipeline:
+    """
+    Delivers bridged messages to a single discord channel, in order.
+
+    Messages are sent through the channel's webhook (so each matrix user shows up under their own name and avatar)
+    if there is one, and through the bot otherwise. Consecutive short messages from the same sender that arrive
+    within `window` seconds of each other are merged into one, and sends are paced to stay inside discord's rate
+    limits instead of running into 429s.
+    """
+
+    def __init__(
+        self,
+        channel: discord.TextChannel,
+        webhook_url: Optional[str] = None,
+        *,
+        session: Optional[aiohttp.ClientSession] = None,
+        window: float = BRIDGE_COALESCE_WINDOW,
+    ):
+        self.channel = channel
+        self.webhook_url = webhook_url
+        self.webhook = discord.Webhook.from_url(webhook_url, session=session) if webhook_url else None
+        self.window = window
+        self.log = logging.getLogger("jimmy.bridge.sender")
+        self.queue: asyncio.Queue[OutboundMessage] = asyncio.Queue()
+        if self.webhook:
+            # Webhooks may send 5 messages every 2 seconds, and 30 a minute per channel.
+            self.limiters = (RateLimiter(5, 2), RateLimiter(30, 60))
+        else:
+            self.limiters = (RateLimiter(5, 5),)
+        self.last_author: Optional[str] = None
+        self.last_sent = 0.0
+        self.sent = 0
+        self.coalesced = 0
+        self.failed = 0
+        # When the last message failed to send, and why.
+        self.last_error: Optional[tuple[float, str]] = None
+        self.busy = False
+        self._pending: Optional[OutboundMessage] = None
+        self.task = asyncio.create_task(self.worker())
+
+    async def _next(self, timeout: float = None) -> OutboundMessage:
+        if self._pending:
+            message, self._pending = self._pending, None
+            return message
+        return await asyncio.wait_for(self.queue.get(), timeout=timeout)
+
+    async def _coalesce(self, message: OutboundMessage) -> OutboundMessage:
+        """Merges messages from the same sender that follow `message` within the coalescing window."""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.window
+        while len(message.pages) == 1 and not message.files and (remaining := deadline - loop.time()) > 0:
+            try:
+                following = await self._next(timeout=remaining)
+            except asyncio.TimeoutError:
+                break
+            if following.author != message.author or len(following.pages) != 1 or following.files:
+                self._pending = following
+                break
+            merged = message.pages[0] + "\n" + following.pages[0]
+            if len(merged) > MAX_PAGE_SIZE:
+                self._pending = following
+                break
+            message = message._replace(pages=[merged])
+            self.coalesced += 1
+        return message
+
+    async def worker(self):
+        while True:
+            message = await self._next()
+            self.busy = True
+            try:
+                message = await self._coalesce(message)
+                await self.deliver(message)
+            except discord.HTTPException as e:
+                self.log.error("Failed to bridge message from %r to %r: %r", message.author, self.channel, e)
+                self._failed(e)
+            except Exception as e:
+                self.log.exception("Failed to bridge message from %r to %r", message.author, self.channel)
+                self._failed(e)
+            finally:
+                self.busy = False
+                message.close()
+
+    def _failed(self, error: Exception):
+        self.failed += 1
+        self.last_error = (time.time(), repr(error))
+
+    async def _send(self, content: str, **kwargs) -> Optional[discord.Message]:
+        for limiter in self.limiters:
+            await limiter.acquire()
+        message = await self.channel.send(content, **kwargs)
+        self.sent += 1
+        return message
+
+    async def deliver(self, message: OutboundMessage):
+        if self.webhook:
+            try:
+                return await self.deliver_webhook(message)
+            except discord.NotFound:
+                self.log.warning("Webhook for %r no longer exists, falling back to sending as the bot.", self.channel)
+                self.webhook = None
+                self.limiters = (RateLimiter(5, 5),)
+        return await self.deliver_bot(message)
+
+    async def deliver_webhook(self, message: OutboundMessage):
+        # The first group of attachments goes with the last page, any others are sent on their own afterwards.
+        m = len(message.pages)
+        sends = [(f"[{n}/{m}]\n{page}" if m > 1 else page, []) for n, page in enumerate(message.pages, 1)]
+        for n, group in enumerate(message.files):
+            if n == 0 and sends:
+                sends[-1] = (sends[-1][0], group)
+            else:
+                sends.append((None, group))
+        for n, (content, files) in enumerate(sends, 1):
+            for limiter in self.limiters:
+                await limiter.acquire()
+            await self.webhook.send(
+                content or discord.utils.MISSING,
+                username=webhook_username(message.author),
+                avatar_url=message.avatar or discord.utils.MISSING,
+                allowed_mentions=discord.AllowedMentions.none(),
+                files=[media.to_discord() for media in files] or discord.utils.MISSING,
+                silent=True,
+                suppress_embeds=n != len(sends),
+            )
+            self.sent += 1
+
+    async def deliver_bot(self, message: OutboundMessage):
+        now = time.monotonic()
+        show_header = self.last_author != message.author or now - self.last_sent >= HEADER_TIMEOUT
+        groups = [[media.to_discord() for media in group] for group in message.files]
+        if len(message.pages) > 1:
+            msg = None
+            if show_header:
+                msg = await self._send(f"**{message.author}**:")
+            m = len(message.pages)
+            for n, page in enumerate(message.pages, 1):
+                await self._send(
+                    f"[{n}/{m}]\n>>> {page}",
+                    allowed_mentions=discord.AllowedMentions.none(),
+                    reference=msg,
+                    files=groups.pop(0) if n == m and groups else None,
+                    silent=True,
+                    suppress=n != m,
+                )
+        else:
+            content = f">>> {message.pages[0]}" if message.pages else ""
+            if show_header:
+                content = f"**{message.author}**:\n" + content
+            await self._send(
+                content or None,
+                allowed_mentions=discord.AllowedMentions.none(),
+                files=groups.pop(0) if groups else None,
+                silent=True,
+                suppress=False,
+            )
+        for group in groups:
+            await self._send(None, files=group, silent=True)
+        self.last_author = message.author
+        self.last_sent = now
+
+    @property
+    def backlog(self) -> int:
+        """The number of messages waiting to be sent, including any being sent right now."""
+        return self.queue.qsize() + bool(self._pending) + self.busy
+
+    async def drain(self):
+        """Waits until every queued message has been sent (or has failed to)."""
+        while self.backlog and not self.task.done():
+            await asyncio.sleep(0.05)
+
+    def close(self):
+        self.task.cancel()
+        if self._pending:
+            self._pending.close()
+        while not self.queue.empty():
+            self.queue.get_nowait().close()
+
+
+class BridgeSender:
+    """
+    Hands out (and caches) a ChannelPipeline for each channel and webhook messages are bridged into.
+
+    Several rooms can be bound to one channel with different webhooks (or none), so each webhook gets its own
+    pipeline rather than replacing the channel's pipeline and dropping whatever it still had queued.
+
+    Messages are sent in the background, so failures are only logged; `snapshot()` counts them.
+    """
+
+    def __init__(self):
+        self.pipelines: dict[tuple[int, Optional[str]], ChannelPipeline] = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+        # Counts from pipelines that have since been replaced, so that the totals never go backwards.
+        self._retired: collections.Counter[str] = collections.Counter()
+        self._retired_error: Optional[tuple[tuple[float, str], int]] = None
+        self.log = logging.getLogger("jimmy.bridge.sender")
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession()
+        return self._session
+
+    def pipeline(self, channel: discord.TextChannel, webhook_url: Optional[str] = None) -> ChannelPipeline:
+        key = (channel.id, webhook_url)
+        pipeline = self.pipelines.get(key)
+        if pipeline is None or pipeline.task.done():
+            if pipeline:
+                self._retire(pipeline)
+            pipeline = ChannelPipeline(channel, webhook_url, session=self.session)
+            self.pipelines[key] = pipeline
+        return pipeline
+
+    def submit(
+        self,
+        channel: discord.TextChannel,
+        author: str,
+        content: str,
+        *,
+        avatar: str = None,
+        webhook: str = None,
+        files: list[MediaFile] = (),
+    ) -> int:
+        """
+        Queues a message to be sent to `channel`, returning the number of pages it will be split into.
+        `files` must already fit into the channel's upload limit (see `bridge_media.fit_to_limit`), and are deleted
+        once they have been sent.
+        """
+        limit = channel.guild.filesize_limit if getattr(channel, "guild", None) else DEFAULT_FILESIZE_LIMIT
+        message = OutboundMessage(author, paginate(content), avatar, group_files(files, limit))
+        if not message.pages and not message.files:
+            return 0
+        self.pipeline(channel, webhook).queue.put_nowait(message)
+        return len(message.pages)
+
+    def _retire(self, pipeline: ChannelPipeline):
+        pipeline.close()
+        self._retired.update(sent=pipeline.sent, coalesced=pipeline.coalesced, failed=pipeline.failed)
+        if pipeline.last_error:
+            self._retired_error = max(filter(None, (self._retired_error, (pipeline.last_error, pipeline.channel.id))))
+
+    def snapshot(self) -> dict:
+        pipelines = list(self.pipelines.values())
+        errors = [(pipeline.last_error, pipeline.channel.id) for pipeline in pipelines if pipeline.last_error]
+        if self._retired_error:
+            errors.append(self._retired_error)
+        last_error = None
+        if errors:
+            (at, error), channel_id = max(errors)
+            last_error = {"at": at, "channel": channel_id, "error": error}
+        return {
+            "pipelines": len(pipelines),
+            "queued": sum(pipeline.backlog for pipeline in pipelines),
+            **{
+                key: self._retired[key] + sum(getattr(pipeline, key) for pipeline in pipelines)
+                for key in ("sent", "coalesced", "failed")
+            },
+            "last_error": last_error,
+        }
+
+    async def close(self, timeout: float = 5):
+        """Gives queued messages up to `timeout` seconds to be sent, then drops whatever is left."""
+        pipelines = list(self.pipelines.values())
+        if pipelines and timeout:
+            drains = [asyncio.create_task(pipeline.drain()) for pipeline in pipelines]
+            await asyncio.wait(drains, timeout=timeout)
+            for task in drains:
+                task.cancel()
+        if dropped := sum(pipeline.backlog for pipeline in pipelines):
+            self.log.warning("Dropped %d bridged messages that were still waiting to be sent.", dropped)
+        for pipeline in pipelines:
+            self._retire(pipeline)
+        self.pipelines.clear()
+        if self._session:
+            await self._session.close()
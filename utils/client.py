@@ -2,7 +2,6 @@ import asyncio
 import logging
 import sys
 from asyncio import Lock
-from orm import __version__ as orm_version
 from pathlib import Path
 from typing import TYPE_CHECKING, Dict, Optional, Union
 
@@ -13,9 +12,12 @@ import config
 
 if TYPE_CHECKING:
     from asyncio import Task
+    from subprocess import Popen
 
     from uvicorn import Config, Server
 
+    from .ipc import IPCServer
+
 
 __all__ = ("Bot", "bot")
 
@@ -23,11 +25,14 @@ __all__ = ("Bot", "bot")
 # noinspection PyAbstractClass
 class Bot(commands.Bot):
     if TYPE_CHECKING:
-        web: Optional[Dict[str, Union[Server, Config, Task]]]
+        web: Optional[Dict[str, Union[Server, Config, Task, IPCServer, Popen]]]
 
     def __init__(self, intents: discord.Intents, guilds: list[int], extensions: list[str], prefixes: list[str]):
+        from .bridge import BridgeBindCache
         from .console import console
         from .db import registry
+        from .metrics import install_bot_metrics
+        from .migrations import migrate
 
         super().__init__(
             command_prefix=commands.when_mentioned_or(*prefixes),
@@ -37,12 +42,12 @@ class Bot(commands.Bot):
             max_messages=5000,
             case_insensitive=True,
         )
-        if tuple(map(int, orm_version.split("."))) >= (0, 3, 1):
-            self.loop.run_until_complete(registry.create_all())
-        else:
-            registry.create_all()
+        self.loop.run_until_complete(migrate(registry))
+        self.bridge_binds = BridgeBindCache()
+        self.loop.run_until_complete(self.bridge_binds.load())
         self.training_lock = Lock()
         self.started_at = discord.utils.utcnow()
+        install_bot_metrics(self)
         self.console = console
         self.log = log = logging.getLogger("jimmy.client")
         self.debug = log.debug
@@ -76,8 +81,20 @@ class Bot(commands.Bot):
         await super().on_error(event, *args, **kwargs)
 
     async def close(self) -> None:
+        if (sender := getattr(self, "bridge_sender", None)) is not None:
+            # Messages from matrix that are still queued may need the bot's HTTP session to be sent.
+            await sender.close()
         await self.http.close()
-        if getattr(self, "web", None) is not None:
+        if getattr(self, "web", None) is not None and "process" in self.web:
+            self.log.info("Stopping web server processes...")
+            self.web["process"].terminate()
+            try:
+                await asyncio.wait_for(asyncio.to_thread(self.web["process"].wait), timeout=5)
+            except asyncio.TimeoutError:
+                self.web["process"].kill()
+            await self.web["ipc"].close()
+            del self.web
+        elif getattr(self, "web", None) is not None:
             self.log.info("Closing web server...")
             try:
                 await asyncio.wait_for(self.web["server"].shutdown(), timeout=5)
@@ -98,6 +115,16 @@ class Bot(commands.Bot):
         except asyncio.TimeoutError:
             self.log.critical("Timed out while closing, forcing shutdown.")
             sys.exit(1)
+        if (edits := getattr(self, "bridge_edits", None)) is not None:
+            # Edits still being held back to coalesce them are sent rather than lost.
+            edits.flush()
+        if (queue := getattr(self, "bridge_queue", None)) is not None:
+            # The queue writes to disk in the background, so anything still pending is written now.
+            queue.close()
+        from .db import registry
+
+        if registry.database.engine is not None:
+            await registry.database.engine.close()
         self.log.info("Finished shutting down.")
 
 
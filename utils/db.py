@@ -8,7 +8,9 @@ from typing import TYPE_CHECKING, Optional, TypeVar
 
 import discord
 import orm
-from databases import Database
+
+from .model_cache import MODEL_CACHE_TTL, CachedModel
+from .sqlite_engine import TunedDatabase
 
 
 class Tutors(IntEnum):
@@ -32,8 +34,10 @@ __all__ = [
     "Assignments",
     "Tutors",
     "UptimeEntry",
+    "UptimeRollup",
     "JimmyBans",
-    "BridgeBind"
+    "BridgeBind",
+    "IPInfo",
 ]
 
 T = TypeVar("T")
@@ -49,11 +53,23 @@ if Path("/data").exists():
 else:
     _pth = "/main.db"
 
-registry = orm.ModelRegistry(Database("sqlite://" + _pth))
+try:
+    from config import DB_READERS
+except ImportError:
+    DB_READERS = 4
+
+try:
+    from config import DB_PRAGMAS
+except ImportError:
+    DB_PRAGMAS = {}
+
+registry = orm.ModelRegistry(TunedDatabase("sqlite://" + _pth, readers=DB_READERS, pragmas=DB_PRAGMAS))
 
 
 async def get_or_none(model: T, **kw) -> Optional[T_co]:
-    """Returns none or the required thing."""
+    """Returns none or the required thing. Lookups on CachedModel subclasses are served from their cache."""
+    if issubclass(model, CachedModel):
+        return await model.cached_get(**kw)
     try:
         return await model.objects.get(**kw)
     except orm.NoMatch:
@@ -78,7 +94,7 @@ class VerifyCode(orm.Model):
         name: str
 
 
-class Student(orm.Model):
+class Student(CachedModel):
     registry = registry
     tablename = "students"
     fields = {
@@ -100,7 +116,7 @@ class Student(orm.Model):
         access_token_hash: str | None
 
 
-class BannedStudentID(orm.Model):
+class BannedStudentID(CachedModel):
     registry = registry
     tablename = "banned"
     fields = {
@@ -189,6 +205,46 @@ class UptimeEntry(orm.Model):
         notes: str | None
 
 
+class UptimeRollup(orm.Model):
+    tablename = "uptime_rollups"
+    registry = registry
+    fields = {
+        "entry_id": orm.UUID(primary_key=True, default=uuid.uuid4),
+        "target_id": orm.String(min_length=2, max_length=128),
+        # The length of the period in seconds (60, 3600 or 86400), and when it started (unix time).
+        "resolution": orm.Integer(),
+        "bucket": orm.Integer(),
+        "checks": orm.Integer(default=0),
+        "up": orm.Integer(default=0),
+        # Response times (in milliseconds) of successful checks.
+        "response_count": orm.Integer(default=0),
+        "response_sum": orm.Integer(default=0),
+        "response_min": orm.Integer(allow_null=True, default=None),
+        "response_max": orm.Integer(allow_null=True, default=None),
+        "p50": orm.Integer(allow_null=True, default=None),
+        "p95": orm.Integer(allow_null=True, default=None),
+        "p99": orm.Integer(allow_null=True, default=None),
+        # Log-scale histogram of response times, so that rollups can be merged and percentiles estimated.
+        "histogram": orm.JSON(default={}),
+    }
+
+    if TYPE_CHECKING:
+        entry_id: uuid.UUID
+        target_id: str
+        resolution: int
+        bucket: int
+        checks: int
+        up: int
+        response_count: int
+        response_sum: int
+        response_min: int | None
+        response_max: int | None
+        p50: int | None
+        p95: int | None
+        p99: int | None
+        histogram: dict[str, int]
+
+
 class JimmyBans(orm.Model):
     tablename = "jimmy_bans"
     registry = registry
@@ -207,9 +263,11 @@ class JimmyBans(orm.Model):
         until: float | None
 
 
-class AccessTokens(orm.Model):
+class AccessTokens(CachedModel):
     tablename = "access_tokens"
     registry = registry
+    # Tokens are written by the web server, which may be in another process (see WEB_WORKERS).
+    cache_ttl = min(MODEL_CACHE_TTL, 10)
     fields = {
         "entry_id": orm.UUID(primary_key=True, default=uuid.uuid4),
         "user_id": orm.BigInteger(unique=True),
@@ -240,3 +298,20 @@ class BridgeBind(orm.Model):
         matrix_id: str
         discord_id: int
         webhook: str | None
+
+
+class IPInfo(orm.Model):
+    tablename = "ip_info"
+    registry = registry
+    fields = {
+        "entry_id": orm.UUID(primary_key=True, default=uuid.uuid4),
+        "ip": orm.String(max_length=45, unique=True),
+        "data": orm.JSON(),
+        "fetched_at": orm.Float(default=lambda: datetime.datetime.utcnow().timestamp()),
+    }
+
+    if TYPE_CHECKING:
+        entry_id: uuid.UUID
+        ip: str
+        data: dict
+        fetched_at: float
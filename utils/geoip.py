@@ -0,0 +1,80 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable
+
+from .db import IPInfo, get_or_none
+
+__all__ = ("GeoIPCache",)
+
+try:
+    from config import GEOIP_CACHE_TTL
+except ImportError:
+    GEOIP_CACHE_TTL = 7 * 86400
+
+try:
+    from config import GEOIP_CACHE_SIZE
+except ImportError:
+    GEOIP_CACHE_SIZE = 10_000
+
+
+class GeoIPCache:
+    """
+    Caches IP geolocation lookups in the database, so they survive restarts.
+
+    Entries are refreshed once they are older than `ttl` seconds, and the oldest entries are deleted once there are
+    more than `maxsize`. Concurrent lookups of the same IP share a single call to `fetch`, and failed lookups are not
+    cached.
+    """
+
+    def __init__(
+        self,
+        fetch: Callable[[str], Awaitable[dict]],
+        *,
+        ttl: float = GEOIP_CACHE_TTL,
+        maxsize: int = GEOIP_CACHE_SIZE,
+    ):
+        self.fetch = fetch
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.log = logging.getLogger("jimmy.geoip")
+        self._pending: dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get(self, ip: str) -> dict:
+        if task := self._pending.get(ip):
+            self.coalesced += 1
+            return await asyncio.shield(task)
+
+        entry = await get_or_none(IPInfo, ip=ip)
+        if entry and time.time() - entry.fetched_at < self.ttl:
+            self.hits += 1
+            return entry.data
+
+        task = self._pending.get(ip)
+        if task:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = self._pending[ip] = asyncio.create_task(self._refresh(ip))
+            task.add_done_callback(lambda _: self._pending.pop(ip, None))
+        return await asyncio.shield(task)
+
+    async def _refresh(self, ip: str) -> dict:
+        data = await self.fetch(ip)
+        _, created = await IPInfo.objects.update_or_create(ip=ip, defaults={"data": data, "fetched_at": time.time()})
+        if created:
+            await self._evict()
+        return data
+
+    async def _evict(self):
+        excess = await IPInfo.objects.count() - self.maxsize
+        if excess > 0:
+            oldest = await IPInfo.objects.order_by("fetched_at").limit(excess).all()
+            await IPInfo.objects.filter(ip__in=[entry.ip for entry in oldest]).delete()
+            self.log.debug("Evicted %d cached IP lookups.", excess)
+
+    def snapshot(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced, "pending": len(self._pending)}
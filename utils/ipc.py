@@ -0,0 +1,556 @@
+"""
+A local IPC link between the bot and web server processes, for when the web server runs out-of-process.
+
+Messages are newline-delimited JSON objects sent over a Unix socket. The web server sends requests:
+
+* `{"id": n, "method": ..., "params": {...}}` expects a reply: `{"id": n, "result": ...}` or `{"id": n, "error": ...}`.
+  Streaming methods send any number of `{"id": n, "item": ...}` messages before the final reply, and can be stopped
+  early with `{"method": "cancel", "params": {"id": n}}`.
+* `{"method": ..., "params": {...}}` (without an ID) is fire-and-forget.
+
+The bot pushes `{"push": "status", ...}` every few seconds, and `{"push": "binds", ...}` whenever the bridge binds
+change, which is enough for the web server to authenticate, route and validate requests without a round trip.
+"""
+
+import asyncio
+import collections
+import itertools
+import logging
+import os
+import time
+import types
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, AsyncIterator, Optional
+
+import discord
+
+from .bridge import BridgeBindCache, BridgeEvent, BridgeQueue
+from .bridge_media import DEFAULT_FILESIZE_LIMIT, MediaFile
+from .bridge_payload import MessagePayload, dumps, history_payloads, loads
+from .bridge_sender import BridgeSender, paginate
+from .db import _pth, BridgeBind
+from .mirror import BRIDGE_MIRROR_URL, AttachmentMirror
+
+if TYPE_CHECKING:
+    from .client import Bot
+
+__all__ = ("IPC_PATH", "IPCServer", "BotProxy", "RemoteChannel", "RemoteBridgeSender")
+
+try:
+    from config import IPC_PATH
+except ImportError:
+    IPC_PATH = str(Path(_pth).with_name("jimmy.sock"))
+
+# Payloads can be large (e.g. a batch of bridge events), so allow long lines.
+LINE_LIMIT = 16 * 1024 * 1024
+STATUS_INTERVAL = 2
+
+log = logging.getLogger("jimmy.ipc")
+
+
+def _encode(message: dict) -> bytes:
+    return (dumps(message) + "\n").encode()
+
+
+def _bind_to_dict(bind: BridgeBind) -> dict:
+    return {
+        "entry_id": str(bind.entry_id),
+        "matrix_id": bind.matrix_id,
+        "discord_id": bind.discord_id,
+        "webhook": bind.webhook,
+    }
+
+
+def _bind_from_dict(data: dict) -> BridgeBind:
+    return BridgeBind(
+        entry_id=uuid.UUID(data["entry_id"]),
+        matrix_id=data["matrix_id"],
+        discord_id=data["discord_id"],
+        webhook=data["webhook"],
+    )
+
+
+class IPCServer:
+    """The bot's end of the link. Serves requests from any number of web server processes."""
+
+    def __init__(self, bot: "Bot", path: str = IPC_PATH):
+        self.bot = bot
+        self.path = path
+        # Also closed by the bot itself, before its HTTP session (see Bot.close).
+        self.sender = bot.bridge_sender = BridgeSender()
+        self.connections: set[asyncio.StreamWriter] = set()
+        # Consumers subscribed through any web server process: each name may only be connected once.
+        self.consumers: set[str] = set()
+        self.server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self):
+        Path(self.path).unlink(missing_ok=True)
+        # The socket is created with the umask's permissions, so it is only ever reachable by this user, rather than
+        # being open to others until it could be chmodded after binding.
+        umask = os.umask(0o177)
+        try:
+            self.server = await asyncio.start_unix_server(self._handle, self.path, limit=LINE_LIMIT)
+        finally:
+            os.umask(umask)
+        log.info("Listening for web server processes on %s", self.path)
+
+    async def close(self):
+        if self.server:
+            self.server.close()
+        for writer in list(self.connections):
+            writer.close()
+        await self.sender.close()
+        Path(self.path).unlink(missing_ok=True)
+
+    def status(self) -> dict:
+        bot = self.bot
+        queue: Optional[BridgeQueue] = getattr(bot, "bridge_queue", None)
+        channels = {}
+        for channel_id in bot.bridge_binds.routes:
+            if channel := bot.get_channel(channel_id):
+                guild = getattr(channel, "guild", None)
+                channels[channel_id] = guild.filesize_limit if guild else DEFAULT_FILESIZE_LIMIT
+        return {
+            "push": "status",
+            "started_at": bot.started_at.timestamp(),
+            "ready": bot.is_ready(),
+            "latency": bot.latency,
+            "channels": channels,
+            "queue": queue.snapshot() if queue else None,
+            "cursors": queue.cursors() if queue else {},
+            "sender": self.sender.snapshot(),
+        }
+
+    def binds(self) -> dict:
+        return {"push": "binds", "binds": [_bind_to_dict(bind) for bind in self.bot.bridge_binds.by_matrix.values()]}
+
+    def broadcast(self, message: dict):
+        data = _encode(message)
+        for writer in self.connections:
+            writer.write(data)
+
+    async def _push_status(self, writer: asyncio.StreamWriter):
+        while True:
+            writer.write(_encode(self.status()))
+            await writer.drain()
+            await asyncio.sleep(STATUS_INTERVAL)
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections.add(writer)
+        writer.write(_encode(self.binds()))
+        streams: dict[int, asyncio.Task] = {}
+        status = asyncio.create_task(self._push_status(writer))
+        try:
+            while line := await reader.readline():
+                request = loads(line)
+                method, params, request_id = request["method"], request.get("params", {}), request.get("id")
+                if method == "cancel":
+                    if task := streams.pop(params["id"], None):
+                        task.cancel()
+                    continue
+                handler = getattr(self, "rpc_" + method.replace(".", "_"), None)
+                if handler is None:
+                    writer.write(_encode({"id": request_id, "error": f"Unknown method {method!r}"}))
+                    continue
+                task = asyncio.create_task(self._run(writer, request_id, handler, params))
+                if request_id is not None:
+                    streams[request_id] = task
+                    task.add_done_callback(lambda _, key=request_id: streams.pop(key, None))
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+            log.warning("Web server connection lost: %r", e)
+        finally:
+            status.cancel()
+            for task in streams.values():
+                task.cancel()
+            self.connections.discard(writer)
+            writer.close()
+
+    async def _run(self, writer: asyncio.StreamWriter, request_id: Optional[int], handler, params: dict):
+        try:
+            result = handler(**params)
+            if hasattr(result, "__aiter__"):
+                async for item in result:
+                    writer.write(_encode({"id": request_id, "item": item}))
+                    await writer.drain()
+                result = None
+            elif asyncio.iscoroutine(result):
+                result = await result
+            reply = {"id": request_id, "result": result}
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.exception("IPC method %r failed", handler.__name__)
+            reply = {"id": request_id, "error": repr(e)}
+        if request_id is not None:
+            writer.write(_encode(reply))
+            await writer.drain()
+
+    # Methods callable by web server processes
+
+    def rpc_bridge_submit(self, channel: int, author: str, content: str, avatar: str, webhook: str, files: list):
+        target = self.bot.get_channel(channel)
+        media = [MediaFile(Path(path), *rest) for path, *rest in files]
+        if target is None:
+            for file in media:
+                file.close()
+            return 0
+        return self.sender.submit(target, author, content, avatar=avatar, webhook=webhook, files=media)
+
+    def rpc_bridge_ack(self, consumer: str, seq: int):
+        self.bot.bridge_queue.ack(consumer, seq)
+
+    async def rpc_bridge_subscribe(self, consumer: str, cursor: Optional[int]) -> AsyncIterator[list]:
+        # Web workers only know about their own consumers, so this is where names are kept unique.
+        if consumer in self.consumers:
+            raise ValueError(f"Consumer {consumer!r} is already connected.")
+        self.consumers.add(consumer)
+        subscription = self.bot.bridge_queue.subscribe(consumer, cursor)
+        try:
+            # An empty first batch confirms the subscription (see RemoteSubscription.ready).
+            yield []
+            while True:
+                events = await subscription.get(limit=100, timeout=30)
+                if events:
+                    yield [list(event) for event in events]
+        finally:
+            subscription.close()
+            self.consumers.discard(consumer)
+
+    async def rpc_bridge_history(self, channel: int, after: int, limit: int) -> AsyncIterator[dict]:
+        target = self.bot.get_channel(channel)
+        if target is None:
+            return
+        mirror = getattr(self.bot, "attachment_mirror", None)
+        async for payload in history_payloads(target, after=discord.Object(after), limit=limit, mirror=mirror):
+            yield payload.to_event()
+
+    async def rpc_binds_create(self, **kwargs) -> dict:
+        bind = await self.bot.bridge_binds.create(**kwargs)
+        self.broadcast(self.binds())
+        return _bind_to_dict(bind)
+
+    async def rpc_binds_delete(self, matrix_id: str):
+        if bind := self.bot.bridge_binds.get(matrix_id):
+            await self.bot.bridge_binds.delete(bind)
+            self.broadcast(self.binds())
+
+    def rpc_metrics(self) -> str:
+        from .metrics import REGISTRY
+
+        return REGISTRY.render()
+
+
+class BotProxy:
+    """
+    The web server's end of the link, standing in for the Bot (as `app.state.bot`) in web server processes.
+
+    It provides the parts of the bot the web server uses: state the bot pushes (status, binds, the channels that
+    can be bridged to) is available synchronously, and everything else is forwarded to the bot.
+    """
+
+    def __init__(self, path: str = IPC_PATH, token: str = None):
+        if token is None:
+            from config import token
+
+        self.path = path
+        self.http = types.SimpleNamespace(token=token)
+        self.bridge_binds = RemoteBindCache(self)
+        self.bridge_queue = RemoteQueue(self)
+        self.started_at = discord.utils.utcnow()
+        self.latency = float("nan")
+        self.channels: dict[int, int] = {}
+        self._ready = False
+        self._ids = itertools.count(1)
+        self._calls: dict[int, asyncio.Queue] = {}
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._connecting: Optional[asyncio.Task] = None
+        self._synced = asyncio.Event()
+        self.sender_status: dict = {}
+        self.log = logging.getLogger("jimmy.ipc.proxy")
+        # The mirror's index and files are on disk, so both processes can use the same store.
+        self.attachment_mirror = AttachmentMirror() if BRIDGE_MIRROR_URL else None
+
+    def __bool__(self):
+        return self._writer is not None and self._synced.is_set()
+
+    def is_ready(self) -> bool:
+        return bool(self) and self._ready
+
+    async def connect(self, timeout: float = 5) -> bool:
+        """Connects to the bot (if not already connected), returning whether the link is up."""
+        if self._connecting is None or self._connecting.done():
+            self._connecting = asyncio.create_task(self._connect())
+        # Wait until the bot's first status push arrives, or until connecting fails.
+        synced = asyncio.ensure_future(self._synced.wait())
+        try:
+            await asyncio.wait({synced, self._connecting}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            synced.cancel()
+        return bool(self)
+
+    async def _connect(self):
+        try:
+            reader, self._writer = await asyncio.open_unix_connection(self.path, limit=LINE_LIMIT)
+        except OSError as e:
+            self.log.warning("Could not connect to the bot at %s: %r", self.path, e)
+            return
+        self.log.info("Connected to the bot at %s", self.path)
+        try:
+            while line := await reader.readline():
+                self._dispatch(loads(line))
+        except (ConnectionError, ValueError) as e:
+            self.log.warning("Lost connection to the bot: %r", e)
+        finally:
+            self._writer = None
+            self._synced.clear()
+            for queue in self._calls.values():
+                queue.put_nowait({"error": "Lost connection to the bot."})
+
+    def _dispatch(self, message: dict):
+        push = message.get("push")
+        if push == "status":
+            self.started_at = datetime.fromtimestamp(message["started_at"], timezone.utc)
+            self._ready = message["ready"]
+            self.latency = float("nan") if message["latency"] is None else message["latency"]
+            self.channels = {int(channel): limit for channel, limit in message["channels"].items()}
+            self.bridge_queue.update(message["queue"] or {}, message["cursors"])
+            self.sender_status = message["sender"]
+            self._synced.set()
+        elif push == "binds":
+            self.bridge_binds.replace(message["binds"])
+        elif (queue := self._calls.get(message.get("id"))) is not None:
+            queue.put_nowait(message)
+
+    def notify(self, method: str, **params):
+        if self._writer is None:
+            raise ConnectionError("Not connected to the bot.")
+        self._writer.write(_encode({"method": method, "params": params}))
+
+    async def stream(self, method: str, **params) -> AsyncIterator[Any]:
+        """Calls a method on the bot, yielding each item it streams back."""
+        if not await self.connect():
+            raise ConnectionError("Not connected to the bot.")
+        request_id = next(self._ids)
+        queue = self._calls[request_id] = asyncio.Queue()
+        self._writer.write(_encode({"id": request_id, "method": method, "params": params}))
+        finished = False
+        try:
+            while True:
+                message = await queue.get()
+                if "item" in message:
+                    yield message["item"]
+                    continue
+                finished = True
+                if "error" in message:
+                    raise RuntimeError(message["error"])
+                return
+        finally:
+            self._calls.pop(request_id, None)
+            if not finished and self._writer is not None:
+                self.notify("cancel", id=request_id)
+
+    async def call(self, method: str, **params) -> Any:
+        """Calls a method on the bot and returns its result."""
+        if not await self.connect():
+            raise ConnectionError("Not connected to the bot.")
+        request_id = next(self._ids)
+        queue = self._calls[request_id] = asyncio.Queue()
+        try:
+            self._writer.write(_encode({"id": request_id, "method": method, "params": params}))
+            message = await queue.get()
+        finally:
+            self._calls.pop(request_id, None)
+        if "error" in message:
+            raise RuntimeError(message["error"])
+        return message["result"]
+
+    def get_channel(self, channel_id: int) -> Optional["RemoteChannel"]:
+        if channel_id in self.channels:
+            return RemoteChannel(self, channel_id, self.channels[channel_id])
+
+
+class RemoteGuild:
+    def __init__(self, filesize_limit: int):
+        self.filesize_limit = filesize_limit
+
+
+class RemoteChannel:
+    """A channel the bot can bridge messages into, as far as the web server needs to know about it."""
+
+    def __init__(self, proxy: BotProxy, channel_id: int, filesize_limit: int):
+        self.proxy = proxy
+        self.id = channel_id
+        self.guild = RemoteGuild(filesize_limit)
+
+    def __repr__(self):
+        return f"<RemoteChannel id={self.id}>"
+
+    async def history_payloads(self, *, after: int, limit: int) -> AsyncIterator[MessagePayload]:
+        async for payload in self.proxy.stream("bridge.history", channel=self.id, after=after, limit=limit):
+            yield MessagePayload(**payload)
+
+
+class RemoteBindCache(BridgeBindCache):
+    """A copy of the bot's bind cache, kept up to date by the bot. Changes are made through the bot."""
+
+    def __init__(self, proxy: BotProxy):
+        super().__init__()
+        self.proxy = proxy
+
+    def replace(self, binds: list[dict]):
+        self.by_matrix.clear()
+        self.by_discord.clear()
+        self.routes.clear()
+        self.webhooks.clear()
+        self._update_route(self.default_channel)
+        for bind in binds:
+            self._add(_bind_from_dict(bind))
+
+    async def load(self):
+        pass
+
+    async def create(self, **kwargs) -> BridgeBind:
+        bind = _bind_from_dict(await self.proxy.call("binds.create", **kwargs))
+        self._add(bind)
+        return bind
+
+    async def delete(self, bind: BridgeBind):
+        await self.proxy.call("binds.delete", matrix_id=bind.matrix_id)
+        self._remove(bind)
+
+
+class RemoteSubscription:
+    """A consumer's subscription to the bot's bridge queue, streamed over the link."""
+
+    def __init__(self, queue: "RemoteQueue", consumer: str, position: Optional[int]):
+        self.queue = queue
+        self.consumer = consumer
+        self.position = position or 0
+        self.buffer: collections.deque[BridgeEvent] = collections.deque()
+        self._wakeup = asyncio.Event()
+        self._error: Optional[Exception] = None
+        self._ready = asyncio.get_running_loop().create_future()
+        self._task = asyncio.create_task(self._receive(position))
+
+    async def _receive(self, cursor: Optional[int]):
+        try:
+            async for events in self.queue.proxy.stream("bridge.subscribe", consumer=self.consumer, cursor=cursor):
+                if not self._ready.done():
+                    self._ready.set_result(None)
+                if events:
+                    self.buffer.extend(BridgeEvent(*event) for event in events)
+                    self._wakeup.set()
+            raise ConnectionError("The bot ended the subscription.")
+        except Exception as e:
+            self._error = e
+            self._wakeup.set()
+            if not self._ready.done():
+                self._ready.set_result(None)
+
+    async def ready(self):
+        """
+        Waits for the bot to accept the subscription. Raises ConnectionError if the bot can't be reached, or
+        RuntimeError if the consumer is already connected through another web server process.
+        """
+        await asyncio.shield(self._ready)
+        if self._error:
+            raise self._error
+
+    @property
+    def lag(self) -> int:
+        return max(self.queue.head - self.position, 0)
+
+    async def get(self, *, limit: int = 100, timeout: float = None) -> list[BridgeEvent]:
+        if not self.buffer:
+            if self._error:
+                raise self._error
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                return []
+            if self._error and not self.buffer:
+                raise self._error
+        events = [self.buffer.popleft() for _ in range(min(limit, len(self.buffer)))]
+        if events:
+            self.position = events[-1].seq
+        return events
+
+    def snapshot(self) -> dict:
+        return {"position": self.position, "lag": self.lag, "buffered": len(self.buffer)}
+
+    def close(self):
+        self._task.cancel()
+
+
+class RemoteQueue:
+    """Stands in for the bot's BridgeQueue. Statistics come from the bot's status pushes."""
+
+    def __init__(self, proxy: BotProxy):
+        self.proxy = proxy
+        self.status: dict = {}
+        self._cursors: dict[str, int] = {}
+
+    def update(self, status: dict, cursors: dict[str, int]):
+        self.status = status
+        self._cursors = cursors
+
+    @property
+    def head(self) -> int:
+        return self.status.get("head", 0)
+
+    def subscribe(self, consumer: str, position: int = None, **_) -> RemoteSubscription:
+        return RemoteSubscription(self, consumer, position)
+
+    def ack(self, consumer: str, seq: int):
+        self._cursors[consumer] = max(self._cursors.get(consumer, 0), seq)
+        self.proxy.notify("bridge.ack", consumer=consumer, seq=seq)
+
+    def cursor(self, consumer: str = "default") -> int:
+        return self._cursors.get(consumer, 0)
+
+    def qsize(self, consumer: str = "default") -> int:
+        return max(self.head - self.cursor(consumer), 0)
+
+    def snapshot(self) -> dict:
+        return {**self.status, "as_of": time.time()}
+
+
+class RemoteBridgeSender:
+    """Stands in for the BridgeSender, handing messages (and their files, by path) to the bot to send."""
+
+    def __init__(self, proxy: BotProxy):
+        self.proxy = proxy
+
+    def submit(
+        self,
+        channel: RemoteChannel,
+        author: str,
+        content: str,
+        *,
+        avatar: str = None,
+        webhook: str = None,
+        files: list[MediaFile] = (),
+    ) -> int:
+        pages = len(paginate(content))
+        if not pages and not files:
+            return 0
+        self.proxy.notify(
+            "bridge.submit",
+            channel=channel.id,
+            author=author,
+            content=content,
+            avatar=avatar,
+            webhook=webhook,
+            files=[[str(file.path), file.filename, file.size, file.content_type] for file in files],
+        )
+        return pages
+
+    def snapshot(self) -> dict:
+        """The bot's sender statistics, as of its last status push."""
+        return self.proxy.sender_status
+
+    async def close(self):
+        pass
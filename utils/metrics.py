@@ -0,0 +1,297 @@
+import abc
+import bisect
+import math
+import os
+import time
+from typing import TYPE_CHECKING, Callable, Iterator, Optional
+
+import discord
+import httpx
+import psutil
+
+if TYPE_CHECKING:
+    from discord.ext import commands
+
+__all__ = (
+    "Registry",
+    "REGISTRY",
+    "Counter",
+    "Gauge",
+    "Histogram",
+    "install_bot_metrics",
+    "httpx_hooks",
+)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Registry:
+    """A set of metrics, rendered together in the prometheus text exposition format."""
+
+    def __init__(self):
+        self.metrics: dict[str, "Metric"] = {}
+
+    def register(self, metric: "Metric"):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name!r} is already registered.")
+        self.metrics[metric.name] = metric
+
+    def unregister(self, name: str):
+        self.metrics.pop(name, None)
+
+    def render(self, exclude: set[str] = frozenset()) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            if metric.name in exclude:
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class Metric(abc.ABC):
+    """
+    Base class for metrics.
+
+    Metrics are only ever updated from the event loop thread, so updates are plain dict operations, without locks.
+    Label values are passed as a tuple, in the order of `labels`.
+    """
+
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = (), *, registry: Registry = REGISTRY):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        if registry is not None:
+            registry.register(self)
+
+    @abc.abstractmethod
+    def collect(self) -> Iterator[str]:
+        """Yields the lines of the text exposition format for this metric."""
+
+
+class Counter(Metric):
+    """
+    A value that only goes up. If `function` is given, it is called at scrape time instead, and should return the
+    current total (or a dict of label values to totals).
+    """
+
+    type = "counter"
+
+    def __init__(self, *args, function: Callable[[], float | dict] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.function = function
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, labels: tuple = ()):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def _current(self) -> dict[tuple, float]:
+        if self.function is None:
+            return self.values
+        value = self.function()
+        return value if isinstance(value, dict) else {(): value}
+
+    def collect(self) -> Iterator[str]:
+        for labels, value in self._current().items():
+            yield f"{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}"
+
+
+class Gauge(Counter):
+    """A value that can go up and down."""
+
+    type = "gauge"
+
+    def set(self, value: float, labels: tuple = ()):
+        self.values[labels] = value
+
+    def dec(self, amount: float = 1, labels: tuple = ()):
+        self.inc(-amount, labels)
+
+
+class Histogram(Metric):
+    """Counts observations (e.g. durations, in seconds) into cumulative buckets."""
+
+    type = "histogram"
+
+    def __init__(self, *args, buckets: tuple[float, ...] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # label values -> [per-bucket counts (last one is +Inf), sum, count]
+        self.values: dict[tuple, list] = {}
+
+    def observe(self, value: float, labels: tuple = ()):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def time(self, labels: tuple = ()) -> "_Timer":
+        return _Timer(self, labels)
+
+    def collect(self) -> Iterator[str]:
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket
+                le = 'le="%s"' % _format_value(bound)
+                yield f"{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.labels, labels)} {count}"
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: tuple):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *_):
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+
+
+HTTP_CLIENT_REQUESTS = Counter(
+    "jimmy_http_client_requests_total", "Outgoing HTTP requests, by host and status code.", ("host", "status")
+)
+HTTP_CLIENT_DURATION = Histogram(
+    "jimmy_http_client_request_duration_seconds",
+    "Time until the response headers of outgoing HTTP requests arrived, by host.",
+    ("host",),
+)
+COMMANDS = Counter("jimmy_commands_total", "Command invocations, by command and outcome.", ("command", "outcome"))
+COMMAND_DURATION = Histogram("jimmy_command_duration_seconds", "Time taken to run commands.", ("command",))
+
+_process = psutil.Process(os.getpid())
+Gauge("process_resident_memory_bytes", "Resident memory size in bytes.", function=lambda: _process.memory_info().rss)
+Counter(
+    "process_cpu_seconds_total",
+    "Total user and system CPU time spent in seconds.",
+    function=lambda: sum(_process.cpu_times()[:2]),
+)
+Gauge("process_threads", "Number of OS threads in the process.", function=_process.num_threads)
+
+
+async def _on_request(request: httpx.Request):
+    request.extensions["jimmy_started"] = time.perf_counter()
+
+
+async def _on_response(response: httpx.Response):
+    request = response.request
+    started: Optional[float] = request.extensions.get("jimmy_started")
+    if started is not None:
+        HTTP_CLIENT_DURATION.observe(time.perf_counter() - started, (request.url.host,))
+    HTTP_CLIENT_REQUESTS.inc(labels=(request.url.host, str(response.status_code)))
+
+
+def httpx_hooks() -> dict:
+    """Returns `event_hooks` for an httpx.AsyncClient that record request counts and timings."""
+    return {"request": [_on_request], "response": [_on_response]}
+
+
+def _command_name(ctx) -> str:
+    return ctx.command.qualified_name if ctx.command else "unknown"
+
+
+def install_bot_metrics(bot: "commands.Bot", registry: Registry = REGISTRY):
+    """Registers gauges that read from `bot` when scraped, and listeners that time every command."""
+    Gauge(
+        "jimmy_gateway_latency_seconds",
+        "Latency between a gateway heartbeat and its acknowledgement.",
+        function=lambda: bot.latency if math.isfinite(bot.latency) else 0,
+        registry=registry,
+    )
+    Gauge("jimmy_guilds", "Number of guilds the bot is in.", function=lambda: len(bot.guilds), registry=registry)
+    Gauge(
+        "jimmy_cached_messages",
+        "Number of messages in the message cache.",
+        function=lambda: len(bot.cached_messages),
+        registry=registry,
+    )
+    Gauge(
+        "jimmy_uptime_seconds",
+        "Seconds since the bot started.",
+        function=lambda: (discord.utils.utcnow() - bot.started_at).total_seconds(),
+        registry=registry,
+    )
+
+    def queue_stat(key: str) -> Callable[[], dict]:
+        def read():
+            queue = getattr(bot, "bridge_queue", None)
+            return {(): queue.snapshot()[key]} if queue else {}
+
+        return read
+
+    Counter(
+        "jimmy_bridge_events_total",
+        "Events put onto the bridge queue.",
+        function=queue_stat("head"),
+        registry=registry,
+    )
+    Gauge(
+        "jimmy_bridge_memory_events",
+        "Bridge events held in memory.",
+        function=queue_stat("memory_events"),
+        registry=registry,
+    )
+    Counter(
+        "jimmy_bridge_spilled_total",
+        "Bridge events evicted from memory.",
+        function=queue_stat("spilled"),
+        registry=registry,
+    )
+    Counter(
+        "jimmy_bridge_dropped_total",
+        "Bridge events dropped unread.",
+        function=queue_stat("dropped"),
+        registry=registry,
+    )
+
+    def started(ctx):
+        ctx._metrics_started = time.perf_counter()
+
+    def finished(ctx, outcome: str):
+        command = _command_name(ctx)
+        COMMANDS.inc(labels=(command, outcome))
+        if (start := getattr(ctx, "_metrics_started", None)) is not None:
+            COMMAND_DURATION.observe(time.perf_counter() - start, (command,))
+
+    async def on_command(ctx):
+        started(ctx)
+
+    async def on_command_completion(ctx):
+        finished(ctx, "success")
+
+    async def on_command_error(ctx, _):
+        finished(ctx, "error")
+
+    for prefix in ("on_command", "on_application_command"):
+        bot.add_listener(on_command, prefix)
+        bot.add_listener(on_command_completion, prefix + "_completion")
+        bot.add_listener(on_command_error, prefix + "_error")
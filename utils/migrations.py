@@ -0,0 +1,114 @@
+"""
+Versioned schema migrations for the main database.
+
+The applied version is recorded in the `schema_version` table. At startup, `migrate()` compares it with the latest
+migration below, and does nothing else if the schema is already current - `create_all()` only runs for databases
+that haven't reached the version that last added a table.
+
+To change the schema, append a Migration with the next version number. Never edit one that has been released:
+databases that already applied it won't run it again. Adding a model needs a migration with `create_tables=True`,
+adding a column to an existing model needs an `ALTER TABLE ... ADD COLUMN` statement, and data changes can
+be made with `function`.
+"""
+import inspect
+import logging
+import time
+from typing import Awaitable, Callable, NamedTuple, Optional
+
+import orm
+
+__all__ = ("Migration", "MIGRATIONS", "get_version", "migrate")
+
+log = logging.getLogger("jimmy.migrations")
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    statements: tuple[str, ...] = ()
+    # Whether to (re)run create_all() first, to create any tables that don't exist yet.
+    create_tables: bool = False
+    # Run after the statements, in the same transaction, for changes that SQL alone can't express.
+    function: Optional[Callable[[], Awaitable]] = None
+
+
+async def _rebuild_uptime_rollups():
+    from .uptime_rollups import rebuild_rollups
+
+    await rebuild_rollups()
+
+
+MIGRATIONS: tuple[Migration, ...] = (
+    Migration(1, "Create tables", create_tables=True),
+    Migration(
+        2,
+        "Add secondary indexes",
+        (
+            "CREATE INDEX IF NOT EXISTS ix_uptime_target_id_timestamp ON uptime (target_id, timestamp)",
+            "CREATE INDEX IF NOT EXISTS ix_uptime_timestamp ON uptime (timestamp)",
+            "CREATE INDEX IF NOT EXISTS ix_jimmy_bans_user_id_until ON jimmy_bans (user_id, until)",
+            "CREATE INDEX IF NOT EXISTS ix_bridge_binds_discord_id ON bridge_binds (discord_id)",
+            "CREATE INDEX IF NOT EXISTS ix_access_tokens_expires ON access_tokens (expires)",
+            "CREATE INDEX IF NOT EXISTS ix_ip_info_fetched_at ON ip_info (fetched_at)",
+        ),
+    ),
+    Migration(
+        3,
+        "Add uptime rollups",
+        (
+            "CREATE UNIQUE INDEX IF NOT EXISTS ux_uptime_rollups_key ON uptime_rollups (target_id, resolution, bucket)",
+            "CREATE INDEX IF NOT EXISTS ix_uptime_rollups_resolution_bucket ON uptime_rollups (resolution, bucket)",
+        ),
+        create_tables=True,
+        function=_rebuild_uptime_rollups,
+    ),
+)
+
+_VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER PRIMARY KEY,
+    description TEXT NOT NULL,
+    applied_at REAL NOT NULL
+)
+"""
+
+
+async def get_version(registry: orm.ModelRegistry) -> int:
+    """Returns the schema version the database is at, or 0 if it has never been migrated."""
+    exists = await registry.database.fetch_val(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'"
+    )
+    if not exists:
+        return 0
+    return await registry.database.fetch_val("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+
+
+async def migrate(registry: orm.ModelRegistry, migrations: tuple[Migration, ...] = MIGRATIONS) -> int:
+    """Applies every migration newer than the database's schema version, in order. Returns the new version."""
+    database = registry.database
+    current = await get_version(registry)
+    pending = [migration for migration in migrations if migration.version > current]
+    if not pending:
+        log.debug("Database schema is current (version %d).", current)
+        return current
+
+    if any(migration.create_tables for migration in pending):
+        result = registry.create_all()
+        # orm < 0.3.1 creates tables synchronously.
+        if inspect.isawaitable(result):
+            await result
+
+    await database.execute(_VERSION_TABLE)
+    for migration in sorted(pending, key=lambda m: m.version):
+        log.info("Migrating database schema to version %d: %s", migration.version, migration.description)
+        async with database.transaction():
+            for statement in migration.statements:
+                await database.execute(statement)
+            if migration.function is not None:
+                await migration.function()
+            await database.execute(
+                "INSERT INTO schema_version (version, description, applied_at) VALUES (:version, :description, :now)",
+                {"version": migration.version, "description": migration.description, "now": time.time()},
+            )
+        current = migration.version
+    return current
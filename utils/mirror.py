@@ -0,0 +1,299 @@
+import asyncio
+import hashlib
+import logging
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import NamedTuple, Optional
+from urllib.parse import quote
+
+import httpx
+
+from .db import _pth
+from .metrics import httpx_hooks
+
+__all__ = ("BRIDGE_MIRROR_URL", "MirroredFile", "AttachmentMirror")
+
+try:
+    from config import BRIDGE_MIRROR_PATH
+except ImportError:
+    BRIDGE_MIRROR_PATH = Path(_pth).with_name("mirror")
+
+try:
+    from config import BRIDGE_MIRROR_SIZE
+except ImportError:
+    BRIDGE_MIRROR_SIZE = 2 * 1024 ** 3
+
+try:
+    from config import BRIDGE_MIRROR_URL
+except ImportError:
+    try:
+        from config import OAUTH_REDIRECT_URI
+    except ImportError:
+        OAUTH_REDIRECT_URI = None
+    # Served by the web server, next to the OAuth callback (see web/server.py)
+    BRIDGE_MIRROR_URL = OAUTH_REDIRECT_URI[:-4] + "bridge/media" if OAUTH_REDIRECT_URI else None
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS attachments (
+    id INTEGER PRIMARY KEY,
+    url TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    content_type TEXT,
+    sha256 TEXT
+);
+CREATE TABLE IF NOT EXISTS objects (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS attachments_sha256 ON attachments (sha256);
+CREATE INDEX IF NOT EXISTS objects_last_used ON objects (last_used);
+"""
+
+
+class MirroredFile(NamedTuple):
+    path: Path
+    sha256: str
+    size: int
+    filename: str
+    content_type: str
+
+
+class AttachmentMirror:
+    """
+    A local, size-capped, content-addressed copy of bridged attachments.
+
+    Attachments are registered (by their discord ID) when they are bridged, and downloaded in the background
+    straight to disk - or, for attachments registered lazily (such as those in backfilled history), the first time
+    they are requested. Files are stored under their SHA-256, so the same file posted twice is only stored once.
+    When the store grows past `max_size` bytes, the least recently served files are deleted, along with the index
+    entries of the attachments that pointed at them.
+
+    The index and the files are only touched from worker threads, so mirroring never blocks the event loop.
+    Mirrored files are served by the web server at `{base_url}/{attachment_id}/{filename}`.
+    """
+
+    def __init__(
+        self,
+        root: str | Path = BRIDGE_MIRROR_PATH,
+        max_size: int = BRIDGE_MIRROR_SIZE,
+        *,
+        base_url: Optional[str] = BRIDGE_MIRROR_URL,
+        concurrency: int = 2,
+    ):
+        self.root = Path(root)
+        self.base_url = base_url
+        self.objects = self.root / "objects"
+        self.objects.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.log = logging.getLogger("jimmy.bridge.mirror")
+        self.http = httpx.AsyncClient(
+            timeout=httpx.Timeout(30, connect=10), follow_redirects=True, event_hooks=httpx_hooks()
+        )
+        self._db = sqlite3.connect(self.root / "index.db", isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(_SCHEMA)
+        (self.total_size,) = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()
+        self._downloads: dict[int, asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+        # Registrations not yet written to the index, by attachment ID.
+        self._pending: dict[int, tuple[int, str, str, Optional[str]]] = {}
+        self._flushing: Optional[asyncio.Task] = None
+        self._evicting = asyncio.Lock()
+        self.downloaded = 0
+        self.evicted = 0
+
+    def path_for(self, sha256: str) -> Path:
+        return self.objects / sha256[:2] / sha256
+
+    def register(
+        self, attachment_id: int, url: str, filename: str, content_type: str = None, *, lazy: bool = False
+    ) -> str:
+        """
+        Records where an attachment can be downloaded from and, unless `lazy`, starts mirroring it in the
+        background. Returns the URL the mirrored copy will be (or can be) served at.
+        """
+        self._pending[attachment_id] = (attachment_id, url, filename, content_type)
+        if self._flushing is None:
+            self._flushing = asyncio.create_task(self._flush())
+        if not lazy:
+            self._start_download(attachment_id)
+        return f"{self.base_url}/{attachment_id}/{quote(filename)}"
+
+    async def _flush(self):
+        """Writes pending registrations to the index, in batches."""
+        try:
+            while self._pending:
+                rows = dict(self._pending)
+                await asyncio.to_thread(
+                    self._db.executemany,
+                    "INSERT OR IGNORE INTO attachments (id, url, filename, content_type) VALUES (?, ?, ?, ?)",
+                    list(rows.values()),
+                )
+                for attachment_id, row in rows.items():
+                    if self._pending.get(attachment_id) == row:
+                        del self._pending[attachment_id]
+        finally:
+            self._flushing = None
+
+    def _start_download(self, attachment_id: int) -> asyncio.Task:
+        task = self._downloads.get(attachment_id)
+        if task is None:
+            task = self._downloads[attachment_id] = asyncio.create_task(self._download(attachment_id))
+            task.add_done_callback(lambda _: self._downloads.pop(attachment_id, None))
+        return task
+
+    def _lookup(self, attachment_id: int) -> Optional[MirroredFile]:
+        # Runs in a worker thread.
+        row = self._db.execute(
+            "SELECT a.sha256, o.size, a.filename, a.content_type FROM attachments a "
+            "JOIN objects o ON o.sha256 = a.sha256 WHERE a.id = ?",
+            (attachment_id,),
+        ).fetchone()
+        if row is None:
+            return
+        sha256, size, filename, content_type = row
+        path = self.path_for(sha256)
+        if not path.exists():
+            return
+        return MirroredFile(path, sha256, size, filename, content_type or "application/octet-stream")
+
+    def _source(self, attachment_id: int) -> Optional[str]:
+        # Runs in a worker thread.
+        row = self._db.execute("SELECT url FROM attachments WHERE id = ?", (attachment_id,)).fetchone()
+        return row[0] if row else None
+
+    def _store(self, temp: Path, sha256: str, size: int) -> bool:
+        """Moves a downloaded file into the store and indexes it. Returns whether it was new. Runs in a thread."""
+        path = self.path_for(sha256)
+        path.parent.mkdir(exist_ok=True)
+        new = not path.exists()
+        if new:
+            temp.replace(path)
+        self._db.execute(
+            "INSERT OR REPLACE INTO objects (sha256, size, last_used) VALUES (?, ?, ?)", (sha256, size, time.time())
+        )
+        return new
+
+    async def _download(self, attachment_id: int) -> Optional[MirroredFile]:
+        if mirrored := await asyncio.to_thread(self._lookup, attachment_id):
+            return mirrored
+        if attachment_id in self._pending:
+            url = self._pending[attachment_id][1]
+        else:
+            url = await asyncio.to_thread(self._source, attachment_id)
+        if url is None:
+            return
+
+        temp = self.root / f".{attachment_id}.{os.urandom(4).hex()}.part"
+        digest = hashlib.sha256()
+        size = 0
+        file = None
+        try:
+            async with self._semaphore, self.http.stream("GET", url) as response:
+                response.raise_for_status()
+                if int(response.headers.get("Content-Length", 0)) > self.max_size:
+                    self.log.warning("Attachment %s is too large to mirror.", attachment_id)
+                    return
+                file = await asyncio.to_thread(temp.open, "wb")
+                async for chunk in response.aiter_bytes(65536):
+                    size += len(chunk)
+                    if size > self.max_size:
+                        self.log.warning("Attachment %s is too large to mirror.", attachment_id)
+                        return
+                    await asyncio.to_thread(_write_chunk, file, digest, chunk)
+            await asyncio.to_thread(file.close)
+            sha256 = digest.hexdigest()
+            if await asyncio.to_thread(self._store, temp, sha256, size):
+                self.total_size += size
+                self.downloaded += 1
+        except httpx.HTTPError as e:
+            self.log.warning("Failed to mirror attachment %s: %r", attachment_id, e)
+            return
+        finally:
+            if file is not None and not file.closed:
+                await asyncio.to_thread(file.close)
+            await asyncio.to_thread(temp.unlink, missing_ok=True)
+        if self._flushing is not None:
+            # The attachment's own row has to be in the index before it can point at the file.
+            await asyncio.shield(self._flushing)
+        await asyncio.to_thread(
+            self._db.execute, "UPDATE attachments SET sha256 = ? WHERE id = ?", (sha256, attachment_id)
+        )
+        await self._evict()
+        return await asyncio.to_thread(self._lookup, attachment_id)
+
+    def _evict_sync(self) -> tuple[int, int]:
+        """
+        Deletes the least recently used files until the store fits into `max_size` again, returning how many were
+        deleted and the store's size afterwards. Runs in a worker thread.
+
+        The size is read from the index rather than trusted from memory, as web workers (see utils/ipc.py) download
+        into the same store, and the index is locked for writing throughout so that they don't evict in parallel.
+        """
+        count = 0
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            (size,) = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()
+            while size > self.max_size:
+                row = self._db.execute("SELECT sha256, size FROM objects ORDER BY last_used LIMIT 1").fetchone()
+                if row is None:
+                    break
+                sha256, object_size = row
+                self.path_for(sha256).unlink(missing_ok=True)
+                self._db.execute("DELETE FROM objects WHERE sha256 = ?", (sha256,))
+                # Discord's CDN links expire, so there is no point keeping the attachments around to download again.
+                self._db.execute("DELETE FROM attachments WHERE sha256 = ?", (sha256,))
+                count += 1
+                size -= object_size
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        return count, size
+
+    async def _evict(self):
+        """Deletes the least recently used files until the store fits into `max_size` again."""
+        async with self._evicting:
+            count, self.total_size = await asyncio.to_thread(self._evict_sync)
+            self.evicted += count
+
+    async def get(self, attachment_id: int) -> Optional[MirroredFile]:
+        """
+        Returns the mirrored copy of an attachment, downloading it first if needed.
+        Concurrent requests for the same attachment share a single download.
+        """
+        mirrored = await asyncio.to_thread(self._lookup, attachment_id)
+        if mirrored is None:
+            mirrored = await asyncio.shield(self._start_download(attachment_id))
+        if mirrored is not None:
+            await asyncio.to_thread(
+                self._db.execute,
+                "UPDATE objects SET last_used = ? WHERE sha256 = ?",
+                (time.time(), mirrored.sha256),
+            )
+        return mirrored
+
+    def snapshot(self) -> dict:
+        return {
+            "size": self.total_size,
+            "max_size": self.max_size,
+            "downloaded": self.downloaded,
+            "evicted": self.evicted,
+            "downloading": len(self._downloads),
+        }
+
+    async def close(self):
+        for task in self._downloads.values():
+            task.cancel()
+        if self._flushing is not None:
+            await self._flushing
+        await self.http.aclose()
+        self._db.close()
+
+
+def _write_chunk(file, digest, chunk: bytes):
+    digest.update(chunk)
+    file.write(chunk)
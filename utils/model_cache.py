@@ -0,0 +1,195 @@
+"""
+An opt-in read-through cache for `get_or_none` lookups.
+
+Models opt in by subclassing CachedModel instead of orm.Model. Lookups are cached by their keyword arguments
+(including lookups that found nothing), and the model's whole cache is dropped whenever a row of it is written
+through orm: `create`, `update`, `delete`, `get_or_create` and `update_or_create`, on querysets or instances.
+
+Writes made by another process (such as web workers, see utils/ipc.py) or with raw SQL don't invalidate the
+cache, so entries also expire after `cache_ttl` seconds.
+"""
+import collections
+import copy
+import time
+from typing import Any, Hashable, Optional
+
+import orm
+from orm.models import QuerySet
+
+from .metrics import Counter, Gauge
+
+__all__ = ("ModelCache", "CachedQuerySet", "CachedModel", "MODEL_CACHES")
+
+try:
+    from config import MODEL_CACHE_TTL
+except ImportError:
+    MODEL_CACHE_TTL = 60
+
+try:
+    from config import MODEL_CACHE_SIZE
+except ImportError:
+    MODEL_CACHE_SIZE = 1024
+
+_MISSING = object()
+
+# model name -> cache, for metrics and stats
+MODEL_CACHES: dict[str, "ModelCache"] = {}
+
+
+class ModelCache:
+    """
+    A TTL'd LRU of lookup results for one model.
+
+    `generation` is bumped on every invalidation, so that a lookup which raced with a write (read the old row,
+    then the write invalidated the cache) doesn't put the stale row back.
+    """
+
+    def __init__(self, name: str, *, ttl: float = MODEL_CACHE_TTL, maxsize: int = MODEL_CACHE_SIZE):
+        self.name = name
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._entries: collections.OrderedDict[Hashable, tuple[float, Any]] = collections.OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def key(lookup: dict) -> Optional[Hashable]:
+        """The cache key for a lookup, or None if its values can't be hashed (so it can't be cached)."""
+        key = tuple(sorted(lookup.items()))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key: Hashable) -> Any:
+        """Returns the cached result (which may be None), or _MISSING."""
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= time.monotonic():
+            self.misses += 1
+            return _MISSING
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: Hashable, value: Any, generation: int):
+        if generation != self.generation or self.ttl <= 0:
+            return
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self):
+        self._entries.clear()
+        self.generation += 1
+        self.invalidations += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def snapshot(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+class CachedQuerySet(QuerySet):
+    """A QuerySet that invalidates its model's cache after every write."""
+
+    def _invalidate(self):
+        self.model_cls.cache.invalidate()
+
+    async def create(self, **kwargs):
+        try:
+            return await super().create(**kwargs)
+        finally:
+            self._invalidate()
+
+    async def update(self, **kwargs) -> None:
+        try:
+            await super().update(**kwargs)
+        finally:
+            self._invalidate()
+
+    async def delete(self) -> None:
+        try:
+            await super().delete()
+        finally:
+            self._invalidate()
+
+
+class CachedModel(orm.Model):
+    """
+    Base class for models whose `get_or_none` lookups are cached. Subclasses can set `cache_ttl` and `cache_size`.
+
+    Instances returned from the cache are copies, so changing one without saving it doesn't change the cache.
+    """
+
+    objects = CachedQuerySet()
+    cache_ttl: float = MODEL_CACHE_TTL
+    cache_size: int = MODEL_CACHE_SIZE
+    cache: ModelCache
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.cache = MODEL_CACHES[cls.__name__] = ModelCache(cls.__name__, ttl=cls.cache_ttl, maxsize=cls.cache_size)
+
+    async def update(self, **kwargs):
+        try:
+            await super().update(**kwargs)
+        finally:
+            self.cache.invalidate()
+
+    async def delete(self) -> None:
+        try:
+            await super().delete()
+        finally:
+            self.cache.invalidate()
+
+    @classmethod
+    async def cached_get(cls, **lookup) -> Optional["CachedModel"]:
+        """Like `objects.get(**lookup)`, but returns None rather than raising NoMatch, and reads through the cache."""
+        key = ModelCache.key(lookup)
+        if key is not None:
+            result = cls.cache.get(key)
+            if result is not _MISSING:
+                return copy.copy(result)
+        generation = cls.cache.generation
+        try:
+            result = await cls.objects.get(**lookup)
+        except orm.NoMatch:
+            result = None
+        if key is not None:
+            cls.cache.put(key, result, generation)
+        return copy.copy(result)
+
+
+def _cache_stat(name: str):
+    def read():
+        return {(model, ): getattr(cache, name) for model, cache in MODEL_CACHES.items()}
+
+    return read
+
+
+Counter(
+    "jimmy_model_cache_hits_total", "get_or_none lookups answered from the cache.", ("model",),
+    function=_cache_stat("hits"),
+)
+Counter(
+    "jimmy_model_cache_misses_total", "get_or_none lookups that went to the database.", ("model",),
+    function=_cache_stat("misses"),
+)
+Counter(
+    "jimmy_model_cache_invalidations_total", "Times a model's cache was dropped after a write.", ("model",),
+    function=_cache_stat("invalidations"),
+)
+Gauge(
+    "jimmy_model_cache_entries", "Lookups currently cached.", ("model",),
+    function=lambda: {(model, ): len(cache) for model, cache in MODEL_CACHES.items()},
+)
@@ -0,0 +1,331 @@
+"""
+A `databases` backend for SQLite that keeps its connections open and tunes them.
+
+The stock backend opens a fresh connection (and a fresh thread) for every query and runs it with SQLite's
+defaults: a rollback journal, a full fsync on every commit, and a 2 MiB page cache. Here, every write goes through
+one long-lived writer connection, and reads are spread over a pool of read-only connections. In WAL mode readers
+don't block the writer or each other, so web requests, ban checks and bind lookups no longer wait on one another.
+"""
+import asyncio
+import collections
+import contextlib
+import logging
+import sqlite3
+from typing import AsyncIterator, Optional
+
+import aiosqlite
+from databases import Database
+from databases.backends.sqlite import SQLiteBackend, SQLiteConnection, SQLiteTransaction
+from sqlalchemy.engine.cursor import CursorResultMetaData
+from sqlalchemy.engine.row import Row
+
+__all__ = ("DEFAULT_PRAGMAS", "SQLiteEngine", "TunedSQLiteBackend", "TunedDatabase")
+
+DEFAULT_PRAGMAS = {
+    "journal_mode": "wal",
+    # In WAL mode, NORMAL only syncs at checkpoints: a power cut may lose the last few commits, but never corrupts.
+    "synchronous": "normal",
+    "busy_timeout": 5000,
+    "mmap_size": 256 * 1024 * 1024,
+    # Negative values are in KiB rather than pages.
+    "cache_size": -16 * 1024,
+    "temp_store": "memory",
+}
+# These change the database file itself (or only matter when writing), so only the writer sets them.
+WRITER_PRAGMAS = frozenset({"journal_mode", "synchronous", "auto_vacuum", "page_size"})
+
+
+class SQLiteEngine:
+    """
+    One writer connection and up to `readers` read-only connections to the database at `path`, each set up with
+    `pragmas` (over DEFAULT_PRAGMAS) when it is opened.
+
+    Connections are opened lazily, and reopened after `close()`. In-memory databases can't be shared between
+    connections, so they get no readers and read through the writer.
+    """
+
+    def __init__(self, path: str, *, readers: int = 4, pragmas: Optional[dict] = None, **options):
+        self.path = path
+        self.readers = 0 if path in ("", ":memory:") else max(readers, 0)
+        self.pragmas = {**DEFAULT_PRAGMAS, **(pragmas or {})}
+        self.options = options
+        self.log = logging.getLogger("jimmy.db")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._idle: list[aiosqlite.Connection] = []
+        self._waiters: collections.deque[asyncio.Future] = collections.deque()
+        self._open_readers = 0
+
+    def _bind(self):
+        """
+        Sets up the locks for the running event loop.
+
+        create_all() runs on a throwaway loop in some setups, and asyncio primitives (and futures waiting on the
+        connections' threads) belong to a single loop, so switching loops starts over with fresh connections.
+        """
+        loop = asyncio.get_running_loop()
+        if loop is self._loop:
+            return
+        for connection in [self._writer, *self._idle]:
+            if connection is not None:
+                connection.stop()
+        self._loop = loop
+        self._writer = None
+        self._idle = []
+        self._waiters = collections.deque()
+        self._open_readers = 0
+        self._write_lock = asyncio.Lock()
+
+    async def _open(self, readonly: bool) -> aiosqlite.Connection:
+        connection = aiosqlite.connect(self.path, isolation_level=None, **self.options)
+        # These connections are meant to live as long as the process, so they mustn't hold up interpreter exit if
+        # nothing got around to closing them (older aiosqlite connections are threads themselves).
+        getattr(connection, "_thread", connection).daemon = True
+        await connection
+        for name, value in self.pragmas.items():
+            if readonly and name in WRITER_PRAGMAS:
+                continue
+            await connection.execute(f"PRAGMA {name}={value}")
+        if readonly:
+            await connection.execute("PRAGMA query_only=ON")
+        self.log.debug("Opened %s connection to %s.", "read-only" if readonly else "writer", self.path)
+        return connection
+
+    async def _get_writer(self) -> aiosqlite.Connection:
+        if self._writer is None:
+            self._writer = await self._open(readonly=False)
+        return self._writer
+
+    @contextlib.asynccontextmanager
+    async def writer(self) -> AsyncIterator[aiosqlite.Connection]:
+        self._bind()
+        async with self._write_lock:
+            yield await self._get_writer()
+
+    async def acquire_reader(self) -> aiosqlite.Connection:
+        """
+        Takes an idle reader, opening one if fewer than `readers` are open, or waits for one to be released.
+        Taking an idle reader doesn't await anything, which keeps the overhead of each read to a minimum.
+        """
+        self._bind()
+        if self._idle:
+            return self._idle.pop()
+        if self._open_readers < self.readers:
+            self._open_readers += 1
+            try:
+                if self._writer is None:
+                    # The writer switches the database to WAL, which read-only connections can't do themselves.
+                    async with self.writer():
+                        pass
+                return await self._open(readonly=True)
+            except BaseException:
+                self._open_readers -= 1
+                raise
+        waiter = self._loop.create_future()
+        self._waiters.append(waiter)
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            # Cancelled after being handed a connection: pass it on rather than losing it.
+            if waiter.done() and not waiter.cancelled():
+                self.release_reader(waiter.result())
+            raise
+
+    def release_reader(self, connection: aiosqlite.Connection):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(connection)
+                return
+        self._idle.append(connection)
+
+    @contextlib.asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        if not self.readers:
+            async with self.writer() as connection:
+                yield connection
+            return
+        connection = await self.acquire_reader()
+        try:
+            yield connection
+        finally:
+            self.release_reader(connection)
+
+    async def close(self):
+        """Closes every open connection. The engine can still be used afterwards, and reconnects as needed."""
+        if self._loop is None:
+            return
+        connections = [self._writer, *self._idle] if self._writer else self._idle
+        self._writer = None
+        self._idle = []
+        self._open_readers = 0
+        for connection in connections:
+            await connection.close()
+
+    def snapshot(self) -> dict:
+        return {"readers": self._open_readers, "idle_readers": len(self._idle), "writer": self._writer is not None}
+
+
+def _fetch(connection: sqlite3.Connection, sql: str, args: list, one: bool) -> tuple[tuple, list]:
+    """Runs a query and fetches its rows in one go, on the connection's thread."""
+    cursor = connection.execute(sql, args)
+    try:
+        rows = cursor.fetchmany(1) if one else cursor.fetchall()
+        return cursor.description, rows
+    finally:
+        cursor.close()
+
+
+def _execute(connection: sqlite3.Connection, sql: str, args: list) -> int:
+    cursor = connection.execute(sql, args)
+    try:
+        # Like the stock backend: the new row's ID for inserts, otherwise the number of rows changed.
+        return cursor.rowcount if cursor.lastrowid == 0 else cursor.lastrowid
+    finally:
+        cursor.close()
+
+
+class TunedSQLiteConnection(SQLiteConnection):
+    """
+    Borrows a connection from the engine for each query (a reader for SELECTs, the writer for anything else),
+    rather than holding one for as long as the `databases` connection is acquired. Transactions hold the writer
+    from BEGIN until they finish.
+    """
+
+    def __init__(self, engine: SQLiteEngine, dialect):
+        super().__init__(engine, dialect)
+        self._engine = engine
+        self._pinned: Optional[contextlib.AsyncExitStack] = None
+
+    async def acquire(self) -> None:
+        pass
+
+    async def release(self) -> None:
+        pass
+
+    @contextlib.asynccontextmanager
+    async def _use(self, write: bool):
+        if self._pinned is not None:
+            yield
+            return
+        async with self._engine.writer() if write else self._engine.reader() as connection:
+            self._connection = connection
+            try:
+                yield
+            finally:
+                self._connection = None
+
+    async def _run(self, write: bool, function, *args):
+        """
+        Calls `function(connection, *args)` on a borrowed connection's thread.
+
+        aiosqlite makes a round trip to that thread for each of execute, fetch and close, so running them together
+        takes a third of the hand-offs. Reads skip the context managers `_use` goes through, as they add up too.
+        """
+        if self._pinned is not None:
+            return await self._connection._execute(function, self._connection._conn, *args)
+        if write or not self._engine.readers:
+            async with self._engine.writer() as connection:
+                return await connection._execute(function, connection._conn, *args)
+        connection = await self._engine.acquire_reader()
+        try:
+            return await connection._execute(function, connection._conn, *args)
+        finally:
+            self._engine.release_reader(connection)
+
+    async def _fetch(self, query, one: bool) -> list[Row]:
+        query_str, args, context = self._compile(query)
+        description, rows = await self._run(getattr(query, "is_dml", False), _fetch, query_str, args, one)
+        if not rows:
+            return []
+        metadata = CursorResultMetaData(context, description)
+        return [Row(metadata, metadata._processors, metadata._keymap, Row._default_key_style, row) for row in rows]
+
+    async def fetch_all(self, query):
+        return await self._fetch(query, one=False)
+
+    async def fetch_one(self, query):
+        rows = await self._fetch(query, one=True)
+        return rows[0] if rows else None
+
+    async def execute(self, query):
+        query_str, args, context = self._compile(query)
+        return await self._run(True, _execute, query_str, args)
+
+    async def execute_many(self, queries):
+        async with self._use(write=True):
+            for query in queries:
+                query_str, args, context = self._compile(query)
+                await self._connection._execute(_execute, self._connection._conn, query_str, args)
+
+    async def iterate(self, query):
+        async with self._use(write=getattr(query, "is_dml", False)):
+            async for record in super().iterate(query):
+                yield record
+
+    def transaction(self) -> "TunedSQLiteTransaction":
+        return TunedSQLiteTransaction(self)
+
+    async def _pin(self):
+        self._pinned = contextlib.AsyncExitStack()
+        try:
+            self._connection = await self._pinned.enter_async_context(self._engine.writer())
+        except BaseException:
+            self._pinned = None
+            raise
+
+    async def _unpin(self):
+        pinned, self._pinned = self._pinned, None
+        self._connection = None
+        if pinned is not None:
+            await pinned.aclose()
+
+
+class TunedSQLiteTransaction(SQLiteTransaction):
+    _connection: TunedSQLiteConnection
+
+    async def start(self, is_root: bool, extra_options: dict) -> None:
+        if is_root:
+            await self._connection._pin()
+        try:
+            await super().start(is_root, extra_options)
+        except BaseException:
+            if is_root:
+                await self._connection._unpin()
+            raise
+
+    async def commit(self) -> None:
+        try:
+            await super().commit()
+        finally:
+            if self._is_root:
+                await self._connection._unpin()
+
+    async def rollback(self) -> None:
+        try:
+            await super().rollback()
+        finally:
+            if self._is_root:
+                await self._connection._unpin()
+
+
+class TunedSQLiteBackend(SQLiteBackend):
+    def __init__(self, database_url, *, readers: int = 4, pragmas: Optional[dict] = None, **options):
+        super().__init__(database_url, **options)
+        self.engine = SQLiteEngine(self._database_url.database, readers=readers, pragmas=pragmas, **options)
+
+    async def disconnect(self) -> None:
+        await self.engine.close()
+
+    def connection(self) -> TunedSQLiteConnection:
+        return TunedSQLiteConnection(self.engine, self._dialect)
+
+
+class TunedDatabase(Database):
+    """A `databases.Database` that uses TunedSQLiteBackend for sqlite:// URLs. Extra keyword arguments go to it."""
+
+    SUPPORTED_BACKENDS = {**Database.SUPPORTED_BACKENDS, "sqlite": __name__ + ":TunedSQLiteBackend"}
+
+    @property
+    def engine(self) -> Optional[SQLiteEngine]:
+        return getattr(self._backend, "engine", None)
@@ -0,0 +1,125 @@
+import abc
+import collections
+import secrets
+import time
+from typing import Optional
+
+import redis.asyncio
+
+__all__ = ("StateStore", "MemoryStateStore", "RedisStateStore", "create_state_store")
+
+try:
+    from config import REDIS_URL
+except ImportError:
+    REDIS_URL = None
+
+try:
+    from config import OAUTH_STATE_TTL
+except ImportError:
+    OAUTH_STATE_TTL = 300
+
+try:
+    from config import OAUTH_STATE_MAX
+except ImportError:
+    OAUTH_STATE_MAX = 10_000
+
+
+class StateStore(abc.ABC):
+    """
+    Holds short-lived, single-use tokens (such as pending OAuth states) and the value each one was issued for.
+
+    Tokens expire `ttl` seconds after they are issued, and at most `maxsize` are kept at once; once full, the tokens
+    closest to expiring are evicted to make room.
+    """
+
+    def __init__(self, *, ttl: float = OAUTH_STATE_TTL, maxsize: int = OAUTH_STATE_MAX):
+        self.ttl = ttl
+        self.maxsize = maxsize
+
+    @abc.abstractmethod
+    async def put(self, token: str, value: str):
+        """Stores a token and its value."""
+
+    @abc.abstractmethod
+    async def pop(self, token: str) -> Optional[str]:
+        """Consumes a token, returning its value, or None if it doesn't exist or has expired."""
+
+    async def issue(self, value: str = "") -> str:
+        """Issues a new token for `value`."""
+        token = secrets.token_urlsafe()
+        await self.put(token, value)
+        return token
+
+
+class MemoryStateStore(StateStore):
+    """
+    Keeps tokens in memory. As every token lives for the same `ttl`, insertion order is expiry order, so expired
+    tokens are always at the front and can be dropped without scanning the rest.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self._tokens: collections.OrderedDict[str, tuple[float, str]] = collections.OrderedDict()
+
+    def _expire(self, now: float):
+        while self._tokens:
+            expires, _ = next(iter(self._tokens.values()))
+            if expires > now:
+                break
+            self._tokens.popitem(last=False)
+
+    async def put(self, token: str, value: str):
+        now = time.monotonic()
+        self._expire(now)
+        self._tokens[token] = (now + self.ttl, value)
+        self._tokens.move_to_end(token)
+        while len(self._tokens) > self.maxsize:
+            self._tokens.popitem(last=False)
+
+    async def pop(self, token: str) -> Optional[str]:
+        self._expire(time.monotonic())
+        entry = self._tokens.pop(token, None)
+        return entry[1] if entry else None
+
+    def __len__(self):
+        return len(self._tokens)
+
+
+class RedisStateStore(StateStore):
+    """
+    Keeps tokens in redis, so that several web workers can share them. Each token is a key that expires on its own,
+    and a sorted set (scored by expiry) is used to enforce the size cap.
+    """
+
+    def __init__(self, redis, prefix: str, **kwargs):
+        super().__init__(**kwargs)
+        self.redis = redis
+        self.prefix = prefix
+        self.index = prefix + ":index"
+
+    async def put(self, token: str, value: str):
+        now = time.time()
+        await self.redis.zremrangebyscore(self.index, "-inf", now)
+        await self.redis.set(self.prefix + ":" + token, value, px=max(int(self.ttl * 1000), 1))
+        await self.redis.zadd(self.index, {token: now + self.ttl})
+        excess = await self.redis.zcard(self.index) - self.maxsize
+        if excess > 0:
+            evicted = await self.redis.zpopmin(self.index, excess)
+            await self.redis.delete(*(self.prefix + ":" + self._decode(evicted_token) for evicted_token, _ in evicted))
+
+    async def pop(self, token: str) -> Optional[str]:
+        value = await self.redis.getdel(self.prefix + ":" + token)
+        if value is not None:
+            await self.redis.zrem(self.index, token)
+            return self._decode(value)
+
+    @staticmethod
+    def _decode(value: str | bytes) -> str:
+        return value.decode() if isinstance(value, bytes) else value
+
+
+def create_state_store(prefix: str, **kwargs) -> StateStore:
+    """Returns a redis-backed store if REDIS_URL is configured, and an in-memory one otherwise."""
+    if REDIS_URL:
+        return RedisStateStore(redis.asyncio.from_url(REDIS_URL), "jimmy:" + prefix, **kwargs)
+    return MemoryStateStore(**kwargs)
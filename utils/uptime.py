@@ -0,0 +1,254 @@
+"""
+Probes HTTP and TCP targets on a schedule and records the results as UptimeEntry rows.
+
+Targets are configured with UPTIME_TARGETS in config.py, as URLs (`https://example.com`, `tcp://example.com:25565`)
+or dicts with `url` and optionally `id`, `interval` and `timeout`. Every target is probed by its own task, with the
+interval jittered so that probes don't line up. Results are buffered and inserted with one multi-row INSERT per
+flush, either every UPTIME_FLUSH_INTERVAL seconds or once UPTIME_BATCH_SIZE results are waiting.
+"""
+import asyncio
+import logging
+import math
+import random
+import time
+import uuid
+from typing import Iterable, NamedTuple, Optional
+from urllib.parse import urlparse
+
+import httpx
+import sqlalchemy
+
+from .db import UptimeEntry, registry
+from .metrics import httpx_hooks
+from .uptime_rollups import pick_resolution, prune, rollup_stats, update_rollups
+
+__all__ = ("UPTIME_TARGETS", "UptimeTarget", "UptimeChecker", "percentile", "uptime_stats", "uptime_report")
+
+try:
+    from config import UPTIME_TARGETS
+except ImportError:
+    UPTIME_TARGETS = []
+
+try:
+    from config import UPTIME_INTERVAL
+except ImportError:
+    UPTIME_INTERVAL = 60
+
+try:
+    from config import UPTIME_TIMEOUT
+except ImportError:
+    UPTIME_TIMEOUT = 10
+
+try:
+    from config import UPTIME_JITTER
+except ImportError:
+    UPTIME_JITTER = 0.1
+
+try:
+    from config import UPTIME_FLUSH_INTERVAL
+except ImportError:
+    UPTIME_FLUSH_INTERVAL = 15
+
+try:
+    from config import UPTIME_BATCH_SIZE
+except ImportError:
+    UPTIME_BATCH_SIZE = 100
+
+# How often raw rows and rollups past their retention are deleted.
+PRUNE_INTERVAL = 3600
+
+
+class UptimeTarget(NamedTuple):
+    id: str
+    url: str
+    interval: float = UPTIME_INTERVAL
+    timeout: float = UPTIME_TIMEOUT
+
+    @classmethod
+    def parse(cls, entry: str | dict) -> "UptimeTarget":
+        """Builds a target from an UPTIME_TARGETS entry. The ID defaults to the URL's host (and port)."""
+        if isinstance(entry, str):
+            entry = {"url": entry}
+        parsed = urlparse(entry["url"])
+        if parsed.scheme not in ("http", "https", "tcp"):
+            raise ValueError(f"Unsupported uptime target {entry['url']!r}: must be http(s):// or tcp://")
+        if parsed.scheme == "tcp" and not parsed.port:
+            raise ValueError(f"TCP uptime target {entry['url']!r} needs a port.")
+        return cls(
+            id=str(entry.get("id") or parsed.netloc)[:128],
+            url=entry["url"],
+            interval=float(entry.get("interval", UPTIME_INTERVAL)),
+            timeout=float(entry.get("timeout", UPTIME_TIMEOUT)),
+        )
+
+
+class ProbeResult(NamedTuple):
+    is_up: bool
+    # Milliseconds until the response headers (or the TCP handshake) arrived. None if the probe failed.
+    response_time: Optional[int]
+    notes: Optional[str] = None
+
+
+class UptimeChecker:
+    def __init__(
+        self,
+        targets: list[UptimeTarget],
+        *,
+        jitter: float = UPTIME_JITTER,
+        flush_interval: float = UPTIME_FLUSH_INTERVAL,
+        batch_size: int = UPTIME_BATCH_SIZE,
+        http: Optional[httpx.AsyncClient] = None,
+    ):
+        self.targets = {target.id: target for target in targets}
+        self.jitter = jitter
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.http = http or httpx.AsyncClient(follow_redirects=True, event_hooks=httpx_hooks())
+        self.log = logging.getLogger("jimmy.uptime")
+        self.latest: dict[str, tuple[float, ProbeResult]] = {}
+        self._buffer: list[dict] = []
+        self._flush_now = asyncio.Event()
+        self.flushed = 0
+
+    async def probe(self, target: UptimeTarget) -> ProbeResult:
+        start = time.perf_counter()
+        try:
+            async with asyncio.timeout(target.timeout):
+                if target.url.startswith("tcp://"):
+                    parsed = urlparse(target.url)
+                    _, writer = await asyncio.open_connection(parsed.hostname, parsed.port)
+                    writer.close()
+                    status = None
+                else:
+                    # Only wait for the headers; the body doesn't say anything more about whether it's up.
+                    async with self.http.stream("GET", target.url, timeout=target.timeout) as response:
+                        status = response.status_code
+        except asyncio.TimeoutError:
+            return ProbeResult(False, None, f"Timed out after {target.timeout:g}s")
+        except (httpx.HTTPError, OSError) as e:
+            return ProbeResult(False, None, f"{type(e).__name__}: {e}"[:1024])
+        elapsed = round((time.perf_counter() - start) * 1000)
+        if status is not None and status >= 400:
+            return ProbeResult(False, elapsed, f"HTTP {status}")
+        return ProbeResult(True, elapsed)
+
+    def record(self, target: UptimeTarget, result: ProbeResult, timestamp: Optional[float] = None):
+        timestamp = timestamp or time.time()
+        self.latest[target.id] = (timestamp, result)
+        self._buffer.append(
+            {
+                "entry_id": uuid.uuid4(),
+                "target_id": target.id,
+                "target": target.url[:128],
+                "is_up": result.is_up,
+                "timestamp": timestamp,
+                "response_time": result.response_time,
+                "notes": result.notes,
+            }
+        )
+        if len(self._buffer) >= self.batch_size:
+            self._flush_now.set()
+
+    async def flush(self):
+        """Writes every buffered result with multi-row INSERTs, and folds them into the rollups."""
+        rows, self._buffer = self._buffer, []
+        if not rows:
+            return
+        try:
+            async with registry.database.transaction():
+                # Chunked to stay well under SQLite's limit on bound parameters (7 per row).
+                for start in range(0, len(rows), 1000):
+                    await registry.database.execute(
+                        UptimeEntry.objects.table.insert().values(rows[start:start + 1000])
+                    )
+                await update_rollups(rows)
+        except Exception:
+            self.log.exception("Failed to write %d uptime results, will retry.", len(rows))
+            # Keep them for the next flush, but don't let a broken database grow the buffer forever.
+            self._buffer = (rows + self._buffer)[-self.batch_size * 10:]
+            return
+        self.flushed += len(rows)
+
+    async def _check_forever(self, target: UptimeTarget):
+        # Spread the first round of probes over the interval, rather than firing them all at once.
+        await asyncio.sleep(random.uniform(0, target.interval))
+        while True:
+            started = time.monotonic()
+            self.record(target, await self.probe(target))
+            delay = target.interval * (1 + random.uniform(-self.jitter, self.jitter))
+            await asyncio.sleep(max(delay - (time.monotonic() - started), 0))
+
+    async def _flush_forever(self):
+        next_prune = time.monotonic()
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            await self.flush()
+            if time.monotonic() >= next_prune:
+                next_prune = time.monotonic() + PRUNE_INTERVAL
+                try:
+                    await prune()
+                except Exception:
+                    self.log.exception("Failed to prune old uptime data.")
+
+    async def run(self):
+        """Probes every target until cancelled, then writes whatever is still buffered."""
+        try:
+            await asyncio.gather(self._flush_forever(), *map(self._check_forever, self.targets.values()))
+        finally:
+            await self.flush()
+            await self.http.aclose()
+
+    async def stats(self, window: float) -> dict[str, dict]:
+        """Like `uptime_report`, but includes results that haven't been written yet and the latest probe."""
+        await self.flush()
+        results = await uptime_report(self.targets.values(), window)
+        for target_id, (timestamp, result) in self.latest.items():
+            results[target_id].update(last_checked=timestamp, is_up=result.is_up, notes=result.notes)
+        return results
+
+
+def percentile(values: list[float], q: float) -> Optional[float]:
+    """The nearest-rank `q`th percentile of already sorted `values`."""
+    if not values:
+        return None
+    return values[max(math.ceil(q / 100 * len(values)) - 1, 0)]
+
+
+async def uptime_stats(target_id: str, since: float) -> dict:
+    """
+    Availability and response times (in milliseconds) for one target, since `since`.
+
+    Short windows are read from raw rows. Longer ones are read from rollups (see `pick_resolution`), whose
+    percentiles are estimates; `resolution` in the result says which was used.
+    """
+    resolution = pick_resolution(time.time() - since)
+    if resolution is not None:
+        return await rollup_stats(target_id, since, resolution)
+    table = UptimeEntry.objects.table
+    query = sqlalchemy.select(table.c.is_up, table.c.response_time).where(
+        table.c.target_id == target_id, table.c.timestamp >= since
+    )
+    rows = await registry.database.fetch_all(query)
+    up = sum(1 for is_up, _ in rows if is_up)
+    times = sorted(response_time for is_up, response_time in rows if is_up and response_time is not None)
+    return {
+        "checks": len(rows),
+        "availability": up / len(rows) if rows else None,
+        "min": times[0] if times else None,
+        "avg": round(sum(times) / len(times)) if times else None,
+        "max": times[-1] if times else None,
+        "p50": percentile(times, 50),
+        "p95": percentile(times, 95),
+        "p99": percentile(times, 99),
+        "resolution": None,
+    }
+
+
+async def uptime_report(targets: Iterable[UptimeTarget], window: float) -> dict[str, dict]:
+    """`uptime_stats` for each target over the last `window` seconds, keyed by target ID."""
+    since = time.time() - window
+    return {target.id: {"url": target.url, **await uptime_stats(target.id, since)} for target in targets}
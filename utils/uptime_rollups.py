@@ -0,0 +1,297 @@
+"""
+Per-minute, per-hour and per-day rollups of uptime checks, and retention for raw UptimeEntry rows.
+
+Rollups are updated in the same transaction that writes the raw rows (see UptimeChecker.flush), so every raw row
+is rolled up as soon as it exists, and can be pruned once it is older than UPTIME_RAW_RETENTION. Response times
+are kept as a log-scale histogram (each bin ~10% wide) alongside count/sum/min/max, so that rollups can be merged
+into longer periods and percentiles estimated from them to within about 5%.
+"""
+import logging
+import math
+import time
+import uuid
+from typing import Iterable, Optional
+
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from .db import UptimeRollup, registry
+
+__all__ = (
+    "RESOLUTIONS",
+    "UPTIME_RAW_RETENTION",
+    "UPTIME_ROLLUP_RETENTION",
+    "Rollup",
+    "update_rollups",
+    "rebuild_rollups",
+    "prune",
+    "pick_resolution",
+    "rollup_stats",
+)
+
+RESOLUTIONS = (60, 3600, 86400)
+
+try:
+    from config import UPTIME_RAW_RETENTION
+except ImportError:
+    UPTIME_RAW_RETENTION = 2 * 86400
+
+try:
+    from config import UPTIME_ROLLUP_RETENTION
+except ImportError:
+    UPTIME_ROLLUP_RETENTION = {60: 7 * 86400, 3600: 90 * 86400, 86400: None}
+
+# Each histogram bin covers response times up to GROWTH times the previous bin's upper bound.
+GROWTH = 1.1
+# Reads aim for at most this many rollups per target; longer windows use a coarser resolution.
+MAX_ROWS = 500
+# Windows up to this long are answered from raw rows, which give exact percentiles.
+RAW_WINDOW = 6 * 3600
+# Rows deleted per statement when pruning, so that pruning a large backlog doesn't hold the writer for long.
+PRUNE_BATCH = 5000
+
+log = logging.getLogger("jimmy.uptime.rollups")
+
+
+def histogram_bin(response_time: int) -> int:
+    return 0 if response_time <= 1 else math.ceil(math.log(response_time, GROWTH))
+
+
+class Rollup:
+    """Aggregated checks for one target over one period."""
+
+    __slots__ = ("checks", "up", "count", "total", "minimum", "maximum", "histogram")
+
+    def __init__(self):
+        self.checks = 0
+        self.up = 0
+        self.count = 0
+        self.total = 0
+        self.minimum: Optional[int] = None
+        self.maximum: Optional[int] = None
+        self.histogram: dict[int, int] = {}
+
+    def add(self, is_up: bool, response_time: Optional[int]):
+        self.checks += 1
+        if not is_up:
+            return
+        self.up += 1
+        if response_time is not None:
+            self.count += 1
+            self.total += response_time
+            self.minimum = response_time if self.minimum is None else min(self.minimum, response_time)
+            self.maximum = response_time if self.maximum is None else max(self.maximum, response_time)
+            index = histogram_bin(response_time)
+            self.histogram[index] = self.histogram.get(index, 0) + 1
+
+    def merge(self, other: "Rollup"):
+        self.checks += other.checks
+        self.up += other.up
+        self.count += other.count
+        self.total += other.total
+        if other.minimum is not None:
+            self.minimum = other.minimum if self.minimum is None else min(self.minimum, other.minimum)
+            self.maximum = other.maximum if self.maximum is None else max(self.maximum, other.maximum)
+        for index, count in other.histogram.items():
+            self.histogram[index] = self.histogram.get(index, 0) + count
+
+    def percentile(self, q: float) -> Optional[int]:
+        """Estimates the nearest-rank `q`th percentile response time from the histogram."""
+        if not self.count:
+            return None
+        rank = max(math.ceil(q / 100 * self.count), 1)
+        seen = 0
+        for index in sorted(self.histogram):
+            seen += self.histogram[index]
+            if seen >= rank:
+                return min(max(round(GROWTH**index), self.minimum), self.maximum)
+        return self.maximum
+
+    @classmethod
+    def from_row(cls, row) -> "Rollup":
+        rollup = cls()
+        rollup.checks = row["checks"]
+        rollup.up = row["up"]
+        rollup.count = row["response_count"]
+        rollup.total = row["response_sum"]
+        rollup.minimum = row["response_min"]
+        rollup.maximum = row["response_max"]
+        rollup.histogram = {int(index): count for index, count in (row["histogram"] or {}).items()}
+        return rollup
+
+    def to_row(self, target_id: str, resolution: int, bucket: int) -> dict:
+        return {
+            "entry_id": uuid.uuid4(),
+            "target_id": target_id,
+            "resolution": resolution,
+            "bucket": bucket,
+            "checks": self.checks,
+            "up": self.up,
+            "response_count": self.count,
+            "response_sum": self.total,
+            "response_min": self.minimum,
+            "response_max": self.maximum,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+            "histogram": {str(index): count for index, count in self.histogram.items()},
+        }
+
+    def snapshot(self) -> dict:
+        return {
+            "checks": self.checks,
+            "availability": self.up / self.checks if self.checks else None,
+            "min": self.minimum,
+            "avg": round(self.total / self.count) if self.count else None,
+            "max": self.maximum,
+            "p50": self.percentile(50),
+            "p95": self.percentile(95),
+            "p99": self.percentile(99),
+        }
+
+
+def _chunks(items: list, size: int) -> Iterable[list]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+async def update_rollups(rows: list[dict]):
+    """
+    Folds raw check results (dicts with target_id, is_up, timestamp and response_time) into every resolution's
+    rollups. Should be called inside the transaction that writes the rows, so that the read-modify-write of
+    existing rollups can't interleave with another.
+    """
+    rollups: dict[tuple[str, int, int], Rollup] = {}
+    for row in rows:
+        for resolution in RESOLUTIONS:
+            key = (row["target_id"], resolution, int(row["timestamp"] // resolution * resolution))
+            if key not in rollups:
+                rollups[key] = Rollup()
+            rollups[key].add(row["is_up"], row["response_time"])
+    if not rollups:
+        return
+
+    table = UptimeRollup.objects.table
+    # Fetch the existing rollups with one range query per target and resolution, rather than one per key.
+    ranges: dict[tuple[str, int], tuple[int, int]] = {}
+    for target_id, resolution, bucket in rollups:
+        low, high = ranges.get((target_id, resolution), (bucket, bucket))
+        ranges[(target_id, resolution)] = (min(low, bucket), max(high, bucket))
+    for (target_id, resolution), (low, high) in ranges.items():
+        query = table.select().where(
+            table.c.target_id == target_id, table.c.resolution == resolution, table.c.bucket.between(low, high)
+        )
+        for existing in await registry.database.fetch_all(query):
+            if rollup := rollups.get((target_id, resolution, existing["bucket"])):
+                rollup.merge(Rollup.from_row(existing))
+
+    values = [rollup.to_row(*key) for key, rollup in rollups.items()]
+    for chunk in _chunks(values, 500):
+        statement = sqlite_insert(table).values(chunk)
+        statement = statement.on_conflict_do_update(
+            index_elements=["target_id", "resolution", "bucket"],
+            set_={
+                name: statement.excluded[name]
+                for name in chunk[0]
+                if name not in ("entry_id", "target_id", "resolution", "bucket")
+            },
+        )
+        await registry.database.execute(statement)
+
+
+async def rebuild_rollups(batch_size: int = 10_000):
+    """Rolls up every raw row already in the database. Used once, when rollups are introduced."""
+    last = 0
+    total = 0
+    while True:
+        rows = await registry.database.fetch_all(
+            "SELECT rowid, target_id, is_up, timestamp, response_time FROM uptime "
+            "WHERE rowid > :last ORDER BY rowid LIMIT :limit",
+            {"last": last, "limit": batch_size},
+        )
+        if not rows:
+            break
+        await update_rollups(
+            [
+                {"target_id": row[1], "is_up": bool(row[2]), "timestamp": row[3], "response_time": row[4]}
+                for row in rows
+            ]
+        )
+        last = rows[-1][0]
+        total += len(rows)
+    if total:
+        log.info("Rolled up %d existing uptime checks.", total)
+
+
+async def _delete_batched(where: str, values: dict, table: str) -> int:
+    deleted = 0
+    while True:
+        async with registry.database.transaction():
+            await registry.database.execute(
+                f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {where} LIMIT {PRUNE_BATCH})",
+                values,
+            )
+            count = await registry.database.fetch_val("SELECT changes()")
+        deleted += count
+        if count < PRUNE_BATCH:
+            return deleted
+
+
+async def prune(
+    now: Optional[float] = None,
+    *,
+    raw_retention: Optional[float] = UPTIME_RAW_RETENTION,
+    rollup_retention: dict[int, Optional[float]] = UPTIME_ROLLUP_RETENTION,
+) -> dict[str, int]:
+    """Deletes raw rows and rollups past their retention (None keeps them forever). Returns how many went."""
+    now = now or time.time()
+    deleted = {}
+    if raw_retention is not None:
+        deleted["raw"] = await _delete_batched("timestamp < :cutoff", {"cutoff": now - raw_retention}, "uptime")
+    for resolution, retention in rollup_retention.items():
+        if retention is not None:
+            deleted[str(resolution)] = await _delete_batched(
+                "resolution = :resolution AND bucket < :cutoff",
+                {"resolution": resolution, "cutoff": now - retention},
+                "uptime_rollups",
+            )
+    if any(deleted.values()):
+        log.info("Pruned old uptime data: %r", deleted)
+    return deleted
+
+
+def pick_resolution(
+    window: float,
+    *,
+    raw_retention: Optional[float] = UPTIME_RAW_RETENTION,
+    rollup_retention: dict[int, Optional[float]] = UPTIME_ROLLUP_RETENTION,
+) -> Optional[int]:
+    """
+    The resolution to read a `window` (in seconds) from: None for raw rows if the window is short enough, otherwise
+    the finest resolution that covers the window in at most MAX_ROWS rollups and still keeps that much history.
+    """
+    if window <= RAW_WINDOW and (raw_retention is None or window <= raw_retention):
+        return None
+    for resolution in RESOLUTIONS:
+        retention = rollup_retention.get(resolution)
+        if window / resolution <= MAX_ROWS and (retention is None or window <= retention):
+            return resolution
+    return RESOLUTIONS[-1]
+
+
+async def rollup_stats(target_id: str, since: float, resolution: int) -> dict:
+    """
+    Merges a target's rollups at `resolution` since `since`. The period `since` falls into is included whole, so
+    the result may cover up to one extra period.
+    """
+    table = UptimeRollup.objects.table
+    rows = await registry.database.fetch_all(
+        table.select().where(
+            table.c.target_id == target_id,
+            table.c.resolution == resolution,
+            table.c.bucket >= int(since // resolution * resolution),
+        )
+    )
+    total = Rollup()
+    for row in rows:
+        total.merge(Rollup.from_row(row))
+    return {**total.snapshot(), "resolution": resolution}
@@ -0,0 +1,21 @@
+"""
+Runs the web server on its own, in one or more worker processes, talking to the bot over IPC (see utils/ipc.py).
+
+main.py starts this automatically when WEB_WORKERS is set in config.py.
+"""
+import os
+
+import uvicorn
+
+import config
+from utils.ipc import IPC_PATH
+
+if __name__ == "__main__":
+    os.environ.setdefault("JIMMY_IPC_PATH", IPC_PATH)
+    uvicorn.run(
+        "web.server:app",
+        host=getattr(config, "HTTP_HOST", "127.0.0.1"),
+        port=getattr(config, "HTTP_PORT", 3762),
+        workers=max(getattr(config, "WEB_WORKERS", 1), 1),
+        **getattr(config, "UVICORN_CONFIG", {}),
+    )
@@ -1,28 +1,45 @@
 import asyncio
+import contextlib
 import ipaddress
 import logging
 import os
-import textwrap
-import secrets
 from asyncio import Lock
 from datetime import datetime, timezone
 from hashlib import sha512
 from http import HTTPStatus
 from pathlib import Path
-from typing import Optional, Annotated
-from discord.ext.commands import Paginator
+from typing import Optional, Annotated, Literal
+from urllib.parse import quote
 
 import discord
 import httpx
-from fastapi import FastAPI, HTTPException, Request, status, Depends, Query
+from fastapi import FastAPI, HTTPException, Header, Request, status, Depends, Query
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials as HTTPAuthCreds
 from fastapi import WebSocketException as _WSException
-from fastapi.responses import HTMLResponse, JSONResponse, RedirectResponse
+from fastapi.responses import (
+    HTMLResponse,
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
+from starlette.datastructures import UploadFile
 from starlette.websockets import WebSocket, WebSocketDisconnect
 from websockets.exceptions import WebSocketException
 
-from utils import get_or_none, BridgeBind
+from utils import get_or_none, BridgeBind, metrics
+from utils.bridge import BRIDGE_CHANNEL, BridgeEvent, BridgeQueue, BridgeStats, BridgeSubscription
+from utils.bridge_payload import CompactEncoder, dumps, history_payloads
+from utils import bridge_media as media
+from utils.bridge_media import DEFAULT_FILESIZE_LIMIT, MediaFile
+from utils.bridge_sender import BridgeSender
 from utils.db import AccessTokens
+from utils.geoip import GeoIPCache
+from utils.ipc import BotProxy, RemoteBridgeSender, RemoteChannel, RemoteSubscription
+from utils.state_store import create_state_store
+from utils.uptime import UPTIME_TARGETS, UptimeTarget, uptime_report
+from utils.mirror import AttachmentMirror
 
 SF_ROOT = Path(__file__).parent / "static"
 if SF_ROOT.exists() and SF_ROOT.is_dir():
@@ -41,6 +58,11 @@ try:
 except ImportError:
     WEB_ROOT_PATH = ""
 
+try:
+    from config import WEB_OUTBOUND_CONCURRENCY
+except ImportError:
+    WEB_OUTBOUND_CONCURRENCY = 8
+
 log = logging.getLogger("jimmy.api")
 
 GENERAL = "https://discord.com/channels/994710566612500550/"
@@ -49,23 +71,75 @@ OAUTH_ENABLED = OAUTH_ID and OAUTH_SECRET and OAUTH_REDIRECT_URI
 
 app = FastAPI(root_path=WEB_ROOT_PATH)
 app.state.bot = None
-app.state.states = {}
-app.state.binds = {}
-app.state.http = httpx.Client()
+# Pending OAuth states: for logins, and for binding matrix accounts (mapped to the matrix ID being bound)
+app.state.states = create_state_store("oauth")
+app.state.binds = create_state_store("binds")
+# Each upstream host gets its own connection pool, so a slow ip-api can't hold up token exchanges with discord.
+app.state.discord_http = httpx.AsyncClient(
+    base_url="https://discord.com/api",
+    http2=True,
+    timeout=httpx.Timeout(10, connect=5),
+    limits=httpx.Limits(max_connections=10, max_keepalive_connections=5),
+    event_hooks=metrics.httpx_hooks(),
+)
+app.state.ip_http = httpx.AsyncClient(
+    base_url="http://ip-api.com",  # the free tier is http only
+    timeout=httpx.Timeout(5, connect=3),
+    limits=httpx.Limits(max_connections=4, max_keepalive_connections=2),
+    event_hooks=metrics.httpx_hooks(),
+)
+# Caps how many of these requests are in flight at once, so a burst of logins can't crowd out the bot.
+app.state.outbound = asyncio.Semaphore(WEB_OUTBOUND_CONCURRENCY)
 security = HTTPBearer()
 
 if StaticFiles:
     app.mount("/static", StaticFiles(directory=SF_ROOT), name="static")
 
-try:
-    from utils.client import bot
-
-    app.state.bot = bot
-except ImportError:
-    bot = None
-app.state.last_sender = None
-app.state.last_sender_ts = datetime.utcnow()
-app.state.ws_connected = Lock()
+if os.environ.get("JIMMY_IPC_PATH"):
+    # Running in a separate process from the bot (see web/__main__.py), talking to it over IPC.
+    bot = app.state.bot = BotProxy(os.environ["JIMMY_IPC_PATH"])
+    app.state.bridge_sender = RemoteBridgeSender(bot)
+else:
+    try:
+        from utils.client import bot
+
+        app.state.bot = bot
+    except ImportError:
+        bot = None
+    app.state.bridge_sender = BridgeSender()
+    if bot is not None:
+        # So that the bot can send whatever is still queued when it shuts down (see Bot.close).
+        bot.bridge_sender = app.state.bridge_sender
+app.state.bridge_http = httpx.AsyncClient(
+    timeout=httpx.Timeout(30, connect=10), follow_redirects=True, event_hooks=metrics.httpx_hooks()
+)
+app.state.bridge_consumers = {}
+app.state.bridge_stats = {}
+
+metrics.Counter(
+    "jimmy_bridge_delivered_events_total",
+    "Bridge events delivered to each consumer.",
+    ("consumer",),
+    function=lambda: {(consumer,): stats.events for consumer, stats in app.state.bridge_stats.items()},
+)
+metrics.Gauge(
+    "jimmy_bridge_consumer_lag",
+    "Bridge events not yet acknowledged by each consumer.",
+    ("consumer",),
+    function=lambda: {
+        (consumer,): app.state.bot.bridge_queue.qsize(consumer) for consumer in app.state.bridge_stats
+    },
+)
+metrics.Gauge(
+    "jimmy_bridge_consumers_connected",
+    "Connected bridge consumers.",
+    function=lambda: len(app.state.bridge_consumers),
+)
+metrics.Counter(
+    "jimmy_bridge_send_failures_total",
+    "Messages from matrix that could not be sent to discord.",
+    function=lambda: {(): app.state.bridge_sender.snapshot().get("failed", 0)},
+)
 
 
 async def is_authenticated(credentials: Annotated[HTTPAuthCreds, Depends(security)]):
@@ -73,39 +147,77 @@ async def is_authenticated(credentials: Annotated[HTTPAuthCreds, Depends(securit
         raise HTTPException(status_code=401, detail="Invalid secret.")
 
 
+@contextlib.asynccontextmanager
+async def _outbound_slot(timeout: float = 10):
+    """Waits for a free outbound request slot, answering 503 if none frees up within `timeout` seconds."""
+    try:
+        await asyncio.wait_for(app.state.outbound.acquire(), timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(503, "Too many requests in progress, try again shortly.", headers={"Retry-After": "10"})
+    try:
+        yield
+    except httpx.TimeoutException as e:
+        raise HTTPException(504, "Upstream request timed out: %r" % e)
+    finally:
+        app.state.outbound.release()
+
+
 async def get_access_token(code: str, redirect_uri: str = OAUTH_REDIRECT_URI):
-    response = app.state.http.post(
-        "https://discord.com/api/oauth2/token",
-        data={
-            "grant_type": "authorization_code",
-            "code": code,
-            "redirect_uri": redirect_uri,
-        },
-        headers={"Content-Type": "application/x-www-form-urlencoded"},
-        auth=(OAUTH_ID, OAUTH_SECRET)
-    )
+    async with _outbound_slot():
+        response = await app.state.discord_http.post(
+            "/oauth2/token",
+            data={
+                "grant_type": "authorization_code",
+                "code": code,
+                "redirect_uri": redirect_uri,
+            },
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+            auth=(OAUTH_ID, OAUTH_SECRET)
+        )
     response.raise_for_status()
     return response.json()
 
 
 async def get_authorised_user(access_token: str):
-    response = app.state.http.get(
-        "https://discord.com/api/users/@me",
-        headers={"Authorization": "Bearer " + access_token}
-    )
+    async with _outbound_slot():
+        response = await app.state.discord_http.get(
+            "/users/@me",
+            headers={"Authorization": "Bearer " + access_token}
+        )
     response.raise_for_status()
     return response.json()
 
 
+async def get_ip_info(host: str) -> dict:
+    async with _outbound_slot():
+        response = await app.state.ip_http.get(
+            f"/json/{host}", params={"fields": "status,city,zip,lat,lon,isp,query,proxy,hosting"}
+        )
+    if response.status_code != 200:
+        raise HTTPException(status_code=response.status_code, detail=response.text)
+    data = response.json()
+    if data["status"] != "success":
+        raise HTTPException(
+            status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
+            detail=f"Failed to get IP data for {host}: {data}.",
+        )
+    return data
+
+
+app.state.geoip = GeoIPCache(get_ip_info)
+
+
 @app.middleware("http")
 async def check_bot_instanced(request, call_next):
+    if isinstance(request.app.state.bot, BotProxy):
+        await request.app.state.bot.connect()
     if not request.app.state.bot:
         return JSONResponse(status_code=503, content={"message": "Not ready."}, headers={"Retry-After": "10"})
     return await call_next(request)
 
 
 @app.get("/ping")
-def ping():
+async def ping():
     bot_started = datetime.now(tz=timezone.utc) - app.state.bot.started_at
     return {
         "ping": "pong",
@@ -115,36 +227,41 @@ def ping():
     }
 
 
+@app.get("/metrics", dependencies=[Depends(is_authenticated)])
+async def metrics_endpoint():
+    """Exports metrics for prometheus."""
+    text = ""
+    if isinstance(app.state.bot, BotProxy):
+        # The bot's own metrics, followed by the ones only this process knows about.
+        text = await app.state.bot.call("metrics")
+    exclude = {line.split()[2] for line in text.splitlines() if line.startswith("# TYPE ")}
+    text += metrics.REGISTRY.render(exclude=exclude)
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/uptime", dependencies=[Depends(is_authenticated)])
+async def uptime(window: float = Query(86400, gt=0, le=90 * 86400), target: Optional[str] = None):
+    """Returns the availability and p50/p95/p99 response times (in milliseconds) of each monitored target."""
+    if checker := getattr(app.state.bot, "uptime_checker", None):
+        stats = await checker.stats(window)
+    else:
+        # The checker runs in the bot's process, so results it hasn't written to the database yet are missing.
+        stats = await uptime_report(map(UptimeTarget.parse, UPTIME_TARGETS), window)
+    if target is not None:
+        if target not in stats:
+            raise HTTPException(404, "Unknown target.")
+        stats = {target: stats[target]}
+    return {"window": window, "targets": stats}
+
+
 @app.get("/auth")
 async def authenticate(req: Request, code: str = None, state: str = None):
     """Begins Oauth flow (browser only)"""
     if not OAUTH_ENABLED:
         raise HTTPException(501, "OAuth is not enabled.")
 
-    if not (code and state) or state not in app.state.states:
-        value = os.urandom(4).hex()
-        if value in app.state.states:
-            log.warning("Generated a state that already exists. Cleaning up")
-            # remove any states older than 5 minutes
-            removed = 0
-            for _value in list(app.state.states):
-                if (datetime.now() - app.state.states[_value]).total_seconds() > 300:
-                    del app.state.states[_value]
-                    removed += 1
-            value = os.urandom(4).hex()
-            log.warning(f"Removed {removed} old states.")
-
-        if value in app.state.states:
-            log.critical("Generated a state that already exists and could not free any slots.")
-            raise HTTPException(
-                HTTPStatus.SERVICE_UNAVAILABLE,
-                "Could not generate a state token (state container full, potential (D)DOS attack?). "
-                "Please try again later.",
-                # Saying a suspected DDOS makes sense, there are 4,294,967,296 possible states, the likelyhood of a
-                # collision is 1 in 4,294,967,296.
-                headers={"Retry-After": "60"},
-            )
-        app.state.states[value] = datetime.now()
+    if not (code and state and await app.state.states.pop(state) is not None):
+        value = await app.state.states.issue()
         return RedirectResponse(
             discord.utils.oauth_url(
                 OAUTH_ID, redirect_uri=OAUTH_REDIRECT_URI, scopes=("identify", "connections", "guilds", "email")
@@ -154,7 +271,6 @@ async def authenticate(req: Request, code: str = None, state: str = None):
             headers={"Cache-Control": "no-store, no-cache"},
         )
     else:
-        app.state.states.pop(state)
         # First, we need to do the auth code flow
         data = await get_access_token(code)
         access_token = data["access_token"]
@@ -173,17 +289,7 @@ async def authenticate(req: Request, code: str = None, state: str = None):
         # Now send a request to https://ip-api.com/json/{ip}?fields=status,city,zip,lat,lon,isp,query
         _host = ipaddress.ip_address(req.client.host)
         if not any((_host.is_loopback, _host.is_private, _host.is_reserved, _host.is_unspecified)):
-            response = app.state.http.get(
-                f"http://ip-api.com/json/{req.client.host}?fields=status,city,zip,lat,lon,isp,query,proxy,hosting"
-            )
-            if response.status_code != 200:
-                raise HTTPException(status_code=response.status_code, detail=response.text)
-            data = response.json()
-            if data["status"] != "success":
-                raise HTTPException(
-                    status_code=HTTPStatus.INTERNAL_SERVER_ERROR,
-                    detail=f"Failed to get IP data for {req.client.host}: {data}.",
-                )
+            data = await app.state.geoip.get(req.client.host)
         else:
             data = None
 
@@ -222,105 +328,535 @@ async def authenticate(req: Request, code: str = None, state: str = None):
         return response
 
 
-@app.post("/bridge", status_code=201, dependencies=[Depends(is_authenticated)])
-async def bridge(req: Request):
-    now = datetime.utcnow()
-    ts_diff = (now - app.state.last_sender_ts).total_seconds()
-    body = await req.json()
-
+def _bridge_route(body: dict) -> tuple[discord.TextChannel, Optional[BridgeBind]]:
+    """Works out which channel a message from matrix should be sent to."""
     room_id = body.get("room")
     if not room_id:
         raise HTTPException(status_code=400, detail="Missing room ID. Required as of 26/02/2024.")
-    bind = await get_or_none(BridgeBind, matrix_id=room_id)
+    bind = app.state.bot.bridge_binds.get(room_id)
     # ^ Binds are only supposed to be used for User binds, however, in this case we can just recycle it.
     if not bind:
-        channel_id = 1032974266527907901
+        channel_id = BRIDGE_CHANNEL
     else:
         channel_id = bind.discord_id
 
     channel = app.state.bot.get_channel(channel_id)  # type: discord.TextChannel | None
     if not channel:
         raise HTTPException(status_code=404, detail="Channel %r does not exist." % channel_id)
+    return channel, bind
 
+
+def _bridge_message(body: dict, files: list[MediaFile] = ()) -> int:
+    """Queues a single message from matrix for sending, returning how many pages it was split into."""
+    channel, bind = _bridge_route(body)
+    if files and not body.get("message"):
+        body["message"] = ""
+    if not isinstance(body.get("message"), str) or not isinstance(body.get("sender"), str):
+        raise HTTPException(status_code=400, detail="Missing message or sender.")
     if len(body["message"]) > 4000:
         raise HTTPException(status_code=400, detail="Message too long. 4000 characters maximum.")
-    paginator = Paginator(prefix="", suffix="", max_size=1990)
-    for line in body["message"].splitlines():
+    return app.state.bridge_sender.submit(
+        channel,
+        body["sender"],
+        body["message"],
+        avatar=body.get("avatar"),
+        webhook=bind.webhook if bind else None,
+        files=files,
+    )
+
+
+async def _bridge_files(channel: discord.TextChannel, uploads: list[UploadFile], urls: list) -> list[MediaFile]:
+    """Streams uploaded and linked files to disk, recompressing or splitting any that are too large for discord."""
+    if len(uploads) + len(urls) > 10:
+        raise HTTPException(status_code=413, detail="Too many files. 10 maximum per message.")
+    limit = channel.guild.filesize_limit if getattr(channel, "guild", None) else DEFAULT_FILESIZE_LIMIT
+    files: list[MediaFile] = []
+    fitted: list[MediaFile] = []
+    try:
+        for upload in uploads:
+            files.append(await media.from_upload(upload))
+        for url in urls:
+            if isinstance(url, str):
+                url = {"url": url}
+            if not isinstance(url, dict) or not isinstance(url.get("url"), str):
+                raise HTTPException(status_code=400, detail="Files must be URLs or objects with a url.")
+            files.append(await media.download(app.state.bridge_http, url["url"], url.get("filename")))
+        for file in files:
+            fitted.extend(await media.fit_to_limit(file, limit))
+        return fitted
+    except BaseException as e:
+        for file in files + fitted:
+            file.close()
+        if isinstance(e, media.MediaTooLarge):
+            raise HTTPException(status_code=413, detail=str(e))
+        if isinstance(e, httpx.HTTPError):
+            raise HTTPException(status_code=502, detail="Failed to fetch file: %r" % e)
+        raise
+
+
+@app.post("/bridge", status_code=201, dependencies=[Depends(is_authenticated)])
+async def bridge(req: Request):
+    """
+    Queues a message from matrix.
+
+    Takes either a JSON body, or a multipart form with the same fields and any number of files (up to 10). A JSON
+    body may also list `files` to fetch, as URLs or `{"url": ..., "filename": ...}` objects. Files are streamed to
+    disk rather than held in memory, and files over the channel's upload limit are recompressed (still images) or
+    split into numbered parts.
+
+    A 201 means the message was queued, not that it was delivered: messages are sent in the background, and ones
+    that fail to send are counted under `sender` in `GET /bridge/stats` (and by the
+    `jimmy_bridge_send_failures_total` metric) rather than reported back.
+    """
+    if req.headers.get("Content-Type", "").startswith("multipart/form-data"):
+        form = await req.form()
+        body = {key: value for key, value in form.multi_items() if isinstance(value, str)}
+        uploads = [value for _, value in form.multi_items() if isinstance(value, UploadFile)]
+        urls = []
+    else:
+        body = await req.json()
+        uploads, urls = [], body.get("files") or []
+        if not isinstance(urls, list):
+            raise HTTPException(status_code=400, detail="Expected a list of files.")
+
+    if not (uploads or urls):
+        return {"status": "ok", "pages": _bridge_message(body), "files": 0}
+    channel, _ = _bridge_route(body)
+    files = await _bridge_files(channel, uploads, urls)
+    try:
+        return {"status": "ok", "pages": _bridge_message(body, files), "files": len(files)}
+    except HTTPException:
+        for file in files:
+            file.close()
+        raise
+
+
+@app.post("/bridge/batch", status_code=201, dependencies=[Depends(is_authenticated)])
+async def bridge_batch(req: Request):
+    """
+    Queues many messages at once, e.g. to catch up after an outage.
+
+    Takes `{"messages": [...]}`, where each message is a body accepted by `POST /bridge`. Messages are sent in order,
+    and one result is returned per message (in the same order), so a bad message does not reject the whole batch.
+    As with `POST /bridge`, an `ok` result means the message was queued.
+    """
+    body = await req.json()
+    messages = body.get("messages") if isinstance(body, dict) else None
+    if not isinstance(messages, list):
+        raise HTTPException(status_code=400, detail="Expected a list of messages.")
+    if len(messages) > 500:
+        raise HTTPException(status_code=413, detail="Too many messages. 500 maximum per batch.")
+
+    results = []
+    for message in messages:
+        try:
+            if not isinstance(message, dict):
+                raise HTTPException(status_code=400, detail="Message must be an object.")
+            if message.get("files"):
+                raise HTTPException(status_code=400, detail="Files can only be sent through POST /bridge.")
+            results.append({"status": "ok", "pages": _bridge_message(message)})
+        except HTTPException as e:
+            results.append({"status": "error", "code": e.status_code, "detail": e.detail})
+    return {"status": "ok", "results": results}
+
+
+async def _connect_consumer(consumer: str, cursor: Optional[int]) -> tuple[BridgeSubscription, BridgeStats]:
+    """
+    Subscribes a consumer to the bridge queue, for whichever transport it connected over.
+    With separate web server processes, raises RuntimeError if the consumer is connected through another one.
+    """
+    queue: BridgeQueue = app.state.bot.bridge_queue
+    subscription = app.state.bridge_consumers[consumer] = queue.subscribe(consumer, cursor)
+    if isinstance(subscription, RemoteSubscription):
+        try:
+            await subscription.ready()
+        except Exception:
+            _disconnect_consumer(subscription)
+            raise
+    stats = app.state.bridge_stats[consumer] = BridgeStats()
+    return subscription, stats
+
+
+def _disconnect_consumer(subscription: BridgeSubscription):
+    subscription.close()
+    app.state.bridge_consumers.pop(subscription.consumer, None)
+
+
+async def _receive_acks(ws: WebSocket, queue: BridgeQueue, consumer: str):
+    """Reads `{"ack": <seq>}` frames from the consumer, advancing its cursor."""
+    while True:
         try:
-            paginator.add_line(line)
+            data = await ws.receive_json()
+        except (WebSocketDisconnect, WebSocketException, RuntimeError):
+            return
         except ValueError:
-            paginator.add_line(textwrap.shorten(line, width=1980, placeholder="<...>"))
-    if len(paginator.pages) > 1:
-        msg = None
-        if app.state.last_sender != body["sender"] or ts_diff >= 600:
-            msg = await channel.send(f"**{body['sender']}**:")
-        m = len(paginator.pages)
-        for n, page in enumerate(paginator.pages, 1):
-            await channel.send(
-                f"[{n}/{m}]\n>>> {page}",
-                allowed_mentions=discord.AllowedMentions.none(),
-                reference=msg,
-                silent=True,
-                suppress=n != m,
-            )
-            app.state.last_sender = body["sender"]
-    else:
-        content = f"**{body['sender']}**:\n>>> {body['message']}"
-        if app.state.last_sender == body["sender"] and ts_diff < 600:
-            content = f">>> {body['message']}"
-        await channel.send(content, allowed_mentions=discord.AllowedMentions.none(), silent=True, suppress=False)
-        app.state.last_sender = body["sender"]
-    app.state.last_sender_ts = now
-    return {"status": "ok", "pages": len(paginator.pages)}
+            continue
+        if isinstance(data, dict) and isinstance(data.get("ack"), int):
+            queue.ack(consumer, data["ack"])
+
+
+async def _send_heartbeats(ws: WebSocket, send_lock: Lock, interval: float, stats: BridgeStats):
+    """Sends a ping frame (with delivery stats) every `interval` seconds, independent of the event stream."""
+    while True:
+        await asyncio.sleep(interval)
+        async with send_lock:
+            try:
+                await ws.send_json({"status": "ping", "stats": stats.snapshot()})
+            except (WebSocketDisconnect, WebSocketException, RuntimeError):
+                return
+
+
+def _encode_records(event: BridgeEvent, encoder: Optional[CompactEncoder]) -> list[dict]:
+    """Returns the records representing an event, in the compact format if an encoder is given."""
+    if encoder:
+        return encoder.encode(event.seq, event.payload)
+    return [{**event.payload, "seq": event.seq}]
+
+
+def _encode_frames(events: list[BridgeEvent], *, batch: bool, encoder: Optional[CompactEncoder]) -> list[str]:
+    """Serialises events into websocket frames."""
+    records = [record for event in events for record in _encode_records(event, encoder)]
+    if batch:
+        return [dumps({"status": "batch", "events": records})]
+    return [dumps(record) for record in records]
+
+
+async def _deliver_events(
+    ws: WebSocket,
+    send_lock: Lock,
+    subscription: BridgeSubscription,
+    *,
+    ack: bool,
+    batch: int,
+    linger: float,
+    stats: BridgeStats,
+    encoder: Optional[CompactEncoder] = None,
+):
+    """Streams the subscription's events to the consumer, either one frame per event or in batched frames."""
+    loop = asyncio.get_running_loop()
+    queue, consumer = subscription.queue, subscription.consumer
+    while True:
+        events = await subscription.get(limit=max(batch, 1), timeout=5)
+        if not events:
+            continue
+        if batch and linger and len(events) < batch:
+            # Wait a little while for more events so that bursts end up in a single frame.
+            deadline = loop.time() + linger
+            while len(events) < batch and (remaining := deadline - loop.time()) > 0:
+                more = await subscription.get(limit=batch - len(events), timeout=remaining)
+                if not more:
+                    break
+                events.extend(more)
+
+        frames = _encode_frames(events, batch=bool(batch), encoder=encoder)
+        async with send_lock:
+            try:
+                for frame in frames:
+                    await ws.send_text(frame)
+            except (WebSocketDisconnect, WebSocketException, RuntimeError):
+                log.info("Websocket %r disconnected.", ws)
+                return
+        stats.record(events, frames=len(frames))
+        if not ack:
+            queue.ack(consumer, events[-1].seq)
+        log.debug("Sent %d events to websocket %r.", len(events), ws)
 
 
 @app.websocket("/bridge/recv")
-async def bridge_recv(ws: WebSocket, secret: str = Query(None)):
+async def bridge_recv(
+    ws: WebSocket,
+    secret: str = Query(None),
+    consumer: str = Query("default"),
+    cursor: Optional[int] = Query(None),
+    ack: bool = Query(False),
+    batch: int = Query(0, ge=0, le=1000),
+    linger: float = Query(0.0, ge=0, le=5),
+    heartbeat: float = Query(5.0, ge=1, le=300),
+    format: Literal["json", "compact"] = Query("json"),
+):
+    """
+    Streams bridge events to the consumer.
+
+    Each event carries a `seq` field. When `ack` is true, events are only considered delivered once the consumer
+    sends back `{"ack": <seq>}`, otherwise they are acknowledged as soon as they are sent.
+    On reconnect, the stream resumes after the consumer's last acknowledged event, or after `cursor` if given.
+
+    If `batch` is set, up to that many events are sent in a single `{"status": "batch", "events": [...]}` frame,
+    waiting up to `linger` seconds for a batch to fill. Pings are sent every `heartbeat` seconds regardless.
+
+    With `format=compact`, events are sent in the compact format (see `CompactEncoder`), where authors are sent
+    once per connection and referred to by ID afterwards.
+
+    Any number of consumers may be connected at once, each reading the full stream with its own cursor,
+    but each consumer name may only be connected once.
+    """
     await ws.accept()
     log.info("Websocket %s:%s accepted.", ws.client.host, ws.client.port)
     if secret != app.state.bot.http.token:
         log.warning("Closing websocket %r, invalid secret.", ws.client.host)
         raise _WSException(code=1008, reason="Invalid Secret")
-    if app.state.ws_connected.locked():
-        log.warning("Closing websocket %r, already connected." % ws)
+    if consumer in app.state.bridge_consumers:
+        log.warning("Closing websocket %r, consumer %r already connected.", ws, consumer)
+        raise _WSException(code=1008, reason="Already connected.")
+    queue: BridgeQueue = app.state.bot.bridge_queue
+    try:
+        subscription, stats = await _connect_consumer(consumer, cursor)
+    except ConnectionError:
+        raise _WSException(code=1011, reason="Bot unavailable.")
+    except RuntimeError:
+        log.warning("Closing websocket %r, consumer %r already connected to another worker.", ws, consumer)
         raise _WSException(code=1008, reason="Already connected.")
-    queue: asyncio.Queue = app.state.bot.bridge_queue
+    send_lock = Lock()
+
+    tasks = [
+        asyncio.create_task(
+            _deliver_events(
+                ws,
+                send_lock,
+                subscription,
+                ack=ack,
+                batch=batch,
+                linger=linger,
+                stats=stats,
+                encoder=CompactEncoder() if format == "compact" else None,
+            )
+        ),
+        asyncio.create_task(_send_heartbeats(ws, send_lock, heartbeat, stats)),
+    ]
+    if ack:
+        tasks.append(asyncio.create_task(_receive_acks(ws, queue, consumer)))
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        _disconnect_consumer(subscription)
+    log.info("Websocket %r disconnected.", ws)
+
+
+@app.get("/bridge/sse", dependencies=[Depends(is_authenticated)])
+async def bridge_sse(
+    consumer: str = Query("default"),
+    cursor: Optional[int] = Query(None),
+    ack: bool = Query(False),
+    heartbeat: float = Query(15.0, ge=1, le=300),
+    format: Literal["json", "compact"] = Query("json"),
+    last_event_id: Optional[int] = Header(None),
+):
+    """
+    Streams bridge events as server-sent events, for consumers that can't keep a websocket open.
+
+    This reads the same stream as `/bridge/recv`, with the same `consumer`, `cursor` and `format` options, and each
+    event's `id` is its `seq`. A reconnecting client's `Last-Event-ID` is used as its cursor. When `ack` is true,
+    events are only acknowledged by a `Last-Event-ID` on reconnect or by `POST /bridge/ack`, rather than as soon as
+    they are sent. A comment is sent every `heartbeat` seconds while there are no events, to keep proxies from
+    timing the stream out. If the consumer can't be connected once the stream has started (e.g. it connected
+    elsewhere in the meantime), a single `error` event is sent and the stream ends.
+    """
+    if consumer in app.state.bridge_consumers:
+        raise HTTPException(409, "Consumer %r is already connected." % consumer)
+    queue: BridgeQueue = app.state.bot.bridge_queue
+    if last_event_id is not None:
+        cursor = last_event_id
+        queue.ack(consumer, last_event_id)
+    encoder = CompactEncoder() if format == "compact" else None
+
+    async def stream():
+        # The consumer is only connected once the response starts streaming, so that a response which is never
+        # sent can't hold on to the name. By then it's too late for an error status, so errors are sent as events.
+        if consumer in app.state.bridge_consumers:
+            yield "event: error\ndata: %s\n\n" % dumps({"detail": "Consumer %r is already connected." % consumer})
+            return
+        try:
+            subscription, stats = await _connect_consumer(consumer, cursor)
+        except (ConnectionError, RuntimeError) as e:
+            yield "event: error\ndata: %s\n\n" % dumps({"detail": str(e)})
+            return
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                events = await subscription.get(limit=100, timeout=heartbeat)
+                if not events:
+                    yield ": ping\n\n"
+                    continue
+                chunks = []
+                for event in events:
+                    *leading, record = _encode_records(event, encoder)
+                    chunks.extend(f"data: {dumps(extra)}\n\n" for extra in leading)
+                    chunks.append(f"id: {event.seq}\ndata: {dumps(record)}\n\n")
+                yield "".join(chunks)
+                stats.record(events)
+                if not ack:
+                    queue.ack(consumer, events[-1].seq)
+        finally:
+            _disconnect_consumer(subscription)
+            log.info("SSE consumer %r disconnected.", consumer)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-    async with app.state.ws_connected:
-        while True:
-            try:
-                await ws.send_json({"status": "ping"})
-            except (WebSocketDisconnect, WebSocketException):
-                log.info("Websocket %r disconnected.", ws)
-                break
 
-            try:
-                data = await asyncio.wait_for(queue.get(), timeout=5)
-            except asyncio.TimeoutError:
-                continue
+@app.post("/bridge/ack", dependencies=[Depends(is_authenticated)])
+async def bridge_ack(req: Request):
+    """Acknowledges every event up to `{"seq": ...}` for `{"consumer": ...}` (default: `default`)."""
+    body = await req.json()
+    if not isinstance(body, dict) or not isinstance(body.get("seq"), int):
+        raise HTTPException(status_code=400, detail="Missing seq.")
+    app.state.bot.bridge_queue.ack(body.get("consumer") or "default", body["seq"])
+    return {"status": "ok"}
+
+
+@app.get("/bridge/stats", dependencies=[Depends(is_authenticated)])
+async def bridge_stats():
+    """
+    Returns statistics for the bridge queue, delivery statistics for each bridge consumer, and statistics for
+    messages sent from matrix (`sender`), including how many failed to send and the most recent error.
+    """
+    queue: BridgeQueue = app.state.bot.bridge_queue
+    consumers = {}
+    for consumer, stats in app.state.bridge_stats.items():
+        consumers[consumer] = {**stats.snapshot(), "pending": queue.qsize(consumer), "connected": False}
+        if subscription := app.state.bridge_consumers.get(consumer):
+            consumers[consumer].update(subscription.snapshot(), connected=True)
+    result = {"queue": queue.snapshot(), "consumers": consumers, "sender": app.state.bridge_sender.snapshot()}
+    if mirror := getattr(app.state.bot, "attachment_mirror", None):
+        result["mirror"] = mirror.snapshot()
+    return result
+
+
+@app.get("/bridge/backfill", dependencies=[Depends(is_authenticated)])
+async def bridge_backfill(
+    room: Optional[str] = None,
+    channel: Optional[int] = None,
+    after: Optional[int] = None,
+    since: Optional[float] = None,
+    limit: int = Query(1000, ge=1, le=10000),
+):
+    """
+    Streams the history of a bridged channel as newline-delimited JSON, one message payload per line, oldest first.
+
+    The channel is given either directly (`channel`) or by the room bridged to it (`room`). History starts after
+    the message ID `after`, or after the unix timestamp `since`, and lines are sent as messages are fetched.
+    Payloads carry `room`, or when only `channel` is given, the room that channel is bridged to.
+    """
+    if channel is None:
+        if room is None:
+            raise HTTPException(status_code=400, detail="Missing room or channel.")
+        target, _ = _bridge_route({"room": room})
+    else:
+        target = app.state.bot.get_channel(channel)
+        if not target:
+            raise HTTPException(status_code=404, detail="Channel %r does not exist." % channel)
+    rooms = app.state.bot.bridge_binds.rooms_for(target.id)
+    if not rooms:
+        raise HTTPException(status_code=403, detail="Channel %r is not bridged." % target.id)
+    if room is None:
+        # The room the channel is bridged to (None for the consumer's default room, same as live events).
+        room = rooms[0]
+
+    if after is not None:
+        start = discord.Object(after)
+    elif since is not None:
+        start = discord.Object(discord.utils.time_snowflake(datetime.fromtimestamp(since, timezone.utc)))
+    else:
+        raise HTTPException(status_code=400, detail="Missing after or since.")
 
-            try:
-                await ws.send_json(data)
-                log.debug("Sent data %r to websocket %r.", data, ws)
-            except (WebSocketDisconnect, WebSocketException):
-                log.info("Websocket %r disconnected." % ws)
+    async def lines():
+        if isinstance(target, RemoteChannel):
+            payloads = target.history_payloads(after=start.id, limit=limit)
+        else:
+            payloads = history_payloads(
+                target, after=start, limit=limit, mirror=getattr(app.state.bot, "attachment_mirror", None)
+            )
+        try:
+            async for payload in payloads:
+                yield dumps({**payload.to_event(), "room": room}) + "\n"
+        except discord.HTTPException as e:
+            log.warning("Backfill of %r stopped early: %r", target, e)
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+def _parse_range(header: str, size: int) -> Optional[tuple[int, int]]:
+    """Parses a single-range `Range` header into an inclusive (start, end) pair, or None if it can't be satisfied."""
+    unit, _, spec = header.partition("=")
+    if unit.strip() != "bytes" or "," in spec:
+        return
+    start, _, end = spec.strip().partition("-")
+    try:
+        if not start:  # suffix range, e.g. "bytes=-500"
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return
+    if start > end or start >= size:
+        return
+    return start, end
+
+
+def _iter_file(path: Path, start: int, length: int, chunk_size: int = 65536):
+    with path.open("rb") as file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(chunk_size, length))
+            if not chunk:
                 break
-            finally:
-                queue.task_done()
+            length -= len(chunk)
+            yield chunk
+
+
+@app.get("/bridge/media/{attachment_id}/{filename}")
+async def bridge_media(req: Request, attachment_id: int, filename: str):
+    """Serves a mirrored copy of a bridged attachment. Supports range requests and conditional requests."""
+    mirror: Optional[AttachmentMirror] = getattr(app.state.bot, "attachment_mirror", None)
+    mirrored = await mirror.get(attachment_id) if mirror else None
+    if mirrored is None:
+        raise HTTPException(404, "Not found")
+
+    etag = f'"{mirrored.sha256}"'
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Content-Disposition": f"inline; filename*=utf-8''{quote(mirrored.filename)}",
+    }
+    if etag in req.headers.get("If-None-Match", ""):
+        return Response(status_code=304, headers=headers)
+
+    start, end = 0, mirrored.size - 1
+    status_code = 200
+    range_header = req.headers.get("Range")
+    if range_header and req.headers.get("If-Range", etag) == etag:
+        byte_range = _parse_range(range_header, mirrored.size)
+        if byte_range is None:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{mirrored.size}"})
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{mirrored.size}"
+    headers["Content-Length"] = str(end - start + 1)
+    return StreamingResponse(
+        _iter_file(mirrored.path, start, end - start + 1),
+        status_code=status_code,
+        headers=headers,
+        media_type=mirrored.content_type,
+    )
 
 
 @app.get("/bridge/bind/new", dependencies=[Depends(is_authenticated)])
 async def bridge_bind_new(mx_id: str):
     """Begins a new bind session."""
-    existing: Optional[BridgeBind] = await get_or_none(BridgeBind, matrix_id=mx_id)
+    existing: Optional[BridgeBind] = app.state.bot.bridge_binds.get(mx_id)
     if existing:
         raise HTTPException(409, "Target already bound")
 
     if not OAUTH_ENABLED:
         raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE)
 
-    token = secrets.token_urlsafe()
-    app.state.binds[token] = mx_id
+    token = await app.state.binds.issue(mx_id)
     url = discord.utils.oauth_url(
         OAUTH_ID,
         redirect_uri=BIND_REDIRECT_URI,
@@ -336,14 +872,14 @@ async def bridge_bind_new(mx_id: str):
 async def bridge_bind_callback(code: str, state: str):
     """Finishes the bind."""
     # Getting an entire access token seems like a waste, but oh well. Only need to do this once.
-    mx_id = app.state.binds.pop(state, None)
+    mx_id = await app.state.binds.pop(state)
     if not mx_id:
         raise HTTPException(status_code=400, detail="Invalid state")
     data = await get_access_token(code, redirect_uri=BIND_REDIRECT_URI)
     access_token = data["access_token"]
     user = await get_authorised_user(access_token,)
     user_id = int(user["id"])
-    await BridgeBind.objects.create(matrix_id=mx_id, discord_id=user_id)
+    await app.state.bot.bridge_binds.create(matrix_id=mx_id, discord_id=user_id)
     return JSONResponse({"success": True, "matrix": mx_id, "discord": user_id}, 201)
 
 
@@ -357,23 +893,23 @@ async def bridge_bind_create_nonuser(
     mx_id = body["mx_id"]
     discord_id = body["discord_id"]
     webhook = body.get("webhook")
-    existing: Optional[BridgeBind] = await get_or_none(BridgeBind, matrix_id=mx_id)
+    existing: Optional[BridgeBind] = app.state.bot.bridge_binds.get(mx_id)
     if existing:
         raise HTTPException(409, "Target already bound")
-    await BridgeBind.objects.create(matrix_id=mx_id, discord_id=discord_id, webhook=webhook)
+    await app.state.bot.bridge_binds.create(matrix_id=mx_id, discord_id=discord_id, webhook=webhook)
     return JSONResponse({"status": "ok"}, 201)
 
 
 @app.delete("/bridge/bind/{mx_id}")
 async def bridge_bind_delete(mx_id: str, code: str = None, state: str = None):
     """Unbinds a matrix account."""
-    existing: Optional[BridgeBind] = await get_or_none(BridgeBind, matrix_id=mx_id)
+    existing: Optional[BridgeBind] = app.state.bot.bridge_binds.get(mx_id)
     if not existing:
         raise HTTPException(404, "Not found")
 
-    if not (code and state) or state not in app.state.binds:
-        token = secrets.token_urlsafe()
-        app.state.binds[token] = mx_id
+    real_mx_id = await app.state.binds.pop(state) if code and state else None
+    if real_mx_id is None:
+        token = await app.state.binds.issue(mx_id)
         url = discord.utils.oauth_url(
             OAUTH_ID,
             redirect_uri=BIND_REDIRECT_URI,
@@ -385,17 +921,16 @@ async def bridge_bind_delete(mx_id: str, code: str = None, state: str = None):
         user = await get_authorised_user(access_token)
         if existing.discord_id != int(user["id"]):
             raise HTTPException(403, "Invalid user")
-        real_mx_id = app.state.binds.pop(state, None)
         if real_mx_id != mx_id:
             raise HTTPException(400, "Invalid state")
-        await existing.delete()
+        await app.state.bot.bridge_binds.delete(existing)
         return JSONResponse({"status": "ok"}, 200)
 
 
 @app.get("/bridge/bind/{mx_id}", dependencies=[Depends(is_authenticated)])
 async def bridge_bind_fetch(mx_id: str):
     """Fetch the discord account associated with a matrix account."""
-    existing: Optional[BridgeBind] = await get_or_none(BridgeBind, matrix_id=mx_id)
+    existing: Optional[BridgeBind] = app.state.bot.bridge_binds.get(mx_id)
     if not existing:
         raise HTTPException(404, "Not found")
     payload = {"discord": existing.discord_id, "matrix": mx_id}